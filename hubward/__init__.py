@@ -2,5 +2,16 @@ import liftover
 import utils
 from log import log
 import models
+import scheduler
+import manifest
+import status
+import workers
+import download
+import cache
+import archive
+import decompress
+import chain
+import genomes
+import metadata
 import generate_config_from_schema
 from version import __version__
@@ -0,0 +1,358 @@
+"""
+Module for extracting files from tar and zip archives.
+
+A track usually needs only one file out of a source archive, so members are
+extracted selectively. For zip and uncompressed tar archives, the listing of
+members is built once and cached next to the archive in
+`<archive>.index.json`, so that tracks drawing from the same large archive
+can each look up and extract their own members concurrently, reading them
+directly from their recorded offsets. Compressed tar archives have no
+usable offsets, so they are not indexed: they are streamed through the
+fastest available decompressor (see `hubward.decompress`) in a single pass
+that stops after the last requested member.
+
+Members are copied in chunks (never read fully into memory) to a temporary
+file that is renamed once complete.
+"""
+import os
+import json
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import posixpath
+import threading
+from hubward import utils, decompress
+
+TAR_SUFFIXES = (
+    '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz',
+    '.tar.zst', '.tzst', '.tar.z')
+
+ZIP_SUFFIXES = ('.zip',)
+
+# Bump when the format of the cached index changes
+INDEX_VERSION = 1
+
+# Size of each read when copying a member
+CHUNK_SIZE = 1024 * 1024
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+_index_locks = {}
+
+
+def is_archive(filename):
+    """
+    Whether `filename` can be extracted by this module.
+    """
+    return filename.lower().endswith(TAR_SUFFIXES + ZIP_SUFFIXES)
+
+
+def is_indexed(filename):
+    """
+    Whether members of archive `filename` (zip or uncompressed tar) are read
+    from their offsets, so that extracting some of them doesn't read the
+    rest of the archive.
+    """
+    return filename.lower().endswith(ZIP_SUFFIXES + ('.tar',))
+
+
+def _normalize(name):
+    return posixpath.normpath(name).lstrip('/')
+
+
+def _target(dest, name):
+    """
+    Path that member `name` extracts to within `dest`, refusing names that
+    would end up outside of it.
+    """
+    dest = os.path.abspath(dest)
+    path = os.path.abspath(os.path.join(dest, *name.split('/')))
+    if not path.startswith(dest + os.sep):
+        raise ValueError(
+            "Refusing to extract {0} outside of {1}".format(name, dest))
+    return path
+
+
+def _copy(fileobj, path, size=None, mode=None, mtime=None):
+    """
+    Copy `size` bytes (or everything) from `fileobj` to `path`, via
+    a temporary file in the same directory so that `path` never exists
+    partially written.
+    """
+    utils.makedirs(os.path.dirname(path))
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            if size is None:
+                shutil.copyfileobj(fileobj, fout, CHUNK_SIZE)
+            else:
+                remaining = size
+                while remaining > 0:
+                    chunk = fileobj.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise ValueError(
+                            "Unexpected end of archive while extracting {0}"
+                            .format(path))
+                    fout.write(chunk)
+                    remaining -= len(chunk)
+        if mode is not None:
+            os.chmod(tmp, mode & 0o777 | 0o600)
+        if mtime is not None:
+            os.utime(tmp, (mtime, mtime))
+        os.rename(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def extract_tar_member(tar, member, dest):
+    """
+    Extract one `member` of open tarfile `tar` into directory `dest`, and
+    return the path it was extracted to.
+
+    Works for tarfiles opened in streaming mode (e.g., 'r|*') as long as
+    members are extracted in the order they are read.
+    """
+    path = _target(dest, member.name)
+    if member.isfile():
+        _copy(tar.extractfile(member), path, mode=member.mode,
+              mtime=member.mtime)
+    elif member.isdir():
+        utils.makedirs(path)
+    else:
+        tar.extract(member, dest)
+    return path
+
+
+class ArchiveIndex(object):
+    def __init__(self, filename):
+        """
+        Listing of the members of a zip or uncompressed tar archive.
+
+        `members` is a dict mapping each member name (normalized, e.g.
+        without a leading "./") to a dict with keys "name" (as stored in the
+        archive), "type" ("file", "dir", or "other"), "size", "mode",
+        "mtime", and "offset" (where the member's data starts).
+
+        Loaded from `<filename>.index.json` if that was written for the
+        current size and modification time of the archive; otherwise built
+        by reading the archive and saved there.
+        """
+        self.filename = filename
+        self.cache_fn = filename + '.index.json'
+        st = os.stat(filename)
+        self.key = [INDEX_VERSION, st.st_size, st.st_mtime]
+        self.is_zip = filename.lower().endswith(ZIP_SUFFIXES)
+        self.members = self._load()
+        if self.members is None:
+            self.members = self._build()
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self.cache_fn) as f:
+                cached = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if cached.get('key') != self.key:
+            return None
+        return cached['members']
+
+    def _save(self):
+        tmp = self.cache_fn + '.{0}.tmp'.format(os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(dict(key=self.key, members=self.members), f)
+            os.rename(tmp, self.cache_fn)
+        except (IOError, OSError):
+            # e.g., a read-only directory; the index is just rebuilt next time
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def _build(self):
+        members = {}
+        if self.is_zip:
+            z = zipfile.ZipFile(self.filename)
+            try:
+                for info in z.infolist():
+                    members[_normalize(info.filename)] = dict(
+                        name=info.filename,
+                        type='dir' if info.filename.endswith('/') else 'file',
+                        size=info.file_size,
+                        mode=(info.external_attr >> 16) or 0o644,
+                        mtime=None,
+                        offset=info.header_offset)
+            finally:
+                z.close()
+            return members
+
+        with open(self.filename, 'rb') as f:
+            return self._build_tar(f)
+
+    def _build_tar(self, f):
+        members = {}
+        tar = tarfile.open(fileobj=f, mode='r|')
+        try:
+            for member in tar:
+                if member.isfile():
+                    type_ = 'file'
+                elif member.isdir():
+                    type_ = 'dir'
+                else:
+                    type_ = 'other'
+                members[_normalize(member.name)] = dict(
+                    name=member.name, type=type_, size=member.size,
+                    mode=member.mode, mtime=member.mtime,
+                    offset=member.offset_data)
+        finally:
+            tar.close()
+        return members
+
+    def find(self, names):
+        """
+        Returns the entries for `names`, or None if any of them is not
+        a regular file in the archive.
+        """
+        entries = []
+        for name in names:
+            entry = self.members.get(_normalize(name))
+            if entry is None or entry['type'] != 'file':
+                return None
+            entries.append(entry)
+        return entries
+
+
+def index(filename):
+    """
+    Returns the (memoized) `ArchiveIndex` for `filename`. Concurrent callers
+    wait for a single thread to build it.
+    """
+    path = os.path.abspath(filename)
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime)
+    with _indexes_lock:
+        if key in _indexes:
+            return _indexes[key]
+        lock = _index_locks.setdefault(path, threading.Lock())
+    with lock:
+        with _indexes_lock:
+            if key in _indexes:
+                return _indexes[key]
+        result = ArchiveIndex(path)
+        with _indexes_lock:
+            _indexes[key] = result
+    return result
+
+
+def extract(filename, dest, members=None):
+    """
+    Extract a tar or zip archive into directory `dest`.
+
+    Parameters
+    ----------
+    filename : str
+
+    dest : str
+
+    members : list or None
+        Names (relative to the top of the archive) of the files to extract.
+        If None, or if any of them is not a regular file in the archive,
+        everything is extracted.
+
+    Returns a list of the paths extracted.
+    """
+    if not is_indexed(filename):
+        return _extract_tar(filename, dest, members)
+
+    idx = index(filename)
+    entries = None
+    if members is not None:
+        entries = idx.find(members)
+
+    if idx.is_zip:
+        if entries is None:
+            entries = list(idx.members.values())
+        return _extract_zip(filename, dest, entries)
+    if entries is not None:
+        return _extract_plain_tar(filename, dest, entries)
+    return _extract_tar(filename, dest)
+
+
+def _extract_zip(filename, dest, entries):
+    paths = []
+    z = zipfile.ZipFile(filename)
+    try:
+        for entry in entries:
+            path = _target(dest, entry['name'].rstrip('/'))
+            if entry['type'] == 'dir':
+                utils.makedirs(path)
+            else:
+                src = z.open(entry['name'])
+                try:
+                    _copy(src, path, mode=entry['mode'])
+                finally:
+                    src.close()
+            paths.append(path)
+    finally:
+        z.close()
+    return paths
+
+
+def _extract_plain_tar(filename, dest, entries):
+    """
+    Uncompressed tar files can be read directly at each member's offset.
+    """
+    paths = []
+    with open(filename, 'rb') as f:
+        for entry in entries:
+            path = _target(dest, entry['name'])
+            f.seek(entry['offset'])
+            _copy(f, path, size=entry['size'], mode=entry['mode'],
+                  mtime=entry['mtime'])
+            paths.append(path)
+    return paths
+
+
+def _extract_tar(filename, dest, members=None):
+    """
+    Compressed tar files have to be read from the start, but reading stops
+    once all requested `members` have been extracted. If `members` is None,
+    everything is extracted.
+
+    If any of `members` turns out not to be a regular file in the archive,
+    everything is extracted, which takes a second pass.
+    """
+    wanted = None
+    if members is not None:
+        wanted = set(_normalize(name) for name in members)
+    with decompress.open_stream(filename) as f:
+        paths = _extract_tar_stream(f, dest, wanted)
+    if wanted:
+        return _extract_tar(filename, dest)
+    return paths
+
+
+def _extract_tar_stream(f, dest, wanted):
+    """
+    Extract members of tar stream `f`; see `_extract_tar`. Members found are
+    removed from the set `wanted`.
+    """
+    paths = []
+    tar = tarfile.open(fileobj=f, mode='r|')
+    try:
+        for member in tar:
+            if wanted is None:
+                paths.append(extract_tar_member(tar, member, dest))
+                continue
+            name = _normalize(member.name)
+            if name not in wanted or not member.isfile():
+                continue
+            paths.append(extract_tar_member(tar, member, dest))
+            wanted.discard(name)
+            if not wanted:
+                break
+    finally:
+        tar.close()
+    return paths
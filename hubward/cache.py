@@ -0,0 +1,543 @@
+"""
+Module for sharing downloaded sources between studies.
+
+Several studies often use the same upstream file. Rather than each study
+downloading its own copy into `<study>/raw-data`, sources are downloaded once
+into a cache directory (see `hubward.utils.cache_dir`) and linked into each
+study's `raw-data`.
+
+The cache is laid out as::
+
+    downloads/urls/<sha1 of url>-<basename>
+        the most recent download of each URL (plus the `.source.json` sidecar
+        used for resuming and refreshing; see `hubward.download`)
+
+    downloads/objects/<xx>/<sha1 of contents>
+        the same files keyed by content, so that identical files from
+        different URLs are only stored once
+
+    downloads/locks/<sha1 of url>.lock
+        held while a URL is being downloaded, so that concurrent hubward
+        processes on the same machine download each URL only once
+
+Study files are hardlinks to the objects, or symlinks if the study is on
+a different filesystem from the cache. Processing scripts should therefore
+never modify their original files in place. For that reason the download
+cache is only used when asked for (see `download_cache`).
+
+Lifted-over files can be cached too (see `liftover_cache`), keyed by the
+contents of the input and chain files, so that lifting over the same file
+again (from another study, or into a new directory) just links the earlier
+result. The cache stores its own copy of each result, so that editing a
+study's file can't change it::
+
+    liftover/objects/<xx>/<key>
+        a lifted-over file (plus `<key>.bai` for BAMs)
+
+    liftover/objects/<xx>/<key>.sha1
+        the size and hash of the file when it was stored; entries that no
+        longer match (e.g., because a study's hardlink to one was edited in
+        place) are dropped rather than used
+
+    liftover/objects/<xx>/<key>.used
+        touched whenever the entry is used; entries whose marker is oldest
+        are evicted first once the cache exceeds its size limit
+
+    liftover/stats.json
+        hit and miss counts
+"""
+import os
+import json
+import time
+import errno
+import fcntl
+import shutil
+import hashlib
+import threading
+import contextlib
+import subprocess
+from hubward import utils, download, manifest
+from hubward.log import log
+
+
+def _url_key(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def _copy(src, dest):
+    """
+    Copy `src` to `dest`, as a reflink (sharing blocks with `src`) if the
+    filesystem supports it.
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(
+                ['cp', '--reflink=auto', '-p', src, dest], stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        # e.g., a `cp` without --reflink
+        shutil.copy2(src, dest)
+
+
+def _link(src, dest, symlink=True):
+    """
+    Atomically replace `dest` with a hardlink to `src`. If a hardlink is not
+    possible, falls back to a symlink (if `symlink` is True) or a copy.
+    """
+    tmp = dest + '.link'
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        if symlink:
+            os.symlink(os.path.abspath(src), tmp)
+        else:
+            _copy(src, tmp)
+    os.rename(tmp, dest)
+
+
+@contextlib.contextmanager
+def _flock(fn, blocking=True):
+    """
+    Context manager holding an exclusive lock on file `fn`, across threads
+    and processes. Yields True once locked or, if not `blocking` and someone
+    else holds the lock, yields False straight away.
+    """
+    with open(fn, 'a') as f:
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(f.fileno(), flags)
+        except (IOError, OSError) as e:
+            if blocking or e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def download_cache(enabled=False):
+    """
+    Returns a `DownloadCache` if `enabled` (e.g., `hubward process --cache`)
+    or if the HUBWARD_DOWNLOAD_CACHE environment variable is set to anything
+    but "" or "0", otherwise None so that sources are downloaded directly
+    into each study.
+
+    HUBWARD_CACHE_DIR alone doesn't turn it on, since it is also where the
+    other (read-only) caches live.
+    """
+    if enabled or os.environ.get('HUBWARD_DOWNLOAD_CACHE', '0') not in (
+            '', '0'):
+        return DownloadCache()
+    return None
+
+
+def liftover_cache(enabled=False):
+    """
+    Returns a `LiftoverCache` if `enabled` (e.g., `hubward liftover --cache`)
+    or if the HUBWARD_LIFTOVER_CACHE environment variable is set to anything
+    but "" or "0", otherwise None so that every track is lifted over.
+    """
+    if enabled or os.environ.get('HUBWARD_LIFTOVER_CACHE', '0') not in (
+            '', '0'):
+        return LiftoverCache()
+    return None
+
+
+class DownloadCache(object):
+    def __init__(self, path=None):
+        """
+        A cache of downloaded files shared by all studies.
+
+        Parameters
+        ----------
+        path : str or None
+            Cache directory. Defaults to `downloads` within
+            `hubward.utils.cache_dir()`.
+        """
+        if path is None:
+            path = os.path.join(utils.cache_dir(), 'downloads')
+        self.path = path
+        utils.makedirs([
+            os.path.join(path, 'urls'),
+            os.path.join(path, 'objects'),
+            os.path.join(path, 'locks'),
+        ])
+
+    def url_path(self, url):
+        """
+        Path to the cached copy of `url`.
+        """
+        return os.path.join(
+            self.path, 'urls',
+            _url_key(url) + '-' + os.path.basename(url.rstrip('/')))
+
+    def object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest)
+
+    @contextlib.contextmanager
+    def lock(self, url):
+        """
+        Context manager holding an exclusive lock on `url`, across threads
+        and processes.
+        """
+        with _flock(os.path.join(
+                self.path, 'locks', _url_key(url) + '.lock')):
+            yield
+
+    def _store(self, cached):
+        """
+        File a newly-downloaded `cached` file under its content hash.
+        """
+        digest = manifest.file_hash(cached)
+        obj = self.object_path(digest)
+        utils.makedirs(os.path.dirname(obj))
+        if not os.path.exists(obj):
+            _link(cached, obj, symlink=False)
+        elif not os.path.samefile(cached, obj):
+            # Same contents as a file from another URL; keep one copy
+            _link(obj, cached, symlink=False)
+        info = download.source_info(cached)
+        info['sha1'] = digest
+        download.write_source_info(cached, info)
+
+    def fetch(self, url, dest, refresh=False, downloader=None):
+        """
+        Make `dest` a link to the cached copy of `url`, downloading it first
+        if it isn't cached yet.
+
+        Parameters
+        ----------
+        url, dest : str
+
+        refresh : bool
+            If True, check whether the cached copy is out of date with
+            a conditional request, and download it again if so.
+
+        downloader : hubward.download.DownloadManager or None
+            If provided, download through this manager.
+
+        Returns True if `dest` was created or now has different contents.
+        """
+        with self.lock(url):
+            cached = self.url_path(url)
+            info = download.source_info(cached)
+            if refresh or not (
+                os.path.exists(cached) and
+                os.path.exists(self.object_path(info.get('sha1', '')))
+            ):
+                if downloader is not None:
+                    d = downloader.submit(url, cached, refresh=refresh)
+                    d.wait()
+                    changed = d.changed
+                else:
+                    changed = utils.download(url, cached, refresh=refresh)
+                if changed or 'sha1' not in info:
+                    self._store(cached)
+                    info = download.source_info(cached)
+            else:
+                log("Using cached {0}".format(url), indent=4)
+
+        obj = self.object_path(info['sha1'])
+        if os.path.exists(dest) and os.path.samefile(obj, dest):
+            return False
+        utils.makedirs(os.path.dirname(os.path.abspath(dest)))
+        _link(obj, dest)
+        return True
+
+    def stats(self):
+        """
+        Returns a dict with the number of cached URLs ("entries") and the
+        total size of the cached files in bytes ("size").
+        """
+        urls = [fn for fn in os.listdir(os.path.join(self.path, 'urls'))
+                if not fn.endswith(('.source.json', '.part'))]
+        return dict(entries=len(urls), size=_disk_usage(
+            os.path.join(self.path, 'objects')))
+
+
+# Default size limit of the liftover cache
+LIFTOVER_CACHE_SIZE = '50G'
+
+# Files written next to a lifted-over file that belong with it
+COMPANION_SUFFIXES = ('.bai',)
+
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def _disk_usage(path):
+    """
+    Total size, in bytes, of the distinct files under `path`.
+    """
+    total = 0
+    seen = set()
+    for root, dirs, files in os.walk(path):
+        for fn in files:
+            st = os.stat(os.path.join(root, fn))
+            if st.st_ino not in seen:
+                seen.add(st.st_ino)
+                total += st.st_size
+    return total
+
+
+def _memoized_hash(filename):
+    """
+    `manifest.file_hash`, remembered for as long as the file's size and
+    modification time don't change (chain files are hashed for every track).
+    """
+    st = os.stat(filename)
+    key = (os.path.abspath(filename), st.st_size, st.st_mtime)
+    with _file_hashes_lock:
+        if key in _file_hashes:
+            return _file_hashes[key]
+    digest = manifest.file_hash(filename)
+    with _file_hashes_lock:
+        _file_hashes[key] = digest
+    return digest
+
+
+class LiftoverCache(object):
+    def __init__(self, path=None, max_size=None):
+        """
+        A cache of lifted-over files shared by all studies.
+
+        Parameters
+        ----------
+        path : str or None
+            Cache directory. Defaults to `liftover` within
+            `hubward.utils.cache_dir()`.
+
+        max_size : str, int, or None
+            Size limit (as for `hubward.utils.parse_memory`, e.g. "50G";
+            plain numbers are MB). Once exceeded, the least recently used
+            entries are evicted. Defaults to $HUBWARD_LIFTOVER_CACHE_SIZE,
+            or LIFTOVER_CACHE_SIZE.
+
+        Evicting an entry only removes the cache's own link to it; studies
+        that were linked to it keep their copy.
+        """
+        if path is None:
+            path = os.path.join(utils.cache_dir(), 'liftover')
+        if max_size is None:
+            max_size = os.environ.get(
+                'HUBWARD_LIFTOVER_CACHE_SIZE', LIFTOVER_CACHE_SIZE)
+        self.path = path
+        self.max_size = utils.parse_memory(max_size) * 1024 * 1024
+        utils.makedirs([
+            os.path.join(path, 'objects'),
+            os.path.join(path, 'locks'),
+        ])
+
+    def key(self, infile, chainfile, filetype, tool_version):
+        """
+        Cache key for lifting over `infile` of type `filetype` with
+        `chainfile`, using the tools described by `tool_version` (see
+        `hubward.liftover.tool_version`).
+        """
+        parts = [manifest.file_hash(infile), _memoized_hash(chainfile),
+                 filetype.lower(), tool_version]
+        return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+
+    def object_path(self, key):
+        return os.path.join(self.path, 'objects', key[:2], key)
+
+    @contextlib.contextmanager
+    def lock(self, key, blocking=True):
+        """
+        Context manager holding an exclusive lock on `key`, so that
+        concurrent hubward processes lift over each file only once. See
+        `_flock` for `blocking`.
+        """
+        with _flock(os.path.join(self.path, 'locks', key + '.lock'),
+                    blocking) as locked:
+            yield locked
+
+    def _touch(self, key):
+        with open(self.object_path(key) + '.used', 'a'):
+            pass
+        os.utime(self.object_path(key) + '.used', None)
+
+    def _count(self, name):
+        with _flock(os.path.join(self.path, 'locks', 'stats.lock')):
+            counts = self._counts()
+            counts[name] = counts.get(name, 0) + 1
+            tmp = os.path.join(self.path, 'stats.json.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(counts, f)
+            os.rename(tmp, os.path.join(self.path, 'stats.json'))
+
+    def _counts(self):
+        try:
+            with open(os.path.join(self.path, 'stats.json')) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _check(self, fn):
+        return '{0} {1}'.format(os.stat(fn).st_size, manifest.file_hash(fn))
+
+    def _remove(self, key):
+        obj = self.object_path(key)
+        for suffix in ('',) + COMPANION_SUFFIXES + ('.sha1', '.used'):
+            if os.path.exists(obj + suffix):
+                os.unlink(obj + suffix)
+
+    def get(self, key, dest):
+        """
+        If `key` is cached, make `dest` (and any companion files, e.g.
+        `dest.bai`) a hardlink to it, or a reflink or copy if that's not
+        possible, and return True. Otherwise return False.
+
+        An entry whose size or hash has changed since it was stored (e.g.,
+        because a study's hardlink to it was edited in place) is removed and
+        counts as a miss.
+        """
+        obj = self.object_path(key)
+        if os.path.exists(obj):
+            try:
+                with open(obj + '.sha1') as f:
+                    stored = f.read().strip()
+            except (IOError, OSError):
+                stored = None
+            if stored != self._check(obj):
+                log('Cached liftover {0} was modified; removing it'
+                    .format(obj))
+                self._remove(key)
+        if not os.path.exists(obj):
+            self._count('misses')
+            return False
+        utils.makedirs(os.path.dirname(os.path.abspath(dest)))
+        for suffix in ('',) + COMPANION_SUFFIXES:
+            if os.path.exists(obj + suffix):
+                _link(obj + suffix, dest + suffix, symlink=False)
+        self._touch(key)
+        self._count('hits')
+        return True
+
+    def put(self, key, src):
+        """
+        Store a copy (or reflink) of lifted-over file `src` (and any
+        companion files) under `key`, then evict old entries if the cache is
+        over its size limit.
+
+        `src` is copied rather than hardlinked so that later changes to it
+        don't reach the cache.
+        """
+        obj = self.object_path(key)
+        utils.makedirs(os.path.dirname(obj))
+        for suffix in COMPANION_SUFFIXES:
+            if os.path.exists(src + suffix):
+                _copy(src + suffix, obj + suffix + '.tmp')
+                os.rename(obj + suffix + '.tmp', obj + suffix)
+        _copy(src, obj + '.tmp')
+        with open(obj + '.sha1', 'w') as f:
+            f.write(self._check(obj + '.tmp') + '\n')
+        # The main file goes last, since its presence marks a complete entry
+        os.rename(obj + '.tmp', obj)
+        self._touch(key)
+        self.evict(keep=key)
+
+    def entries(self):
+        """
+        Returns a list of dicts, one per cached file, with keys "key",
+        "size" (in bytes, including companion files), and "used" (time of
+        last use), least recently used first.
+        """
+        entries = []
+        objects = os.path.join(self.path, 'objects')
+        for prefix in os.listdir(objects):
+            for fn in os.listdir(os.path.join(objects, prefix)):
+                if '.' in fn:
+                    continue
+                obj = self.object_path(fn)
+                try:
+                    used = os.stat(obj + '.used').st_mtime
+                except OSError:
+                    used = 0
+                size = sum(
+                    os.stat(obj + suffix).st_size
+                    for suffix in ('',) + COMPANION_SUFFIXES
+                    if os.path.exists(obj + suffix))
+                entries.append(dict(key=fn, size=size, used=used))
+        return sorted(entries, key=lambda e: e['used'])
+
+    def evict(self, max_size=None, keep=None):
+        """
+        Remove the least recently used entries until the cache is within
+        `max_size` bytes (by default, `self.max_size`), except for the entry
+        `keep` (whose lock the caller may be holding). Returns the number of
+        entries removed.
+
+        Entries locked by others (e.g., being stored by a concurrent `put`,
+        which calls this while holding its own lock) are skipped rather than
+        waited for, so that two of them can't wait on each other.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        entries = self.entries()
+        total = sum(e['size'] for e in entries)
+        removed = 0
+        for entry in entries:
+            if total <= max_size:
+                break
+            if entry['key'] == keep:
+                continue
+            with self.lock(entry['key'], blocking=False) as locked:
+                if not locked:
+                    continue
+                self._remove(entry['key'])
+            total -= entry['size']
+            removed += 1
+        if removed:
+            log('Evicted {0} lifted-over files from {1}'.format(
+                removed, self.path))
+        return removed
+
+    def stats(self):
+        """
+        Returns a dict with keys "entries", "size" (bytes), "max_size"
+        (bytes), "hits", "misses", and "oldest" (time the least recently
+        used entry was last used, or None).
+        """
+        entries = self.entries()
+        counts = self._counts()
+        return dict(
+            entries=len(entries),
+            size=sum(e['size'] for e in entries),
+            max_size=self.max_size,
+            hits=counts.get('hits', 0),
+            misses=counts.get('misses', 0),
+            oldest=entries[0]['used'] if entries else None)
+
+
+def format_stats(downloads, liftovers):
+    """
+    Format the `stats()` of a DownloadCache and a LiftoverCache as text.
+    """
+    lines = [
+        'downloads: {0} URLs, {1:.1f} MB'.format(
+            downloads['entries'], downloads['size'] / 1e6),
+        'liftover:  {0} files, {1:.1f} of {2:.1f} MB; {3} hits, {4} misses'
+        .format(liftovers['entries'], liftovers['size'] / 1e6,
+                liftovers['max_size'] / 1e6, liftovers['hits'],
+                liftovers['misses']),
+    ]
+    if liftovers['oldest'] is not None:
+        lines.append('           least recently used: {0}'.format(
+            time.strftime('%Y-%m-%d %H:%M',
+                          time.localtime(liftovers['oldest']))))
+    return '\n'.join(lines)
+
+
+def format_json(downloads, liftovers):
+    """
+    Format the `stats()` of a DownloadCache and a LiftoverCache as JSON.
+    """
+    return json.dumps(dict(downloads=downloads, liftover=liftovers), indent=2)
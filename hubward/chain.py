@@ -0,0 +1,529 @@
+"""
+Module for lifting over BED intervals using UCSC chain files, without the
+`liftOver` program.
+
+A chain file (e.g., hg19ToHg38.over.chain.gz) is parsed once into sorted
+arrays of aligned blocks for each source chromosome, which are saved to
+`<HUBWARD_CACHE_DIR>/<chainfile>.npz`. Later runs load that instead of
+parsing the chain file again. The arrays of each chromosome are only read
+from the .npz the first time that chromosome is used.
+
+Intervals are then mapped in batches with NumPy. As with `liftOver`, an
+interval is mapped to the span from its first to its last aligned base, and
+fails to map if fewer than `min_match` of its bases are aligned or if it is
+split across chains. Unlike CrossMap, thickStart/thickEnd and the blocks of
+BED12 records are lifted over too.
+
+Over.chain files are netted, so their blocks do not overlap on the source
+assembly. If a chain file does have overlapping blocks, the blocks of the
+higher-scoring chain are kept.
+"""
+import os
+import bisect
+import gzip
+import json
+import threading
+import numpy as np
+from hubward import utils
+from hubward.log import log
+
+# Bump when the layout of the compiled .npz changes
+VERSION = 1
+
+# Per-chromosome arrays stored in the compiled .npz
+FIELDS = ['t_start', 't_end', 'q_start', 'q_chrom', 'reverse', 'chain',
+          'cum_len']
+
+_chains = {}
+_chains_lock = threading.Lock()
+
+
+def compiled_path(chainfile):
+    """
+    Where the compiled version of `chainfile` is stored.
+    """
+    return os.path.join(
+        utils.cache_dir(), os.path.basename(chainfile) + '.npz')
+
+
+def _key(chainfile):
+    st = os.stat(chainfile)
+    return [VERSION, os.path.abspath(chainfile), st.st_size, st.st_mtime]
+
+
+def _open(chainfile):
+    if chainfile.endswith('.gz'):
+        if str is bytes:
+            # Python 2
+            return gzip.open(chainfile)
+        return gzip.open(chainfile, 'rt')
+    return open(chainfile)
+
+
+def _open_file(f, mode):
+    """
+    Open `f` unless it's already a file-like object.
+    """
+    if hasattr(f, 'read') or hasattr(f, 'write'):
+        return f
+    return open(f, mode)
+
+
+def _parse(chainfile):
+    """
+    Returns a dict of {source chromosome: list of blocks}, where each block
+    is (t_start, t_end, q_start, q_name, q_size, reverse, chain_id, score),
+    and q_start is on the strand of the query.
+    """
+    blocks = {}
+    chain_id = -1
+    with _open(chainfile) as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[0] == 'chain':
+                chain_id += 1
+                score = float(fields[1])
+                t_name = fields[2]
+                q_name, q_size = fields[7], int(fields[8])
+                reverse = fields[9] == '-'
+                t, q = int(fields[5]), int(fields[10])
+                current = blocks.setdefault(t_name, [])
+                continue
+            size = int(fields[0])
+            current.append(
+                (t, t + size, q, q_name, q_size, reverse, chain_id, score))
+            if len(fields) == 3:
+                t += size + int(fields[1])
+                q += size + int(fields[2])
+    return blocks
+
+
+def _remove_overlaps(blocks):
+    """
+    Keep the blocks of higher-scoring chains where blocks overlap on the
+    source chromosome. `blocks` is sorted by start.
+    """
+    starts = np.array([b[0] for b in blocks], dtype=np.int64)
+    ends = np.array([b[1] for b in blocks], dtype=np.int64)
+    if len(blocks) < 2 or np.all(
+            starts[1:] >= np.maximum.accumulate(ends)[:-1]):
+        return blocks
+    kept_starts, kept_ends, kept = [], [], []
+    for block in sorted(blocks, key=lambda b: (-b[7], b[0])):
+        i = bisect.bisect_right(kept_starts, block[0])
+        if i > 0 and kept_ends[i - 1] > block[0]:
+            continue
+        if i < len(kept_starts) and kept_starts[i] < block[1]:
+            continue
+        kept_starts.insert(i, block[0])
+        kept_ends.insert(i, block[1])
+        kept.insert(i, block)
+    return kept
+
+
+def compile_chain(chainfile, dest=None):
+    """
+    Parse `chainfile` and save it as an .npz (by default, to
+    `compiled_path(chainfile)`). Returns the path to the .npz.
+    """
+    if dest is None:
+        dest = compiled_path(chainfile)
+    log("Compiling {0} to {1}".format(chainfile, dest))
+    parsed = _parse(chainfile)
+    q_names = []
+    q_sizes = []
+    q_index = {}
+    arrays = {}
+    for t_name, blocks in parsed.items():
+        blocks = _remove_overlaps(sorted(blocks))
+        for b in blocks:
+            if b[3] not in q_index:
+                q_index[b[3]] = len(q_names)
+                q_names.append(b[3])
+                q_sizes.append(b[4])
+        t_start = np.array([b[0] for b in blocks], dtype=np.int64)
+        t_end = np.array([b[1] for b in blocks], dtype=np.int64)
+        arrays[t_name + '/t_start'] = t_start
+        arrays[t_name + '/t_end'] = t_end
+        arrays[t_name + '/q_start'] = np.array(
+            [b[2] for b in blocks], dtype=np.int64)
+        arrays[t_name + '/q_chrom'] = np.array(
+            [q_index[b[3]] for b in blocks], dtype=np.int32)
+        arrays[t_name + '/reverse'] = np.array(
+            [b[5] for b in blocks], dtype=bool)
+        arrays[t_name + '/chain'] = np.array(
+            [b[6] for b in blocks], dtype=np.int64)
+        arrays[t_name + '/cum_len'] = np.cumsum(t_end - t_start)
+    meta = dict(key=_key(chainfile), chroms=sorted(parsed),
+                q_names=q_names, q_sizes=q_sizes)
+    arrays['meta'] = np.array(json.dumps(meta))
+
+    utils.makedirs(os.path.dirname(os.path.abspath(dest)))
+    tmp = dest + '.{0}.tmp.npz'.format(os.getpid())
+    np.savez(tmp, **arrays)
+    os.rename(tmp, dest)
+    return dest
+
+
+class Chain(object):
+    def __init__(self, chainfile, compiled=None):
+        """
+        A compiled chain file. Use `load` rather than creating these
+        directly.
+
+        Parameters
+        ----------
+        chainfile : str
+
+        compiled : str or None
+            Path to the compiled .npz. If it doesn't exist or is out of date
+            with respect to `chainfile`, it is (re)compiled.
+        """
+        self.chainfile = chainfile
+        self.compiled = compiled or compiled_path(chainfile)
+        self.npz = None
+        if os.path.exists(self.compiled):
+            self.npz = np.load(self.compiled)
+            self.meta = json.loads(str(self.npz['meta']))
+            if self.meta['key'] != _key(chainfile):
+                self.npz.close()
+                self.npz = None
+        if self.npz is None:
+            compile_chain(chainfile, self.compiled)
+            self.npz = np.load(self.compiled)
+            self.meta = json.loads(str(self.npz['meta']))
+        self.q_names = np.array(self.meta['q_names'], dtype=object)
+        self.q_sizes = np.array(self.meta['q_sizes'], dtype=np.int64)
+        self._chroms = set(self.meta['chroms'])
+        self._arrays = {}
+        self._lock = threading.Lock()
+
+    def close(self):
+        """
+        Close the compiled .npz. The chain can't be used afterwards.
+        """
+        self.npz.close()
+
+    def arrays(self, chrom):
+        """
+        Dict of the block arrays (see FIELDS) for source chromosome `chrom`,
+        or None if the chain file has nothing on it.
+        """
+        if chrom not in self._chroms:
+            return None
+        with self._lock:
+            if chrom not in self._arrays:
+                a = dict(
+                    (field, self.npz[chrom + '/' + field])
+                    for field in FIELDS)
+                # Running count of changes in chain from block to block;
+                # blocks i..j are all in one chain if this doesn't change
+                a['breaks'] = np.concatenate(
+                    [[0], np.cumsum(a['chain'][1:] != a['chain'][:-1])])
+                self._arrays[chrom] = a
+        return self._arrays[chrom]
+
+    def map_intervals(self, chrom, starts, ends, min_match=0.95):
+        """
+        Map intervals on source chromosome `chrom`.
+
+        Parameters
+        ----------
+        chrom : str
+
+        starts, ends : array-like
+            0-based, half-open coordinates.
+
+        min_match : float
+            Minimum fraction of each interval's bases that must be aligned.
+
+        Returns
+        -------
+        A dict of arrays, one item per interval: "mapped" (bool), "q_chrom"
+        (index into `q_names`), "start", "end", "reverse" (whether it
+        mapped to the opposite strand), "chain", "aligned" (number of
+        aligned bases), and "split" (whether it spans more than one chain).
+        Values other than "mapped", "aligned", and "split" are meaningless
+        for intervals that did not map.
+        """
+        s = np.asarray(starts, dtype=np.int64)
+        e = np.asarray(ends, dtype=np.int64)
+        a = self.arrays(chrom)
+        if a is None or len(a['t_start']) == 0:
+            zeros = np.zeros(len(s), dtype=np.int64)
+            return dict(mapped=np.zeros(len(s), dtype=bool), q_chrom=zeros,
+                        start=zeros, end=zeros, chain=zeros, aligned=zeros,
+                        reverse=np.zeros(len(s), dtype=bool),
+                        split=np.zeros(len(s), dtype=bool))
+        ts, te = a['t_start'], a['t_end']
+        n = len(ts)
+
+        # First block containing or following the start, and last block
+        # starting before the end
+        i = np.searchsorted(ts, s, side='right') - 1
+        in_block = (i >= 0) & (te[np.clip(i, 0, n - 1)] > s)
+        first = np.where(in_block, i, i + 1)
+        last = np.searchsorted(ts, e, side='left') - 1
+        fb = np.clip(first, 0, n - 1)
+        lb = np.clip(last, 0, n - 1)
+
+        overlaps = (e > s) & (first <= last) & (first < n) & (last >= 0)
+        split = overlaps & (a['breaks'][lb] != a['breaks'][fb])
+
+        cum = a['cum_len']
+        aligned = (
+            cum[lb] - cum[fb] + (te[fb] - ts[fb]) -
+            np.maximum(0, s - ts[fb]) - np.maximum(0, te[lb] - e))
+        aligned = np.where(overlaps, aligned, 0)
+        mapped = overlaps & ~split & (aligned >= min_match * (e - s))
+
+        # Query coordinates of the first and (exclusive) last aligned bases,
+        # on the query strand
+        q_first = a['q_start'][fb] + (np.maximum(s, ts[fb]) - ts[fb])
+        q_last = a['q_start'][lb] + (np.minimum(e, te[lb]) - ts[lb])
+        reverse = a['reverse'][fb]
+        q_chrom = a['q_chrom'][fb]
+        size = self.q_sizes[q_chrom]
+        return dict(
+            mapped=mapped,
+            q_chrom=q_chrom,
+            start=np.where(reverse, size - q_last, q_first),
+            end=np.where(reverse, size - q_first, q_last),
+            reverse=reverse,
+            chain=a['chain'][fb],
+            aligned=aligned,
+            split=split,
+        )
+
+    def split_intervals(self, chrom, starts, ends):
+        """
+        Map the aligned parts of intervals on source chromosome `chrom`,
+        splitting each interval at the gaps between aligned blocks (as
+        CrossMap does for bedGraph and bigWig). Unaligned parts are dropped.
+
+        Returns a dict of arrays, one item per piece: "index" (of the
+        interval the piece came from), "q_chrom" (index into `q_names`),
+        "start", and "end". Pieces are in the order of the input intervals,
+        and then of the source coordinates.
+        """
+        s = np.asarray(starts, dtype=np.int64)
+        e = np.asarray(ends, dtype=np.int64)
+        a = self.arrays(chrom)
+        if a is None or len(a['t_start']) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return dict(index=empty, q_chrom=empty.astype(np.int32),
+                        start=empty, end=empty)
+        ts, te = a['t_start'], a['t_end']
+
+        # Blocks first..last overlap each interval (if first <= last)
+        first = np.searchsorted(te, s, side='right')
+        last = np.searchsorted(ts, e, side='left') - 1
+        counts = np.maximum(last - first + 1, 0)
+        index = np.repeat(np.arange(len(s)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts)
+        b = first[index] + offsets
+
+        t0 = np.maximum(s[index], ts[b])
+        t1 = np.minimum(e[index], te[b])
+        q0 = a['q_start'][b] + (t0 - ts[b])
+        q1 = q0 + (t1 - t0)
+        reverse = a['reverse'][b]
+        q_chrom = a['q_chrom'][b]
+        size = self.q_sizes[q_chrom]
+        return dict(
+            index=index,
+            q_chrom=q_chrom,
+            start=np.where(reverse, size - q1, q0),
+            end=np.where(reverse, size - q0, q1),
+        )
+
+    def liftover_bed(self, infile, outfile, unmapped=None, min_match=0.95,
+                     batch_size=100000):
+        """
+        Lift over a BED file (BED3 through BED12, plus any extra columns).
+
+        Parameters
+        ----------
+        infile, outfile : str or file-like
+            Filenames, or open files (e.g., pipes) which are left open. Each
+            output record is passed to `outfile.write` separately.
+
+        unmapped : str, file-like, or None
+            If provided, records that could not be mapped are written here,
+            each preceded by a comment giving the reason as `liftOver` does.
+
+        min_match : float
+            Minimum fraction of each record's bases that must be aligned.
+
+        batch_size : int
+            Number of records to map at a time.
+
+        Output is in the same order as the input (so it is generally not
+        sorted). Returns a tuple of (number mapped, number unmapped).
+        """
+        n_mapped = n_unmapped = 0
+        fin = _open_file(infile, 'r')
+        fout = _open_file(outfile, 'w')
+        fout_unmapped = _open_file(unmapped, 'w') if unmapped else None
+        try:
+            batch = []
+            for line in fin:
+                if line.startswith(('#', 'track', 'browser')) or \
+                        not line.strip():
+                    continue
+                batch.append(line.rstrip('\n').split('\t'))
+                if len(batch) >= batch_size:
+                    m, u = self._liftover_batch(
+                        batch, fout, fout_unmapped, min_match)
+                    n_mapped += m
+                    n_unmapped += u
+                    batch = []
+            if batch:
+                m, u = self._liftover_batch(
+                    batch, fout, fout_unmapped, min_match)
+                n_mapped += m
+                n_unmapped += u
+        finally:
+            for f, fn in [(fin, infile), (fout, outfile),
+                          (fout_unmapped, unmapped)]:
+                if f is not None and f is not fn:
+                    f.close()
+        return n_mapped, n_unmapped
+
+    def _liftover_batch(self, rows, fout, fout_unmapped, min_match):
+        chroms = np.array([r[0] for r in rows], dtype=object)
+        out = [None] * len(rows)
+        reasons = ['Deleted in new'] * len(rows)
+        for chrom in set(chroms):
+            idx = np.nonzero(chroms == chrom)[0]
+            for i, fields in zip(idx, self._liftover_rows(
+                    chrom, [rows[j] for j in idx], min_match)):
+                if isinstance(fields, list):
+                    out[i] = fields
+                else:
+                    reasons[i] = fields
+
+        n_mapped = 0
+        for i, fields in enumerate(out):
+            if fields is not None:
+                fout.write('\t'.join(fields) + '\n')
+                n_mapped += 1
+            elif fout_unmapped is not None:
+                fout_unmapped.write(
+                    '#{0}\n{1}\n'.format(reasons[i], '\t'.join(rows[i])))
+        return n_mapped, len(rows) - n_mapped
+
+    def _liftover_rows(self, chrom, rows, min_match):
+        """
+        Lift over BED records (lists of fields) all on `chrom`. Returns
+        a list with, for each record, either the new list of fields or
+        a string describing why it could not be mapped.
+        """
+        starts = np.array([int(r[1]) for r in rows], dtype=np.int64)
+        ends = np.array([int(r[2]) for r in rows], dtype=np.int64)
+        m = self.map_intervals(chrom, starts, ends, min_match)
+        new_start = m['start'].copy()
+        new_end = m['end'].copy()
+        ok = m['mapped'].copy()
+
+        # thickStart/thickEnd (BED8+): lift over the thick region, keeping
+        # any of it that's aligned in the same chain as the record, or make
+        # it empty
+        has_thick = np.array([len(r) >= 8 for r in rows])
+        thick_start = new_start.copy()
+        thick_end = new_start.copy()
+        if has_thick.any():
+            ts = np.array([int(r[6]) if len(r) >= 8 else 0 for r in rows],
+                          dtype=np.int64)
+            te = np.array([int(r[7]) if len(r) >= 8 else 0 for r in rows],
+                          dtype=np.int64)
+            t = self.map_intervals(chrom, ts, te, min_match=0)
+            thick_ok = t['mapped'] & (t['chain'] == m['chain'])
+            thick_start = np.where(
+                thick_ok, np.clip(t['start'], new_start, new_end), new_start)
+            thick_end = np.where(
+                thick_ok, np.clip(t['end'], new_start, new_end), new_start)
+
+        # Blocks (BED12): every block must map within the record's chain
+        blocks = {}
+        bed12 = [j for j, r in enumerate(rows) if len(r) >= 12]
+        if bed12:
+            rec, b_start, b_end = [], [], []
+            for j in bed12:
+                sizes = [int(x) for x in rows[j][10].rstrip(',').split(',')]
+                offsets = [int(x) for x in rows[j][11].rstrip(',').split(',')]
+                for size, offset in zip(sizes, offsets):
+                    rec.append(j)
+                    b_start.append(starts[j] + offset)
+                    b_end.append(starts[j] + offset + size)
+            rec = np.array(rec)
+            b = self.map_intervals(chrom, b_start, b_end, min_match=0)
+            b_ok = b['mapped'] & (b['chain'] == m['chain'][rec])
+            for j in bed12:
+                sel = rec == j
+                if not b_ok[sel].all():
+                    ok[j] = False
+                    continue
+                bs, be = b['start'][sel], b['end'][sel]
+                order = np.argsort(bs)
+                bs, be = bs[order], be[order]
+                new_start[j], new_end[j] = bs[0], be[-1]
+                blocks[j] = (bs, be)
+            thick_start = np.clip(thick_start, new_start, new_end)
+            thick_end = np.clip(thick_end, new_start, new_end)
+
+        results = []
+        for j, fields in enumerate(rows):
+            if not ok[j]:
+                if m['aligned'][j] == 0:
+                    results.append('Deleted in new')
+                elif m['split'][j] or m['mapped'][j]:
+                    # Blocks of a BED12 record mapped to different chains
+                    results.append('Split in new')
+                else:
+                    results.append('Partially deleted in new')
+                continue
+            fields = list(fields)
+            fields[0] = self.q_names[m['q_chrom'][j]]
+            fields[1] = str(new_start[j])
+            fields[2] = str(new_end[j])
+            if len(fields) >= 6 and m['reverse'][j]:
+                fields[5] = {'+': '-', '-': '+'}.get(fields[5], fields[5])
+            if len(fields) >= 8:
+                fields[6] = str(thick_start[j])
+                fields[7] = str(thick_end[j])
+            if j in blocks:
+                bs, be = blocks[j]
+                fields[9] = str(len(bs))
+                fields[10] = ','.join(str(x) for x in be - bs) + ','
+                fields[11] = ','.join(
+                    str(x) for x in bs - new_start[j]) + ','
+            results.append(fields)
+        return results
+
+
+def _forget():
+    """
+    Forget the chains loaded so far, so that `load` opens them again. Used in
+    new worker processes, which must not read the .npz files through file
+    objects shared with their parent or wait on a lock that was held when
+    they were forked.
+    """
+    global _chains, _chains_lock
+    _chains = {}
+    _chains_lock = threading.Lock()
+
+
+def load(chainfile):
+    """
+    Returns the (memoized) `Chain` for `chainfile`, compiling it first if
+    needed.
+    """
+    key = tuple(_key(chainfile))
+    with _chains_lock:
+        if key not in _chains:
+            _chains[key] = Chain(chainfile)
+        return _chains[key]
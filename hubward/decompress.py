@@ -0,0 +1,241 @@
+"""
+Module for reading compressed files as a stream, using the fastest
+decompressor available.
+
+For each compression format, backends are tried in order of preference:
+external multithreaded programs first (`pigz`, `xz -T0`, `lbzip2`, ...),
+then Python's own modules. External programs write to a pipe that is read
+directly (e.g., by `tarfile` in streaming mode), so no decompressed copy of
+an archive is ever written to disk.
+"""
+import os
+import bz2
+import gzip
+import time
+import tempfile
+import subprocess
+
+try:
+    from shutil import which
+except ImportError:
+    # Python 2
+    from distutils.spawn import find_executable as which
+
+try:
+    import lzma
+except ImportError:
+    # Python 2
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# File suffixes (lowercase) and their compression formats. Longer suffixes
+# come first.
+SUFFIXES = [
+    ('.tar.gz', 'gzip'), ('.tgz', 'gzip'), ('.gz', 'gzip'),
+    ('.tar.xz', 'xz'), ('.txz', 'xz'), ('.xz', 'xz'),
+    ('.tar.bz2', 'bzip2'), ('.tbz2', 'bzip2'), ('.bz2', 'bzip2'),
+    ('.tar.zst', 'zstd'), ('.tzst', 'zstd'), ('.zst', 'zstd'),
+    ('.tar.z', 'compress'), ('.z', 'compress'),
+]
+
+# Size of each read when benchmarking
+CHUNK_SIZE = 1024 * 1024
+
+
+class _ProcessReader(object):
+    def __init__(self, cmds, filename):
+        """
+        File-like object reading the stdout of `cmds + [filename]`.
+
+        Raises an IOError on reaching the end of the output if the program
+        failed (e.g., a truncated or corrupt file).
+        """
+        self.cmds = cmds + [filename]
+        # stderr goes to a file rather than a pipe, which could fill up (and
+        # block the program) while we are still reading stdout
+        self.stderr = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(
+            self.cmds, stdout=subprocess.PIPE, stderr=self.stderr)
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        # read() without a size reads to the end of the output
+        if size < 0 or (not data and size != 0):
+            self._check()
+        return data
+
+    def _check(self):
+        if self.proc.wait() != 0:
+            self.stderr.seek(0)
+            err = self.stderr.read()
+            raise IOError(
+                "{0} failed: {1}".format(
+                    ' '.join(self.cmds),
+                    err.decode('utf-8', 'replace').strip()))
+
+    def close(self):
+        # Closing early (e.g., once tarfile has found the members it needs)
+        # stops the program with SIGPIPE, which is not an error.
+        self.proc.stdout.close()
+        self.proc.wait()
+        self.stderr.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _command(*cmds):
+    """
+    A backend that runs an external program.
+    """
+    def available():
+        return which(cmds[0]) is not None
+
+    def open_(filename):
+        return _ProcessReader(list(cmds), filename)
+    return available, open_
+
+
+def _module(module, opener):
+    """
+    A backend that uses a Python module, if it could be imported.
+    """
+    def available():
+        return module is not None
+
+    def open_(filename):
+        return opener(filename)
+    return available, open_
+
+
+def _zstandard_open(filename):
+    f = open(filename, 'rb')
+    return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+
+
+# For each format, backends in order of preference as (name, (available,
+# open)) pairs
+BACKENDS = {
+    'gzip': [
+        ('pigz', _command('pigz', '-dc')),
+        ('gzip', _module(gzip, lambda fn: gzip.open(fn, 'rb'))),
+    ],
+    'xz': [
+        ('xz', _command('xz', '-dc', '-T0')),
+        ('lzma', _module(lzma, lambda fn: lzma.open(fn, 'rb'))),
+    ],
+    'bzip2': [
+        ('lbzip2', _command('lbzip2', '-dc')),
+        ('pbzip2', _command('pbzip2', '-dc')),
+        ('bz2', _module(bz2, lambda fn: bz2.BZ2File(fn, 'rb'))),
+    ],
+    'zstd': [
+        ('zstd', _command('zstd', '-dcq')),
+        ('zstandard', _module(zstandard, _zstandard_open)),
+    ],
+    'compress': [
+        ('uncompress', _command('uncompress', '-c')),
+        ('gzip -d', _command('gzip', '-dc')),
+    ],
+}
+
+
+def compression(filename):
+    """
+    Returns the compression format of `filename` based on its extension (one
+    of the keys of BACKENDS), or None if it isn't compressed.
+    """
+    lower = filename.lower()
+    for suffix, format_ in SUFFIXES:
+        if lower.endswith(suffix):
+            return format_
+    return None
+
+
+def backends(filename):
+    """
+    Names of the backends available on this machine for decompressing
+    `filename`, fastest first.
+    """
+    format_ = compression(filename)
+    if format_ is None:
+        return []
+    return [name for name, (available, _) in BACKENDS[format_]
+            if available()]
+
+
+def open_stream(filename, backend=None):
+    """
+    Returns a file-like object for reading the decompressed contents of
+    `filename`, which is returned as-is if it isn't compressed.
+
+    Parameters
+    ----------
+    filename : str
+
+    backend : str or None
+        Name of the backend to use (see `backends`). If None, use the fastest
+        one available.
+
+    Use as a context manager or call `close()` when done.
+    """
+    format_ = compression(filename)
+    if format_ is None:
+        return open(filename, 'rb')
+    for name, (available, open_) in BACKENDS[format_]:
+        if backend not in (None, name):
+            continue
+        if available():
+            return open_(filename)
+    if backend is None:
+        raise ValueError(
+            "No decompressor available for {0} ({1} format). Install one of: "
+            "{2}".format(filename, format_,
+                         ', '.join(name for name, _ in BACKENDS[format_])))
+    raise ValueError(
+        "Decompression backend {0} is not available for {1}"
+        .format(backend, filename))
+
+
+def benchmark(filename):
+    """
+    Decompress `filename` with each available backend, discarding the
+    output.
+
+    Returns a list of dicts, one per backend, with keys "backend", "seconds",
+    "size" (decompressed bytes), and "mb_per_s" (decompressed MB per second).
+    """
+    results = []
+    for name in backends(filename):
+        t0 = time.time()
+        size = 0
+        with open_stream(filename, backend=name) as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+        seconds = time.time() - t0
+        results.append(dict(
+            backend=name, seconds=seconds, size=size,
+            mb_per_s=size / 1e6 / max(seconds, 1e-6)))
+    return results
+
+
+def format_benchmark(filename, results):
+    """
+    Format the output of `benchmark` as text.
+    """
+    lines = ['{0} ({1:.1f} MB compressed)'.format(
+        filename, os.stat(filename).st_size / 1e6)]
+    for r in sorted(results, key=lambda r: r['seconds']):
+        lines.append('    {backend:<12} {seconds:8.2f} s  {mb_per_s:8.1f} MB/s'
+                     .format(**r))
+    return '\n'.join(lines)
@@ -0,0 +1,726 @@
+"""
+Module for downloading many files concurrently.
+
+A single `DownloadManager` multiplexes all transfers over one
+`pycurl.CurlMulti` handle in a background thread. Connections are kept open
+and reused for later files from the same host.
+
+Every download (including those made by `hubward.utils.download`) is written
+to `<dest>.part` and only renamed to `<dest>` once complete, so an interrupted
+download is resumed from where it stopped using an HTTP Range request. The
+ETag, Last-Modified, and Content-Length of each completed download are stored
+in `<dest>.source.json`, so that a source can later be refreshed with
+a conditional request that only transfers anything if it changed upstream.
+
+Tar archives can instead be extracted while they download (see
+`StreamingUnpack`), without writing the archive to disk first.
+"""
+import os
+import json
+import time
+import tarfile
+import zipfile
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import pycurl
+from colorama import Fore
+from hubward import utils
+from hubward import archive as hubward_archive
+from hubward.log import log
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    # Python 2
+    from urlparse import urlparse
+
+
+def sidecar(dest):
+    """
+    Path to the file recording where `dest` was downloaded from.
+    """
+    return dest + '.source.json'
+
+
+def source_info(dest):
+    """
+    Returns a dict of the url, etag, last_modified, and content_length that
+    `dest` was downloaded with, or an empty dict if unknown.
+    """
+    try:
+        with open(sidecar(dest)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_source_info(dest, info):
+    with open(sidecar(dest), 'w') as f:
+        json.dump(info, f, indent=2, sort_keys=True)
+
+
+def _remove(filename):
+    if os.path.exists(filename):
+        os.unlink(filename)
+
+
+class Transfer(object):
+    def __init__(self, url, dest, refresh=False):
+        """
+        Downloads `url` to `dest` via `<dest>.part`.
+
+        Parameters
+        ----------
+        url, dest : str
+
+        refresh : bool
+            If True and `dest` already exists, send a conditional request
+            using the ETag/Last-Modified recorded when it was downloaded, and
+            leave `dest` untouched if the server reports it has not changed.
+
+        After a transfer, `changed` is True if `dest` was (re)written.
+        """
+        self.url = url
+        self.dest = dest
+        self.part = dest + '.part'
+        self.refresh = refresh
+        self.changed = False
+        self.restart = False
+
+    def setup(self, c):
+        """
+        Configure the pycurl handle `c` for this transfer.
+        """
+        utils.makedirs(os.path.dirname(os.path.abspath(self.dest)))
+        self.status = None
+        self.headers = {}
+        self.fileobj = None
+        self.restart = False
+        self.offset = 0
+        if os.path.exists(self.part):
+            self.offset = os.path.getsize(self.part)
+
+        c.setopt(pycurl.URL, self.url)
+        c.setopt(pycurl.FOLLOWLOCATION, 1)
+        c.setopt(pycurl.WRITEFUNCTION, self._write)
+        c.setopt(pycurl.HEADERFUNCTION, self._header)
+
+        headers = []
+        if self.offset:
+            log("Resuming {0} from byte {1}".format(self.url, self.offset),
+                indent=4)
+            c.setopt(pycurl.RESUME_FROM_LARGE, self.offset)
+
+            # If the source changed since the partial download started, ask
+            # for all of it instead of the rest of it
+            partial = source_info(self.part)
+            validator = partial.get('etag') or partial.get('last_modified')
+            if validator:
+                headers.append('If-Range: ' + validator)
+        if self.refresh and os.path.exists(self.dest):
+            info = source_info(self.dest)
+            if info.get('etag'):
+                headers.append('If-None-Match: ' + info['etag'])
+            if info.get('last_modified'):
+                headers.append('If-Modified-Since: ' + info['last_modified'])
+        if headers:
+            c.setopt(pycurl.HTTPHEADER, headers)
+
+    def _header(self, line):
+        line = line.decode('iso-8859-1').strip()
+        if line.startswith('HTTP/'):
+            # Each response (e.g., after a redirect) starts with a status
+            # line and has its own headers
+            self.status = int(line.split()[1])
+            self.headers = {}
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            self.headers[name.strip().lower()] = value.strip()
+
+    def _info(self):
+        return dict(
+            url=self.url,
+            etag=self.headers.get('etag'),
+            last_modified=self.headers.get('last-modified'),
+            content_length=self._expected_size(),
+        )
+
+    def _expected_size(self):
+        """
+        Full size of the file according to the response headers, or None if
+        they don't say.
+        """
+        content_range = self.headers.get('content-range', '')
+        if self.status == 206 and '/' in content_range:
+            total = content_range.rsplit('/', 1)[1]
+            return int(total) if total.isdigit() else None
+        length = self.headers.get('content-length')
+        if length is None or not length.isdigit():
+            return None
+        return self.offset + int(length)
+
+    def _write(self, data):
+        if self.fileobj is None:
+            if self.status is not None and self.status >= 300:
+                # Body of an error page or a 304 Not Modified
+                return
+            self.fileobj = open(self.part, 'ab' if self.offset else 'wb')
+            if not self.offset:
+                write_source_info(self.part, self._info())
+        self.fileobj.write(data)
+
+    def finish(self, c, error=None):
+        """
+        Called once pycurl has finished with this transfer (successfully if
+        `error` is None). Moves the completed file into place and records its
+        source info.
+
+        Returns an error message, or None on success. On failure the partial
+        file is kept so that the next attempt can resume it. If `restart` is
+        True afterwards, the transfer should be attempted again from scratch.
+        """
+        if self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
+        code = c.getinfo(pycurl.RESPONSE_CODE)
+        if self.offset and code == 200:
+            # The server doesn't support ranges, or (given If-Range) the
+            # source changed since the partial download started. pycurl
+            # aborts the transfer in this case.
+            log("Cannot resume {0}; starting over".format(self.url),
+                indent=4)
+            _remove(self.part)
+            _remove(sidecar(self.part))
+            self.restart = True
+            return error or 'cannot resume'
+        if error:
+            return error
+        if code == 304:
+            log("{0} is unchanged".format(self.url), indent=4)
+            _remove(self.part)
+            _remove(sidecar(self.part))
+            return None
+        if code == 416 and self.offset:
+            # Whatever the partial file is, it's not the start of the current
+            # source
+            _remove(self.part)
+            _remove(sidecar(self.part))
+            self.restart = True
+            return 'HTTP 416'
+        if code >= 400:
+            return 'HTTP {0}'.format(code)
+        if not os.path.exists(self.part):
+            # Empty file
+            open(self.part, 'wb').close()
+
+        size = os.path.getsize(self.part)
+        expected = self._expected_size()
+        if expected is not None and size != expected:
+            return "incomplete download ({0} of {1} bytes)".format(
+                size, expected)
+        info = self._info()
+        info['content_length'] = size
+        os.rename(self.part, self.dest)
+        write_source_info(self.dest, info)
+        _remove(sidecar(self.part))
+        self.changed = True
+        return None
+
+    def perform(self):
+        """
+        Run the transfer in the calling thread, raising a ValueError if it
+        fails. Returns True if `dest` was (re)written.
+        """
+        while True:
+            c = pycurl.Curl()
+            try:
+                self.setup(c)
+                try:
+                    c.perform()
+                    error = None
+                except pycurl.error as e:
+                    error = e.args[-1]
+                error = self.finish(c, error)
+            finally:
+                c.close()
+            if not self.restart:
+                break
+        if error:
+            raise ValueError(
+                "Error downloading {0} to {1}: {2}"
+                .format(self.url, self.dest, error))
+        return self.changed
+
+
+# Archives that can be extracted while they download
+STREAMABLE = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz')
+
+# Size of each read when extracting streamed archive members
+CHUNK_SIZE = 1024 * 1024
+
+
+class _StreamingTransfer(Transfer):
+    def __init__(self, url, dest, fd):
+        """
+        A `Transfer` that also writes everything it receives to file
+        descriptor `fd`. If `dest` is None, nothing is written to disk.
+        """
+        Transfer.__init__(self, url, dest or '')
+        self.dest = dest
+        self.fd = fd
+
+    def setup(self, c):
+        if self.dest is not None:
+            # The reader needs the whole stream, so this can't resume
+            _remove(self.part)
+            return Transfer.setup(self, c)
+        self.status = None
+        self.headers = {}
+        c.setopt(pycurl.URL, self.url)
+        c.setopt(pycurl.FOLLOWLOCATION, 1)
+        c.setopt(pycurl.WRITEFUNCTION, self._write)
+        c.setopt(pycurl.HEADERFUNCTION, self._header)
+
+    def _write(self, data):
+        if self.status is not None and self.status >= 300:
+            return
+        view = data
+        try:
+            while view:
+                view = view[os.write(self.fd, view):]
+        except OSError:
+            # The reader has stopped (e.g., a corrupt archive); returning
+            # a different length than received makes pycurl abort.
+            return 0
+        if self.dest is not None:
+            Transfer._write(self, data)
+
+    def finish(self, c, error=None):
+        if self.dest is not None:
+            return Transfer.finish(self, c, error)
+        if error:
+            return error
+        code = c.getinfo(pycurl.RESPONSE_CODE)
+        if code >= 400:
+            return 'HTTP {0}'.format(code)
+
+
+class StreamingUnpack(object):
+    def __init__(self, url, dest, archive=None):
+        """
+        Downloads a (possibly compressed) tar archive and extracts it into
+        directory `dest` as it arrives, rather than writing the whole archive
+        to disk first and extracting it afterwards.
+
+        Extraction runs in a background thread. Use `wait_for` to block until
+        a particular file is available.
+
+        Parameters
+        ----------
+        url : str
+
+        dest : str
+            Directory to extract into.
+
+        archive : str or None
+            If provided, also save a copy of the archive here.
+
+        Each file is written to a temporary file and renamed once complete,
+        so a file that exists has been fully extracted (see
+        `hubward.archive`).
+        """
+        self.url = url
+        self.dest = dest
+        self.archive = archive
+        self.extracted = set()
+        self.error = None
+        self._finished = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def done(self):
+        return self._finished
+
+    def _run(self):
+        try:
+            error = self._stream()
+        except Exception as e:
+            error = str(e)
+        if error:
+            log("Failed to stream {0}: {1}".format(self.url, error),
+                style=Fore.RED)
+        else:
+            log("Streamed and extracted {0}".format(self.url), indent=4)
+        with self._cond:
+            self.error = error
+            self._finished = True
+            self._cond.notify_all()
+
+    def _stream(self):
+        """
+        Download and extract, returning an error message or None.
+        """
+        r, w = os.pipe()
+        transfer = _StreamingTransfer(self.url, self.archive, w)
+        result = {}
+
+        def download():
+            c = None
+            try:
+                c = pycurl.Curl()
+                transfer.setup(c)
+                try:
+                    c.perform()
+                    error = None
+                except pycurl.error as e:
+                    error = e.args[-1]
+                result['error'] = transfer.finish(c, error)
+            except Exception as e:
+                result['error'] = str(e)
+            finally:
+                if c is not None:
+                    c.close()
+                os.close(w)
+
+        t = threading.Thread(target=download)
+        t.daemon = True
+        t.start()
+        error = None
+        try:
+            with os.fdopen(r, 'rb') as f:
+                self._extract(f)
+                # Consume any padding after the end of the archive
+                while f.read(CHUNK_SIZE):
+                    pass
+        except (tarfile.TarError, ValueError, IOError, OSError, EOFError) as e:
+            error = str(e) or e.__class__.__name__
+        while t.is_alive():
+            t.join(1)
+
+        # A failed download also truncates the archive; report the cause
+        return result.get('error') or error
+
+    def _extract(self, f):
+        tar = tarfile.open(fileobj=f, mode='r|*')
+        for member in tar:
+            path = hubward_archive.extract_tar_member(tar, member, self.dest)
+            with self._cond:
+                self.extracted.add(path)
+                self._cond.notify_all()
+        tar.close()
+
+    def wait_for(self, path):
+        """
+        Block until `path` has been extracted or the download has finished.
+        Raises a ValueError if it failed before `path` was extracted.
+        """
+        path = os.path.abspath(path)
+        with self._cond:
+            while path not in self.extracted and not self._finished:
+                # Timeout lets KeyboardInterrupt through on Python 2
+                self._cond.wait(1)
+            if path not in self.extracted and self.error:
+                raise ValueError(
+                    "Error streaming {0}: {1}".format(self.url, self.error))
+
+    def wait(self):
+        """
+        Block until the whole archive has been extracted, raising
+        a ValueError if it failed.
+        """
+        with self._cond:
+            while not self._finished:
+                self._cond.wait(1)
+        if self.error:
+            raise ValueError(
+                "Error streaming {0}: {1}".format(self.url, self.error))
+
+
+class Download(object):
+    def __init__(self, url, dest, refresh=False):
+        """
+        A single file submitted to a `DownloadManager`.
+        """
+        self.url = url
+        self.dest = dest
+        self.host = urlparse(url).netloc
+        self.transfer = Transfer(url, dest, refresh=refresh)
+        self.error = None
+        self.bytes = 0
+        self._done = threading.Event()
+
+    @property
+    def changed(self):
+        """
+        True if the file was (re)written; False if the server reported that
+        an existing file was unchanged.
+        """
+        return self.transfer.changed
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self):
+        """
+        Block until the download has finished, raising a ValueError if it
+        failed.
+        """
+        # Waiting with a timeout lets KeyboardInterrupt through on Python 2
+        while not self._done.is_set():
+            self._done.wait(1)
+        if self.error:
+            raise ValueError(
+                "Error downloading {0} to {1}: {2}"
+                .format(self.url, self.dest, self.error))
+
+
+class DownloadManager(object):
+    def __init__(self, max_connections=8, max_per_host=4,
+                 report_interval=30):
+        """
+        Downloads files concurrently in a background thread.
+
+        Parameters
+        ----------
+        max_connections : int
+            Maximum number of files to download at once.
+
+        max_per_host : int
+            Maximum number of files to download at once from any single host.
+
+        report_interval : float
+            Log progress and throughput every this many seconds while
+            downloads are active.
+        """
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.report_interval = report_interval
+        self.multi = pycurl.CurlMulti()
+        self._handles = []
+        self._queue = deque()
+        self._active = {}
+        self._submitted = {}
+        self._lock = threading.Condition()
+        self._closed = False
+        self._finished = 0
+        self._bytes = 0
+        self._start_time = None
+        self._last_report = 0
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, url, dest, refresh=False):
+        """
+        Queue `url` to be downloaded to `dest` and return a `Download` that can
+        be waited on. Submitting the same `dest` again returns the existing
+        `Download`, unless it has finished and `refresh` is True.
+
+        See `Transfer` for `refresh`.
+        """
+        with self._lock:
+            if self._closed:
+                raise ValueError("DownloadManager has been closed")
+            existing = self._submitted.get(dest)
+            if existing is not None and not (refresh and existing.done()):
+                return existing
+            d = Download(url, dest, refresh=refresh)
+            self._submitted[dest] = d
+            self._queue.append(d)
+            if self._start_time is None:
+                self._start_time = time.time()
+            self._lock.notify()
+        return d
+
+    def fetch(self, url, dest):
+        """
+        Download `url` to `dest`, blocking until it's done. Other downloads
+        continue in the background in the meantime.
+        """
+        self.submit(url, dest).wait()
+
+    def close(self):
+        """
+        Finish all submitted downloads and stop the background thread.
+        """
+        with self._lock:
+            self._closed = True
+            self._lock.notify()
+        while self._thread.is_alive():
+            self._thread.join(1)
+
+    def _start_queued(self):
+        """
+        Start as many queued downloads as the connection limits allow.
+        """
+        per_host = {}
+        for d in self._active.values():
+            per_host[d.host] = per_host.get(d.host, 0) + 1
+        for d in list(self._queue):
+            if len(self._active) >= self.max_connections:
+                break
+            if per_host.get(d.host, 0) >= self.max_per_host:
+                continue
+            self._queue.remove(d)
+            per_host[d.host] = per_host.get(d.host, 0) + 1
+            # Easy handles are reused so their connections can be too
+            c = self._handles.pop() if self._handles else pycurl.Curl()
+            try:
+                d.transfer.setup(c)
+            except (IOError, OSError) as e:
+                c.reset()
+                self._handles.append(c)
+                self._finish(d, str(e))
+                continue
+            self._active[c] = d
+            self.multi.add_handle(c)
+
+    def _finish(self, d, error):
+        d.error = error
+        if not error:
+            if d.changed:
+                log("Downloaded {0}".format(d.url), indent=4)
+        else:
+            log("Failed to download {0}: {1}".format(d.url, error),
+                style=Fore.RED)
+        self._finished += 1
+        self._bytes += d.bytes
+        d._done.set()
+
+    def _complete(self, c, error):
+        d = self._active.pop(c)
+        self.multi.remove_handle(c)
+        d.bytes += int(c.getinfo(pycurl.SIZE_DOWNLOAD))
+        error = d.transfer.finish(c, error)
+        c.reset()
+        self._handles.append(c)
+        if d.transfer.restart:
+            self._queue.appendleft(d)
+            return
+        self._finish(d, error)
+
+    def _report(self, force=False):
+        now = time.time()
+        if not force and now - self._last_report < self.report_interval:
+            return
+        self._last_report = now
+        nbytes = self._bytes + sum(
+            int(c.getinfo(pycurl.SIZE_DOWNLOAD)) for c in self._active)
+        elapsed = max(now - self._start_time, 1e-6)
+        log("Downloads: {0} done, {1} active, {2} queued; {3:.1f} MB at "
+            "{4:.2f} MB/s".format(
+                self._finished, len(self._active), len(self._queue),
+                nbytes / 1e6, nbytes / 1e6 / elapsed))
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                self._start_queued()
+                if not self._active:
+                    if self._closed and not self._queue:
+                        break
+                    # Nothing in flight; wait for more submissions
+                    self._lock.wait(1)
+                    continue
+
+            while True:
+                ret, _ = self.multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            with self._lock:
+                while True:
+                    queued, ok, errors = self.multi.info_read()
+                    for c in ok:
+                        self._complete(c, None)
+                    for c, errno, errmsg in errors:
+                        self._complete(c, errmsg)
+                    if not queued:
+                        break
+                self._report(force=not self._active and not self._queue)
+            self.multi.select(0.5)
+
+
+def prefetch(studies, manager, refresh=False, cache=None):
+    """
+    Download (and unpack) the source files of all tracks in `studies` whose
+    original files do not exist yet, using `manager` to download them
+    concurrently. Each source is unpacked as soon as it has downloaded.
+
+    If `refresh` is True, the sources of all tracks are checked with
+    conditional requests, and any that changed upstream are downloaded and
+    unpacked again (which in turn makes their tracks out of date).
+
+    If `cache` (a `hubward.cache.DownloadCache`) is provided, sources are
+    downloaded into it and linked into each study.
+
+    Raises a ValueError listing any downloads that failed.
+    """
+    tracks = []
+    for study in studies:
+        for d in study.tracks:
+            if d._was_lifted_over():
+                continue
+            if refresh or d._needs_download():
+                tracks.append(d)
+    if refresh:
+        log("Checking sources of {0} tracks".format(len(tracks)),
+            style=Fore.BLUE)
+    else:
+        log("{0} tracks need downloading".format(len(tracks)),
+            style=Fore.BLUE)
+
+    pending = {}
+    for d in tracks:
+        pending.setdefault(d.source_fn, []).append(d)
+
+    def fetch(source_fn):
+        tracks = pending[source_fn]
+        url = tracks[0].source_url
+        try:
+            if tracks[0].stream and not os.path.exists(source_fn):
+                # Extracted while downloading; nothing to refresh against
+                # unless the archive was kept
+                for d in tracks:
+                    d._download()
+                return []
+            if cache is not None:
+                changed = cache.fetch(
+                    url, source_fn, refresh=refresh, downloader=manager)
+            else:
+                download = manager.submit(url, source_fn, refresh=refresh)
+                download.wait()
+                changed = download.changed
+            if changed or any(d._needs_download() for d in tracks):
+                members = [d._archive_members() for d in tracks]
+                if None in members:
+                    members = None
+                else:
+                    members = sorted(set(sum(members, [])))
+                utils.unpack(
+                    source_fn, os.path.dirname(source_fn), members=members)
+        except (tarfile.TarError, zipfile.BadZipfile, ValueError, IOError,
+                OSError, EOFError) as e:
+            # e.g., a truncated archive; reported along with the others
+            return ["Error unpacking {0}: {1}".format(
+                source_fn, str(e) or e.__class__.__name__)]
+        return [
+            "Downloading and unpacking '{0.source_url}' did not result in "
+            "'{0.original}'".format(d)
+            for d in tracks if d._needs_download()]
+
+    # One thread per source waits for its download (the transfers themselves
+    # all happen in the manager's thread) and then unpacks it.
+    errors = []
+    if pending:
+        pool = ThreadPool(min(len(pending), manager.max_connections))
+        try:
+            for errs in pool.imap_unordered(fetch, list(pending)):
+                errors.extend(errs)
+        finally:
+            pool.close()
+            pool.join()
+    if errors:
+        raise ValueError('\n'.join(errors))
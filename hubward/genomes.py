@@ -0,0 +1,159 @@
+"""
+Module for looking up the chromosome sizes of assemblies.
+
+UCSC tools (bedToBigBed, bedGraphToBigWig) need a chrom.sizes file, and
+Python code (e.g., `hubward.utils.fix_macs_wig`) needs the sizes themselves.
+For each assembly, the first of these that exists is used:
+
+1. a file passed to `register`
+
+2. `<assembly>.chrom.sizes` in one of the directories listed in the
+   HUBWARD_CHROMSIZES environment variable (separated by ":")
+
+3. `<HUBWARD_CACHE_DIR>/chromsizes/<assembly>.chrom.sizes`, saved by an
+   earlier run
+
+4. a fresh download from UCSC, saved to the cache as above
+
+5. the sizes bundled with pybedtools (`pybedtools.genome_registry`), if the
+   download failed (e.g., when offline)
+
+Results are remembered for the rest of the process, so each assembly is
+looked up only once no matter how many files are converted.
+"""
+import os
+import threading
+from hubward import utils
+from hubward.log import log
+
+URL = "http://hgdownload.cse.ucsc.edu/goldenPath/{0}/bigZips/{0}.chrom.sizes"
+
+_registered = {}
+_files = {}
+_sizes = {}
+_lock = threading.Lock()
+_assembly_locks = {}
+
+
+def register(assembly, filename):
+    """
+    Use `filename` as the chrom.sizes file for `assembly`.
+    """
+    with _lock:
+        _registered[assembly] = os.path.abspath(filename)
+        _files.pop(assembly, None)
+        _sizes.pop(assembly, None)
+
+
+def _assembly_lock(assembly):
+    with _lock:
+        return _assembly_locks.setdefault(assembly, threading.Lock())
+
+
+def _user_file(assembly):
+    if assembly in _registered:
+        return _registered[assembly]
+    for dirname in os.environ.get('HUBWARD_CHROMSIZES', '').split(':'):
+        if not dirname:
+            continue
+        fn = os.path.join(dirname, assembly + '.chrom.sizes')
+        if os.path.exists(fn):
+            return fn
+    return None
+
+
+def _write(sizes, filename):
+    """
+    Write a dict of {chrom: size} as a chrom.sizes file.
+    """
+    tmp = filename + '.{0}.tmp'.format(os.getpid())
+    with open(tmp, 'w') as fout:
+        for chrom, size in sizes.items():
+            fout.write('{0}\t{1}\n'.format(chrom, size))
+    os.rename(tmp, filename)
+
+
+def _bundled(assembly):
+    """
+    Sizes bundled with pybedtools, or None if it doesn't know `assembly`.
+    """
+    from pybedtools import genome_registry
+    registry = getattr(genome_registry, assembly, None)
+    if registry is None:
+        return None
+    return dict((chrom, v[1]) for chrom, v in registry.items())
+
+
+def _cached_file(assembly):
+    """
+    Path to the chrom.sizes file for `assembly` in the cache, downloading it
+    there if needed, or to the bundled sizes if that fails.
+    """
+    cache = os.path.join(utils.cache_dir(), 'chromsizes')
+    fn = os.path.join(cache, assembly + '.chrom.sizes')
+    if os.path.exists(fn):
+        return fn
+    utils.makedirs(cache)
+    try:
+        # Downloads go to a .part file that is renamed once complete
+        log('Downloading chromosome sizes for {0}'.format(assembly))
+        utils.download(URL.format(assembly), fn)
+        return fn
+    except Exception as e:
+        sizes = _bundled(assembly)
+        if sizes is None:
+            raise ValueError(
+                "Could not download chromosome sizes for {0} ({1}), and "
+                "none are bundled with pybedtools. Provide a chrom.sizes "
+                "file with hubward.genomes.register or $HUBWARD_CHROMSIZES"
+                .format(assembly, e))
+
+    # Kept separately, so that the next run tries UCSC again
+    log('Using chromosome sizes for {0} bundled with pybedtools'
+        .format(assembly))
+    fn = os.path.join(cache, 'bundled', assembly + '.chrom.sizes')
+    utils.makedirs(os.path.dirname(fn))
+    _write(sizes, fn)
+    return fn
+
+
+def chromsizes_file(assembly):
+    """
+    Path to the chrom.sizes file for `assembly`, downloading it if needed
+    (see the module docstring for where it comes from).
+    """
+    with _lock:
+        if assembly in _files:
+            return _files[assembly]
+    with _assembly_lock(assembly):
+        with _lock:
+            if assembly in _files:
+                return _files[assembly]
+        fn = _user_file(assembly)
+        if fn is None:
+            fn = _cached_file(assembly)
+        elif not os.path.exists(fn):
+            raise ValueError(
+                "Chromosome sizes file {0} for {1} does not exist"
+                .format(fn, assembly))
+        with _lock:
+            _files[assembly] = fn
+    return fn
+
+
+def chromsizes(assembly):
+    """
+    Returns a dict of {chromosome: size} for `assembly`.
+    """
+    with _lock:
+        if assembly in _sizes:
+            return _sizes[assembly]
+    sizes = {}
+    with open(chromsizes_file(assembly)) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2:
+                sizes[fields[0]] = int(fields[1])
+    with _lock:
+        _sizes[assembly] = sizes
+    return sizes
@@ -3,11 +3,17 @@ Module for converting genomic coordinates from one version of an assembly to
 another
 """
 import utils
+import chain
 import subprocess
 import os
 import shutil
-import pybedtools
+import time
+import tempfile
+import threading
+import multiprocessing
+import numpy as np
 from hubward.log import log
+from hubward.decompress import which
 
 
 def download_chainfile(source_assembly, target_assembly):
@@ -17,8 +23,7 @@ def download_chainfile(source_assembly, target_assembly):
     If the environmental variable HUBWARD_CACHE_DIR does not exist, then use
     ~/.hubward_cache
     """
-    cache_dir = os.environ.get(
-        'HUBWARD_CACHE_DIR', os.path.expanduser('~/.hubward_cache'))
+    cache_dir = utils.cache_dir()
     utils.makedirs(cache_dir)
     url = chainfile_url(source_assembly, target_assembly)
     dest = os.path.join(cache_dir, os.path.basename(url))
@@ -34,43 +39,129 @@ def chainfile_url(source_assembly, target_assembly):
                 source_assembly, target_assembly.title()))
 
 
-def _liftover_bam(source_assembly, target_assembly, infile, outfile):
+def _disk_usage(path):
+    """
+    Total size, in bytes, of the files under `path`.
+    """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for fn in files:
+            try:
+                total += os.stat(os.path.join(root, fn)).st_size
+            except OSError:
+                # removed in the meantime
+                pass
+    return total
+
+
+def _liftover_bam(source_assembly, target_assembly, infile, outfile,
+                  threads=1, memory=None, scratch=None):
+    """
+    CrossMap's output is piped straight into `samtools sort`, which writes
+    the index as it writes the sorted BAM (this needs samtools >= 1.10).
+
+    Parameters
+    ----------
+    threads : int
+        Number of threads for `samtools sort`.
+
+    memory : int or None
+        Memory in MB for `samtools sort`, split between its threads. Fewer
+        threads are used if each would get less than 100 MB, so the total
+        never exceeds `memory`. If None, use samtools' default.
+
+    scratch : str or None
+        Directory for the temporary files of `samtools sort`. Defaults to
+        $HUBWARD_SCRATCH_DIR if set, otherwise the system temp dir.
+
+    Logs how long each stage took and the peak disk space used in `scratch`.
+    """
     chainfile = download_chainfile(source_assembly, target_assembly)
+    if scratch is None:
+        scratch = os.environ.get('HUBWARD_SCRATCH_DIR')
+    tmpdir = tempfile.mkdtemp(prefix='hubward-sort.', dir=scratch)
 
     # In the test environment, CrossMap.py causes segfault if output is not
     # STDOUT
-    with open(outfile + '.tmp.bam', 'w') as fout:
-        cmds = [
-            'CrossMap.py',
-            'bam',
-            chainfile,
-            infile,
-            'STDOUT']
-
-        p = subprocess.check_call(cmds, stdout=fout)
-
-    with open(outfile, 'w') as fout:
-        cmds = [
-            'samtools',
-            'sort',
-            '-T', outfile + '.sorting',
-            outfile + '.tmp.bam',
-        ]
-        print(cmds)
-        p = subprocess.check_call(cmds, stdout=fout)
-
-    cmds = [
+    crossmap_cmds = [
+        'CrossMap.py',
+        'bam',
+        chainfile,
+        infile,
+        'STDOUT']
+    if memory:
+        threads = max(min(threads, memory // 100), 1)
+    sort_cmds = [
         'samtools',
-        'index',
-        outfile]
-    print(cmds)
-    p = subprocess.check_call(cmds)
+        'sort',
+        '-@', str(threads),
+        '-T', os.path.join(tmpdir, 'sorting'),
+        '--write-index',
+        '-o', outfile + '##idx##' + outfile + '.bai',
+    ]
+    if memory:
+        sort_cmds += ['-m', '{0}M'.format(memory // threads)]
+    sort_cmds.append('-')
+
+    # Sample scratch use while sorting
+    peak = [0]
+    finished = threading.Event()
+
+    def watch():
+        while not finished.wait(0.2):
+            peak[0] = max(peak[0], _disk_usage(tmpdir))
+    watcher = threading.Thread(target=watch)
+    watcher.daemon = True
+    watcher.start()
+
+    t0 = time.time()
+    try:
+        crossmap = subprocess.Popen(crossmap_cmds, stdout=subprocess.PIPE)
+        sort = subprocess.Popen(sort_cmds, stdin=crossmap.stdout)
+        # Only samtools should hold the pipe, so that CrossMap gets SIGPIPE
+        # if samtools dies
+        crossmap.stdout.close()
+        crossmap.wait()
+        t_crossmap = time.time() - t0
+        sort.wait()
+        t_sort = time.time() - t0
+        # samtools first, so that its failure is reported rather than the
+        # SIGPIPE it causes in CrossMap
+        for proc, cmds in [(sort, sort_cmds), (crossmap, crossmap_cmds)]:
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmds)
+    except BaseException:
+        for fn in [outfile, outfile + '.bai']:
+            if os.path.exists(fn):
+                os.unlink(fn)
+        raise
+    finally:
+        finished.set()
+        watcher.join()
+        shutil.rmtree(tmpdir)
 
+    log('Lifted over {0} in {1:.1f}s: CrossMap finished after {2:.1f}s '
+        '(samtools sort reading its output meanwhile), and samtools sort '
+        '{3:.1f}s later; peak scratch use {4:.1f} MB in {5}'
+        .format(infile, t_sort, t_crossmap, t_sort - t_crossmap,
+                peak[0] / 1e6, os.path.dirname(tmpdir)))
     return outfile
 
 
-def _liftover_bigwig(source_assembly, target_assembly, infile, outfile):
+def _liftover_bigwig(source_assembly, target_assembly, infile, outfile,
+                     jobs=1):
+    """
+    Parameters
+    ----------
+    jobs : int
+        If 1, lift over the whole file with one CrossMap process. Otherwise,
+        lift over each chromosome separately using this many processes (see
+        `_scatter_bigwig`).
+    """
     chainfile = download_chainfile(source_assembly, target_assembly)
+    if jobs > 1:
+        return _scatter_bigwig(
+            chainfile, target_assembly, infile, outfile, jobs)
     cmds = [
         'CrossMap.py',
         'bigwig',
@@ -82,46 +173,304 @@ def _liftover_bigwig(source_assembly, target_assembly, infile, outfile):
     return outfile
 
 
-def _liftover_bigbed(source_assembly, target_assembly, infile, outfile):
-    chainfile = download_chainfile(source_assembly, target_assembly)
+def _bigwig_chroms(infile):
+    """
+    Chromosomes in a bigWig, from `bigWigInfo -chroms`.
+    """
+    output = subprocess.check_output(['bigWigInfo', '-chroms', infile])
+    chroms = []
+    for line in output.decode().splitlines():
+        # Chromosome lines are indented: "\tchr1 0 249250621"
+        if line.startswith('\t'):
+            chroms.append(line.split()[0])
+    return chroms
 
-    # Convert bigBed to bed
-    cmds = [
-        'bigBedToBed',
-        infile,
-        outfile + '.bed']
-    p = subprocess.check_call(cmds)
 
-    # get a tempfile for the unmapped; this wil actually not be returned but
-    # needs to be specified for `liftOver`.
-    unmapped = pybedtools.BedTool._tmp()
+def _read_bedgraph(fn):
+    """
+    Returns starts, ends, and values from a bedGraph file as arrays, plus
+    the chromosome of each line.
+    """
+    chroms, starts, ends, values = [], [], [], []
+    with open(fn) as f:
+        for line in f:
+            fields = line.split()
+            chroms.append(fields[0])
+            starts.append(int(fields[1]))
+            ends.append(int(fields[2]))
+            values.append(fields[3])
+    return (np.array(chroms, dtype=object),
+            np.array(starts, dtype=np.int64),
+            np.array(ends, dtype=np.int64),
+            np.array(values, dtype=object))
 
-    # There seems to be a bug in crossmap where a BED9 file's thickStart and
-    # thickEnd are not lifted over. So use UCSC's liftover directly. Might as
-    # well, since it was designed for BED files anyway.
-    cmds = [
-        'liftOver',
-        outfile + '.bed',
-        chainfile,
-        outfile + '.converted',
-        unmapped,
-    ]
-    p = subprocess.check_call(cmds)
 
-    tmp = pybedtools.BedTool(outfile + '.converted').sort()
+def _write_bedgraph(fout, chrom, starts, ends, values):
+    for start, end, value in zip(starts, ends, values):
+        fout.write('{0}\t{1}\t{2}\t{3}\n'.format(chrom, start, end, value))
+
+
+def _scatter_chrom(args):
+    """
+    Lift over one source chromosome of a bigWig. Writes the lifted-over
+    intervals to one bedGraph per target chromosome, and returns a list of
+    (target chromosome, filename) tuples.
+    """
+    chainfile, infile, chrom, tmpdir = args
+    bedgraph = os.path.join(tmpdir, 'source.{0}.bedGraph'.format(chrom))
+    subprocess.check_call(
+        ['bigWigToBedGraph', '-chrom=' + chrom, infile, bedgraph])
+    _, starts, ends, values = _read_bedgraph(bedgraph)
+    os.unlink(bedgraph)
+
+    c = chain.load(chainfile)
+    pieces = c.split_intervals(chrom, starts, ends)
+    written = []
+    for q in np.unique(pieces['q_chrom']):
+        sel = pieces['q_chrom'] == q
+        target = c.q_names[q]
+        fn = os.path.join(
+            tmpdir, 'lifted.{0}.from.{1}.bedGraph'.format(target, chrom))
+        with open(fn, 'w') as fout:
+            _write_bedgraph(fout, target, pieces['start'][sel],
+                            pieces['end'][sel], values[pieces['index'][sel]])
+        written.append((target, fn))
+    return written
+
+
+def _gather_chrom(args):
+    """
+    Merge the lifted-over pieces for one target chromosome into a single
+    sorted bedGraph without overlaps, and return its filename.
 
-    utils.bigbed(tmp.fn, target_assembly, outfile)
+    Where pieces overlap (because different source regions map to the same
+    place), the one that starts first is kept and the later one is trimmed
+    to start where it ends, or dropped if nothing is left. Ties are broken
+    by the order of `filenames`, so the result doesn't depend on which
+    chunks finished first.
+    """
+    target, filenames, tmpdir = args
+    parts = [_read_bedgraph(fn) for fn in filenames]
+    starts = np.concatenate([p[1] for p in parts])
+    ends = np.concatenate([p[2] for p in parts])
+    values = np.concatenate([p[3] for p in parts])
+    order = np.lexsort((ends, starts))
+    starts, ends, values = starts[order], ends[order], values[order]
+
+    # Trim each interval to start after everything before it
+    covered = np.concatenate([[0], np.maximum.accumulate(ends)[:-1]])
+    starts = np.maximum(starts, covered)
+    keep = starts < ends
+
+    fn = os.path.join(tmpdir, 'merged.{0}.bedGraph'.format(target))
+    with open(fn, 'w') as fout:
+        _write_bedgraph(fout, target, starts[keep], ends[keep], values[keep])
+    return fn
+
+
+def _scatter_bigwig(chainfile, target_assembly, infile, outfile, jobs):
+    """
+    Lift over a bigWig by scattering it by source chromosome, then gathering
+    by target chromosome.
+
+    Each source chromosome is converted to bedGraph and lifted over in its
+    own process (at most `jobs` at once), so memory use per process is
+    bounded by one chromosome. Intervals are split at gaps in the alignment
+    and unaligned parts are dropped, as CrossMap does. The pieces are then
+    merged per target chromosome (see `_gather_chrom`) and converted to
+    a bigWig in one step.
+    """
+    # Compile the chain file once, before the worker processes each load it.
+    # It is closed again so that no open .npz is inherited by the workers;
+    # each one opens its own (see `chain._forget`).
+    chain.Chain(chainfile).close()
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outfile)))
+    pool = multiprocessing.Pool(jobs, initializer=chain._forget)
+    try:
+        chroms = _bigwig_chroms(infile)
+        log('Lifting over {0} chromosomes of {1} with {2} processes'
+            .format(len(chroms), infile, jobs))
+        by_target = {}
+        for written in pool.map(
+                _scatter_chrom,
+                [(chainfile, infile, chrom, tmpdir) for chrom in chroms]):
+            for target, fn in written:
+                by_target.setdefault(target, []).append(fn)
+
+        # bedGraphToBigWig wants chromosomes sorted as `sort -k1,1` would
+        targets = sorted(by_target)
+        merged = pool.map(
+            _gather_chrom,
+            [(target, by_target[target], tmpdir) for target in targets])
+
+        bedgraph = os.path.join(tmpdir, 'lifted.bedGraph')
+        with open(bedgraph, 'wb') as fout:
+            for fn in merged:
+                with open(fn, 'rb') as fin:
+                    shutil.copyfileobj(fin, fout)
+                os.unlink(fn)
+        utils.bigwig(bedgraph, target_assembly, outfile)
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(tmpdir)
     return outfile
 
 
+def _bigbed_engine(engine=None):
+    """
+    The engine `_liftover_bigbed` uses: `engine` if given, otherwise UCSC's
+    `liftOver` if it's on the PATH and `hubward.chain` if not.
+    """
+    if engine is None:
+        engine = 'liftOver' if which('liftOver') else 'hubward'
+    if engine not in ('hubward', 'liftOver'):
+        raise ValueError("unknown liftover engine: {0}".format(engine))
+    return engine
+
+
+def _liftover_bigbed(source_assembly, target_assembly, infile, outfile,
+                     engine=None, threads=1, memory=None, scratch=None):
+    """
+    bigBedToBed's output is piped through the liftover into the file that
+    bedToBigBed reads. That file is only sorted (in place, with `sort
+    --parallel`) if the lifted-over features came out unsorted.
+
+    Parameters
+    ----------
+    engine : str or None
+        "liftOver" to use UCSC's `liftOver` program, or "hubward" to use
+        `hubward.chain`. If None (the default), use `liftOver` if it's on the
+        PATH, and `hubward.chain` otherwise.
+
+    threads : int
+        Number of threads for `sort`.
+
+    memory : int or None
+        Memory in MB for `sort`. If None, use sort's default.
+
+    scratch : str or None
+        Directory for the temporary files of `sort` and for the lifted-over
+        BED file. Defaults to $HUBWARD_SCRATCH_DIR if set, otherwise the
+        system temp dir.
+    """
+    engine = _bigbed_engine(engine)
+    chainfile = download_chainfile(source_assembly, target_assembly)
+    if scratch is None:
+        scratch = os.environ.get('HUBWARD_SCRATCH_DIR')
+    tmpdir = tempfile.mkdtemp(prefix='hubward-liftover.', dir=scratch)
+
+    # bedToBigBed reads its input twice, so it needs a real file rather than
+    # a pipe
+    bed = os.path.join(tmpdir, 'lifted.bed')
+    procs = []
+    try:
+        with open(bed, 'w') as fout:
+            writer = utils.SortedBedWriter(fout)
+            cmds = ['bigBedToBed', infile, 'stdout']
+            procs.append((subprocess.Popen(
+                cmds, stdout=subprocess.PIPE, universal_newlines=True),
+                cmds))
+
+            # There seems to be a bug in crossmap where a BED9 file's
+            # thickStart and thickEnd are not lifted over. So use either our
+            # own engine, which handles them, or UCSC's liftover directly.
+            # Might as well, since it was designed for BED files anyway.
+            if engine == 'hubward':
+                mapped, failed = chain.load(chainfile).liftover_bed(
+                    procs[0][0].stdout, writer)
+                log('Lifted over {0} features; {1} could not be mapped'
+                    .format(mapped, failed))
+            else:
+                cmds = ['liftOver', 'stdin', chainfile, 'stdout',
+                        os.devnull]
+                procs.append((subprocess.Popen(
+                    cmds, stdin=procs[0][0].stdout, stdout=subprocess.PIPE,
+                    universal_newlines=True), cmds))
+                # Only liftOver should hold the pipe, so that bigBedToBed
+                # gets SIGPIPE if liftOver dies
+                procs[0][0].stdout.close()
+                for line in procs[1][0].stdout:
+                    writer.write(line)
+            # From the last stage back, so that a failure is reported rather
+            # than the SIGPIPE it causes upstream
+            for proc, cmds in reversed(procs):
+                proc.stdout.close()
+                if proc.wait() != 0:
+                    raise subprocess.CalledProcessError(proc.returncode, cmds)
+
+        if not writer.sorted:
+            log('Sorting lifted-over features of {0}'.format(infile))
+            utils.sort_bed(bed, threads=threads, memory=memory, tmpdir=tmpdir)
+
+        utils.bigbed(bed, target_assembly, outfile,
+                     bedtype='bed{0}'.format(writer.field_count or 3))
+    finally:
+        for proc, cmds in procs:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        shutil.rmtree(tmpdir)
+    return outfile
+
+
+_program_versions = {}
+
+
+def _program_version(cmds):
+    """
+    First line of the output of `cmds` (e.g., `samtools --version`), or
+    "unknown" if it couldn't be run.
+    """
+    key = tuple(cmds)
+    if key not in _program_versions:
+        try:
+            output = subprocess.check_output(cmds, stderr=subprocess.STDOUT)
+            lines = output.decode('utf-8', 'replace').strip().splitlines()
+            _program_versions[key] = lines[0] if lines else 'unknown'
+        except (OSError, subprocess.CalledProcessError):
+            _program_versions[key] = 'unknown'
+    return _program_versions[key]
+
+
+def tool_version(filetype, **kwargs):
+    """
+    Describes the tools that `liftover` would use for `filetype` with
+    `kwargs`, so that cached results (see `hubward.cache.LiftoverCache`) are
+    not reused after those tools change.
+    """
+    filetype = filetype.lower()
+    crossmap = 'CrossMap ' + _program_version(['CrossMap.py', '--version'])
+    if filetype == 'bam':
+        return '{0}; {1}'.format(
+            crossmap, _program_version(['samtools', '--version']))
+    if filetype == 'bigwig':
+        if kwargs.get('jobs', 1) > 1:
+            return 'hubward.chain {0} scatter'.format(chain.VERSION)
+        return crossmap
+    if filetype == 'bigbed':
+        if _bigbed_engine(kwargs.get('engine')) == 'hubward':
+            return 'hubward.chain {0}'.format(chain.VERSION)
+        # liftOver has no version option
+        return 'liftOver'
+    return 'unknown'
+
+
 _dispatch = {
     'bigwig': _liftover_bigwig,
     'bigbed': _liftover_bigbed,
     'bam': _liftover_bam,
 }
 
-def liftover(from_, to_, infile, outfile, filetype):
+def liftover(from_, to_, infile, outfile, filetype, **kwargs):
+    """
+    Lift over `infile` from assembly `from_` to assembly `to_`.
+
+    Additional kwargs are passed to the function for `filetype` (e.g.,
+    `engine` for bigBed).
+    """
     try:
-        return _dispatch[filetype.lower()](from_, to_, infile, outfile)
+        func = _dispatch[filetype.lower()]
     except KeyError:
         raise ValueError("unsupported filetype (%s) to lift over" % filetype)
+    return func(from_, to_, infile, outfile, **kwargs)
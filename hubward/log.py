@@ -1,4 +1,6 @@
 import logging
+import threading
+from contextlib import contextmanager
 from colorama import Fore, Back, Style
 
 #logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(message)s")
@@ -10,6 +12,29 @@ formatter = logging.Formatter("[%(asctime)s] %(name)s %(levelname)s %(message)s"
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
+# Per-thread tag (e.g., a track label) prepended to every message. This lets
+# messages from concurrently-running tracks be told apart in the log.
+_context = threading.local()
+
+
+@contextmanager
+def tagged(tag):
+    """
+    Context manager that prefixes all messages logged from the current thread
+    with "[tag]".
+
+    Parameters
+    ----------
+    tag : str
+        For example, the label of the track being processed.
+    """
+    previous = getattr(_context, 'tag', None)
+    _context.tag = tag
+    try:
+        yield
+    finally:
+        _context.tag = previous
+
 
 def log(msg, indent=0, style=None):
     """
@@ -32,4 +57,7 @@ def log(msg, indent=0, style=None):
     else:
         start = ""
         end = ""
+    tag = getattr(_context, 'tag', None)
+    if tag:
+        start += '[{0}] '.format(tag)
     logger.info(start + (" " * indent) + msg + end)
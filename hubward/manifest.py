@@ -0,0 +1,208 @@
+"""
+Module for deciding whether tracks need rebuilding based on file contents
+rather than modification times.
+
+File modification times are unreliable after `git checkout`, `rsync -a`, or
+across NFS mounts with clock skew. Instead, each study can keep a manifest
+(`<study>/.hubward/manifest.sqlite`) recording content hashes of the original,
+script, and processed file of every track as of the last time it was built.
+A track is rebuilt only when one of those hashes changes.
+"""
+import os
+import sqlite3
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+from hubward import utils
+
+# Files are hashed in blocks of this many bytes. The digest of a file is the
+# SHA1 of the concatenated SHA1 digests of its blocks, so large files can have
+# their blocks hashed in parallel without changing the result.
+BLOCK_SIZE = 64 * 1024 * 1024
+
+# Size of each read within a block
+CHUNK_SIZE = 1024 * 1024
+
+
+def _hash_block(args):
+    filename, offset = args
+    h = hashlib.sha1()
+    remaining = BLOCK_SIZE
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            h.update(chunk)
+            remaining -= len(chunk)
+    return h.digest()
+
+
+def file_hash(filename, jobs=4):
+    """
+    Returns a hex digest of the contents of `filename`.
+
+    Parameters
+    ----------
+    filename : str
+
+    jobs : int
+        Files larger than one block are hashed using this many threads
+        (hashlib releases the GIL, so this scales with cores and disk
+        throughput).
+    """
+    size = os.stat(filename).st_size
+    offsets = range(0, max(size, 1), BLOCK_SIZE)
+    args = [(filename, offset) for offset in offsets]
+    if len(args) == 1 or jobs == 1:
+        digests = [_hash_block(a) for a in args]
+    else:
+        pool = ThreadPool(min(jobs, len(args)))
+        try:
+            digests = pool.map(_hash_block, args)
+        finally:
+            pool.close()
+            pool.join()
+    return hashlib.sha1(b''.join(digests)).hexdigest()
+
+
+class Manifest(object):
+    def __init__(self, dirname, jobs=4):
+        """
+        Content hashes of the files used to build each track in a study.
+
+        Parameters
+        ----------
+        dirname : str
+            Study directory. The manifest is stored in
+            `<dirname>/.hubward/manifest.sqlite`.
+
+        jobs : int
+            Number of threads to use when hashing a large file.
+        """
+        self.dirname = dirname
+        self.jobs = jobs
+        self.filename = os.path.join(dirname, '.hubward', 'manifest.sqlite')
+        utils.makedirs(os.path.dirname(self.filename))
+
+        # Tracks within a study may be processed in parallel threads, so share
+        # one connection and serialize access to it.
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS hashes (
+                    path TEXT PRIMARY KEY,
+                    inode INTEGER,
+                    size INTEGER,
+                    mtime REAL,
+                    digest TEXT)
+                """)
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS tracks (
+                    processed TEXT PRIMARY KEY,
+                    original TEXT,
+                    script TEXT,
+                    original_digest TEXT,
+                    script_digest TEXT,
+                    processed_digest TEXT)
+                """)
+
+    def hash(self, filename):
+        """
+        Returns the content hash of `filename`.
+
+        Hashes are memoized by (inode, size, mtime), so a file is only
+        re-read when it has been touched.
+        """
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        key = (st.st_ino, st.st_size, st.st_mtime)
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT inode, size, mtime, digest FROM hashes WHERE path = ?',
+                (path,)).fetchone()
+        if row is not None and tuple(row[:3]) == key:
+            return row[3]
+
+        digest = file_hash(path, jobs=self.jobs)
+        with self._lock:
+            with self.conn:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)',
+                    (path,) + key + (digest,))
+        return digest
+
+    def _record(self, track):
+        with self._lock:
+            return self.conn.execute(
+                'SELECT original, script, original_digest, script_digest, '
+                'processed_digest FROM tracks WHERE processed = ?',
+                (os.path.abspath(track.processed),)).fetchone()
+
+    def record(self, track):
+        """
+        Record the current hashes of a track's files, marking it as built.
+        """
+        values = (
+            os.path.abspath(track.processed),
+            os.path.abspath(track.original),
+            os.path.abspath(track.script),
+            self.hash(track.original),
+            self.hash(track.script),
+            self.hash(track.processed),
+        )
+        with self._lock:
+            with self.conn:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?)',
+                    values)
+
+    def reasons(self, track, fallback):
+        """
+        Returns a list of reasons why `track` needs to be rebuilt; an empty
+        list means it's up to date.
+
+        Parameters
+        ----------
+        track : hubward.models.Data
+
+        fallback : callable
+            Returns the reasons according to modification times. Used for
+            tracks with no record in the manifest yet (e.g., the first run
+            after switching to content hashes). If it finds nothing to do, the
+            track's current hashes are recorded so that later runs can rely
+            on them.
+        """
+        if not os.path.exists(track.processed):
+            return ["{0.processed} does not exist".format(track)]
+
+        record = self._record(track)
+        if record is None:
+            reasons = fallback()
+            if not reasons:
+                self.record(track)
+            return reasons
+
+        original, script, original_digest, script_digest, processed_digest = \
+            record
+        reasons = []
+        if original != os.path.abspath(track.original):
+            reasons.append(
+                "original changed from {0} to {1.original}"
+                .format(original, track))
+        elif self.hash(track.original) != original_digest:
+            reasons.append(
+                "contents of {0.original} changed".format(track))
+        if script != os.path.abspath(track.script):
+            reasons.append(
+                "script changed from {0} to {1.script}".format(script, track))
+        elif self.hash(track.script) != script_digest:
+            reasons.append("contents of {0.script} changed".format(track))
+        if self.hash(track.processed) != processed_digest:
+            reasons.append(
+                "{0.processed} was modified after it was built".format(track))
+        return reasons
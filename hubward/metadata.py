@@ -0,0 +1,141 @@
+"""
+Module for loading and validating metadata.yaml and group config files.
+
+Each schema is read and compiled into a validator only once per process, and
+config files are parsed with libyaml's CSafeLoader if PyYAML was built with
+it.
+
+Parsed and validated configs are also cached in
+`<HUBWARD_CACHE_DIR>/metadata`, so that unchanged files (e.g., most of the
+studies in a large group) are neither parsed nor validated again. A cached
+config is used if the file has the same size and modification time as when
+it was cached or, failing that, the same content hash (e.g., when
+metadata-builder.py writes an unchanged metadata.yaml again). Changes to the
+schema invalidate the cache. Cached configs are stored as JSON; configs that
+JSON can't represent exactly (e.g., with dates) are parsed every time.
+"""
+import os
+import json
+import hashlib
+import threading
+import yaml
+from jsonschema import Draft4Validator
+from hubward import utils
+
+# Bump when the format of cached configs changes
+VERSION = 2
+
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+_schemas = {}
+_lock = threading.Lock()
+
+
+def _schema(name):
+    """
+    Returns the compiled validator and the hash of schema resource `name`.
+    """
+    with _lock:
+        if name not in _schemas:
+            text = utils.get_resource(name)
+            if not isinstance(text, bytes):
+                text = text.encode('utf-8')
+            schema = yaml.load(text, Loader=Loader)
+            Draft4Validator.check_schema(schema)
+            _schemas[name] = (
+                Draft4Validator(schema), hashlib.sha1(text).hexdigest())
+        return _schemas[name]
+
+
+def validator(name):
+    """
+    Returns the (memoized) jsonschema validator for schema resource `name`,
+    e.g., "metadata_schema.yaml".
+    """
+    return _schema(name)[0]
+
+
+def _cache_path(fn):
+    key = hashlib.sha1(os.path.abspath(fn).encode('utf-8')).hexdigest()
+    return os.path.join(utils.cache_dir(), 'metadata', key + '.json')
+
+
+def _native(obj):
+    """
+    On Python 2, json gives unicode strings where YAML gives str for ASCII
+    ones; convert them back so cached configs are just like parsed ones.
+    """
+    if str is not bytes:
+        return obj
+    if isinstance(obj, dict):
+        return dict((_native(k), _native(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [_native(x) for x in obj]
+    if isinstance(obj, unicode):
+        try:
+            return obj.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+    return obj
+
+
+def _read(cache_fn):
+    try:
+        with open(cache_fn) as f:
+            return _native(json.load(f))
+    except Exception:
+        # Missing, or written by an incompatible version; parsed again
+        return None
+
+
+def _write(cache_fn, cached):
+    try:
+        text = json.dumps(cached)
+    except (TypeError, ValueError):
+        # e.g., dates
+        return
+    if _native(json.loads(text)) != cached:
+        # e.g., non-string keys, which JSON turns into strings
+        return
+    tmp = cache_fn + '.{0}.tmp'.format(os.getpid())
+    try:
+        utils.makedirs(os.path.dirname(cache_fn))
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.rename(tmp, cache_fn)
+    except (IOError, OSError):
+        # e.g., a read-only cache; the file is just parsed again next time
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def load(fn, schema):
+    """
+    Parse YAML file `fn` and validate it against schema resource `schema`
+    (e.g., "metadata_schema.yaml"), or return the cached result if `fn` is
+    unchanged.
+
+    Raises jsonschema.ValidationError if `fn` is invalid. Each call returns
+    a new object, so it can be modified by the caller.
+    """
+    validator_, schema_hash = _schema(schema)
+    st = os.stat(fn)
+    cache_fn = _cache_path(fn)
+    head = [VERSION, schema_hash]
+    cached = _read(cache_fn)
+    if cached is not None and cached['key'][:2] != head:
+        cached = None
+    if cached is not None and cached['key'][2:] == [st.st_size, st.st_mtime]:
+        return cached['data']
+
+    with open(fn, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha1(content).hexdigest()
+    if cached is not None and cached['hash'] == digest:
+        data = cached['data']
+    else:
+        data = yaml.load(content, Loader=Loader)
+        validator_.validate(data)
+    _write(cache_fn, dict(
+        key=head + [st.st_size, st.st_mtime], hash=digest, data=data))
+    return data
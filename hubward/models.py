@@ -5,16 +5,42 @@ import tempfile
 from colorama import init, Fore, Back, Style
 from textwrap import dedent
 import yaml
-import jsonschema
 import subprocess
+import threading
 from trackhub import Track, default_hub, CompositeTrack, ViewTrack
 from trackhub.upload import upload_hub, upload_track, upload_file
-from hubward import utils, liftover
+from hubward import utils, liftover, scheduler, manifest, download
+from hubward import workers as hubward_workers
+from hubward import archive as hubward_archive
+from hubward import metadata as hubward_metadata
 from hubward.log import log
 
 
+# Resources assumed for tracks that don't configure them; keep in sync with
+# the defaults in metadata_schema.yaml.
+DEFAULT_THREADS = 1
+DEFAULT_MEMORY = '500M'
+
+# Tracks often share a single source archive. When tracks are processed in
+# parallel, these locks (one per source file) ensure it's only downloaded once.
+_download_locks = {}
+_download_locks_lock = threading.Lock()
+
+
+def _download_lock(source_fn):
+    with _download_locks_lock:
+        return _download_locks.setdefault(
+            os.path.abspath(source_fn), threading.Lock())
+
+
+# Archives currently being streamed (see Data._stream), keyed by source file,
+# so that tracks sharing an archive wait on the same extraction.
+_streams = {}
+
+
 class Data(object):
-    def __init__(self, obj, reldir):
+    def __init__(self, obj, reldir, manifest=None, downloader=None,
+                 cache=None):
         """
         Represents a single track destined for upload to UCSC as part of
         a track hub.
@@ -27,12 +53,29 @@ class Data(object):
         reldir : str
             The directory name of the metadata file. All paths within the
             metadata file are assumed to be relative to `reldir`.
+
+        manifest : hubward.manifest.Manifest or None
+            If provided, decide whether the processed file is out of date by
+            comparing content hashes recorded in the manifest rather than
+            modification times.
+
+        downloader : hubward.download.DownloadManager or None
+            If provided, download the source through this manager so that it
+            shares connections and bandwidth with other tracks' downloads.
+
+        cache : hubward.cache.DownloadCache or None
+            If provided, download the source into this cache (or reuse the
+            copy already there) and link it into `raw-data`.
         """
         self.obj = obj
         self.reldir = reldir
         self.original = os.path.join(reldir, obj['original'])
         self.source_url = obj['source']['url']
         self.source_fn = os.path.join(reldir, 'raw-data', obj['source']['fn'])
+        self.stream = (
+            obj['source'].get('stream', False) and
+            self.source_fn.lower().endswith(download.STREAMABLE))
+        self.keep_archive = obj['source'].get('keep', False)
         self.processed = os.path.join(reldir, obj['processed'])
         self.description = obj.get('description', "")
         self.label = obj['short_label']
@@ -41,6 +84,25 @@ class Data(object):
         self.genome = obj['genome']
         self.script = os.path.join(reldir, obj['script'])
         self.trackinfo = obj.get('trackinfo', {})
+        self.batch = obj.get('batch', False)
+        resources = obj.get('resources', {})
+        self.threads = int(resources.get('threads', DEFAULT_THREADS))
+        self.memory = utils.parse_memory(
+            resources.get('memory', DEFAULT_MEMORY))
+        self.manifest = manifest
+        self.downloader = downloader
+        self.cache = cache
+
+        # Reasons the processed file was last rebuilt, if it was
+        self.why = []
+
+        # Version of the processed file before the script last ran (see
+        # `_processed_stat`)
+        self._before = None
+
+        # Tracks (including this one) with the same source file; set by
+        # Study
+        self.sharing = [self]
 
     def __str__(self):
         return yaml.dump(self.obj)
@@ -55,79 +117,173 @@ class Data(object):
 
     def _download(self):
         """
-        Downloads and unpacks the source to `raw-data`.
+        Downloads the source to `raw-data` (unless it's already there) and
+        extracts `self.original` from it.
 
         After doing so, if self.original still does not exist, then raises
         a ValueError.
         """
-        log(
-            "Downloading '%s' -> '%s'" %
-            (self.source_url, self.source_fn), indent=4)
-        if not os.path.exists(os.path.dirname(self.source_fn)):
-            os.makedirs(os.path.dirname(self.source_fn))
-        utils.download(self.source_url, self.source_fn)
-        utils.unpack(self.source_fn, os.path.dirname(self.source_fn))
+        if self.stream:
+            return self._stream()
+        with _download_lock(self.source_fn):
+            # Another track sharing the same source may have just downloaded
+            # it.
+            if not self._needs_download():
+                return
+            if not os.path.exists(self.source_fn):
+                log(
+                    "Downloading '%s' -> '%s'" %
+                    (self.source_url, self.source_fn), indent=4)
+                utils.makedirs(os.path.dirname(self.source_fn))
+                if self.cache is not None:
+                    self.cache.fetch(self.source_url, self.source_fn,
+                                     downloader=self.downloader)
+                elif self.downloader is not None:
+                    self.downloader.fetch(self.source_url, self.source_fn)
+                else:
+                    utils.download(self.source_url, self.source_fn)
+
+            # A compressed tar has to be decompressed from the start, so the
+            # first track extracts the files of every track sharing it in
+            # a single pass
+            if not hubward_archive.is_indexed(self.source_fn):
+                members = [d._archive_members() for d in self.sharing
+                           if d._needs_download()]
+                if None in members:
+                    members = None
+                else:
+                    members = sorted(set(sum(members, [])))
+                utils.unpack(self.source_fn, os.path.dirname(self.source_fn),
+                             members=members)
+
+        # Tracks sharing a zip or uncompressed tar extract their own files
+        # concurrently
+        if hubward_archive.is_indexed(self.source_fn):
+            utils.unpack(self.source_fn, os.path.dirname(self.source_fn),
+                         members=self._archive_members())
 
         if self._needs_download():
             raise ValueError(
                 "Downloading and unpacking '%s' did not result in '%s'"
                 % (self.source_url, self.source_fn))
 
+    def _archive_members(self):
+        """
+        Path of `self.original` within the source archive, as a list for
+        `utils.unpack`, or None if it isn't within the directory the archive
+        is extracted to.
+        """
+        rel = os.path.relpath(self.original, os.path.dirname(self.source_fn))
+        if rel.startswith(os.pardir):
+            return None
+        return [rel.replace(os.sep, '/')]
+
+    def _stream(self):
+        """
+        Like `_download`, but the archive is extracted while it downloads
+        (see `hubward.download.StreamingUnpack`), and this returns as soon as
+        `self.original` has been extracted rather than when the whole archive
+        is done.
+
+        Streamed sources are not stored in the download cache. The archive
+        itself is only kept if the source sets `keep: true`.
+        """
+        with _download_lock(self.source_fn):
+            if not self._needs_download():
+                return
+            key = os.path.abspath(self.source_fn)
+            stream = _streams.get(key)
+            if stream is None or (stream.done() and stream.error):
+                log("Streaming '{0.source_url}' into '{1}'".format(
+                    self, os.path.dirname(self.source_fn)), indent=4)
+                utils.makedirs(os.path.dirname(self.source_fn))
+                stream = download.StreamingUnpack(
+                    self.source_url, os.path.dirname(self.source_fn),
+                    archive=self.source_fn if self.keep_archive else None)
+                _streams[key] = stream
+        stream.wait_for(self.original)
+
+        if self._needs_download():
+            raise ValueError(
+                "Streaming '%s' did not result in '%s'"
+                % (self.source_url, self.original))
+
+    def _staleness_reasons(self):
+        """
+        Returns a list of reasons why the processed file is out of date with
+        respect to the original file and script. An empty list means it's up
+        to date.
+
+        By default this compares modification times; if this track has
+        a `manifest` then content hashes are compared instead.
+        """
+        if self.manifest is not None:
+            return self.manifest.reasons(self, fallback=self._mtime_reasons)
+        return self._mtime_reasons()
+
+    def _mtime_reasons(self, exists=os.path.exists, stat=os.stat,
+                       lstat=os.lstat):
+        """
+        Returns the reasons the processed file is out of date according to
+        modification times.
+
+        `exists`, `stat`, and `lstat` default to the functions in `os`; other
+        implementations (e.g., `hubward.status.StatCache`) can be provided.
+        """
+        reasons = []
+        if not exists(self.processed):
+            reasons.append("{0.processed} does not exist".format(self))
+
+        # if processed is a link, then check the LINK time
+        if (
+            exists(self.processed) and
+            lstat(self.script).st_mtime > lstat(self.processed).st_mtime
+        ):
+            reasons.append("{0.script} is newer than {0.processed}, need to "
+                           "re-run".format(self))
+
+        # but for the original data, we want to FOLLOW the link
+        if (
+                exists(self.original) and
+                exists(self.processed) and
+                stat(self.original).st_mtime > stat(self.processed).st_mtime
+        ):
+            reasons.append("{0.original} is newer than {0.processed}, need "
+                           "to re-run".format(self))
+        return reasons
+
     def _needs_update(self):
         """
         Decides if we need to update the processed file.
+
+        Returns a list of the reasons for updating, which is empty (and so
+        evaluates to False) if no update is needed.
         """
-        do_update = False
+        reasons = []
         if self._was_lifted_over():
             log(
                 "This file appears to have been lifted over from another "
                 "study, in which case we assume it does not need updating",
                 style=Fore.YELLOW
             )
-            return False
+            return reasons
         if self._needs_download():
             log("{0.original} does not exist; downloading"
-                .format(self, indent=4))
-            self._download()
-            do_update = True
-
-        if not os.path.exists(self.processed):
-            log("{0.processed} does not exist".format(self), indent=4)
-            do_update = True
-
-        # if processed is a link, then check the LINK time
-        if (
-            os.path.exists(self.processed) and
-            utils.link_is_newer(self.script, self.processed)
-        ):
-            log("{0.script} is newer than {0.processed}, need to re-run"
                 .format(self), indent=4)
-            do_update = True
+            self._download()
+            reasons.append("{0.original} was downloaded".format(self))
 
-        # but for the original data, we want to FOLLOW the link
-        if (
-                os.path.exists(self.original) and
-                os.path.exists(self.processed) and
-                utils.is_newer(self.original, self.processed)
-        ):
-            log("{0.original} is newer than {0.processed}, need to re-run"
-                .format(self), indent=4)
-            do_update = True
+        reasons.extend(self._staleness_reasons())
+        for reason in reasons:
+            log(reason, indent=4)
 
-        if not do_update:
+        if not reasons:
             log("{0.processed} is up to date"
                 .format(self), indent=4, style=Style.DIM)
 
-        return do_update
-
-    def process(self):
-        """
-        Run the conversion script if the output needs updating.
-        """
-        # Note: _needs_update() does the logging.
-        if not self._needs_update():
-            return
+        return reasons
 
+    def _check_script(self):
         if not os.path.exists(self.script):
             raise ValueError(
                 "Processing script {0.script} does not exist".format(self))
@@ -138,21 +294,134 @@ class Data(object):
                 "Processing script {0.script} not executable".format(self) +
                 Fore.RESET)
 
+    def _run_script(self, workers=None):
+        """
+        Run the conversion script, `script original processed`.
+
+        If `workers` (a `hubward.workers.WorkerPool`) is provided and the
+        script defines a `process(source, target)` function, call that
+        function in one of the pool's worker processes instead.
+
+        The number of threads configured for the track is provided to the
+        script in the HUBWARD_THREADS environment variable.
+        """
+        self._check_script()
         utils.makedirs(os.path.dirname(self.processed))
+        self._before = self._processed_stat()
 
         cmds = [
             self.script,
             self.original,
             self.processed
         ]
-        retval = subprocess.check_call(cmds)
-        if self._needs_update():
+        if workers is not None and hubward_workers.has_entry_point(
+                self.script):
+            log("Calling process() from {0.script} in a worker process"
+                .format(self), indent=4)
+            workers.run(self.script, self.original, self.processed,
+                        env=self._env())
+        else:
+            env = dict(os.environ)
+            env.update(self._env())
+            retval = subprocess.check_call(cmds, env=env)
+        return cmds
+
+    def _env(self):
+        """
+        Environment variables to provide to the processing script.
+        """
+        return {'HUBWARD_THREADS': str(self.threads)}
+
+    def _processed_stat(self):
+        """
+        Identifies the current version of the processed file, or None if it
+        doesn't exist.
+        """
+        if not os.path.exists(self.processed):
+            return None
+        st = os.stat(self.processed)
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def _verify(self, cmds):
+        """
+        Raise a ValueError if running `cmds` did not update the processed file.
+
+        With a manifest, the track's hashes are recorded only once the
+        processed file is known to have been (re)written since `_run_script`
+        started; comparing hashes afterwards would trivially succeed.
+        """
+        if self.manifest is not None:
+            updated = self._processed_stat() not in (None, self._before)
+            if updated:
+                self.manifest.record(self)
+        else:
+            updated = not self._needs_update()
+        if not updated:
             raise ValueError(
                 Fore.RED + 'The following command did not update '
                 '{1}:\n\n{0}\n'.format(' \\\n'.join(cmds), self.processed) +
                 Fore.RESET
             )
 
+    def process(self, workers=None):
+        """
+        Run the conversion script if the output needs updating.
+
+        See `_run_script` for `workers`.
+        """
+        # Note: _needs_update() does the logging.
+        reasons = self._needs_update()
+        if not reasons:
+            return
+        self.why = reasons
+        self._verify(self._run_script(workers))
+
+    def add_jobs(self, scheduler, name, workers=None):
+        """
+        Add the jobs needed to process this track to a
+        `hubward.scheduler.Scheduler`.
+
+        These are the same steps as `process()`, split up as download ->
+        script -> verify so that other jobs can depend on them.
+
+        Parameters
+        ----------
+        scheduler : hubward.scheduler.Scheduler
+
+        name : str
+            Unique prefix for the names of the added jobs.
+
+        workers : hubward.workers.WorkerPool or None
+            See `_run_script`.
+
+        Returns the name of the final job.
+        """
+        # The commands that were run, if any, to be checked by the verify job
+        ran = []
+
+        def download():
+            if not self._was_lifted_over() and self._needs_download():
+                self._download()
+
+        def script():
+            reasons = self._needs_update()
+            if reasons:
+                self.why = reasons
+                ran.extend(self._run_script(workers))
+
+        def verify():
+            if ran:
+                self._verify(ran)
+
+        scheduler.add(name + ':download', download, tag=self.label,
+                      threads=0)
+        scheduler.add(name + ':script', script,
+                      depends=[name + ':download'], tag=self.label,
+                      threads=self.threads, memory=self.memory)
+        return scheduler.add(name + ':verify', verify,
+                             depends=[name + ':script'], tag=self.label,
+                             threads=0)
+
     def _needs_liftover(self, from_assembly, to_assembly, newfile):
         """
         Checks to see if liftover is needed based on the 
@@ -176,7 +445,8 @@ class Data(object):
             os.path.basename(newfile)
         ).format(from_assembly, to_assembly)
 
-    def liftover(self, from_assembly, to_assembly, newfile):
+    def liftover(self, from_assembly, to_assembly, newfile, scratch=None,
+                 cache=None):
         """
         Lifts over the processed file to a new file, but only if needed.
 
@@ -193,6 +463,16 @@ class Data(object):
 
         newfile : str
             Target filename of the lifted-over data
+
+        scratch : str or None
+            Directory for temporary files while sorting BAM and bigBed
+            files. See `hubward.liftover._liftover_bam` and
+            `hubward.liftover._liftover_bigbed`.
+
+        cache : hubward.cache.LiftoverCache or None
+            If provided, link the result from this cache if the same file
+            has been lifted over before with the same chain file and tools,
+            and otherwise store the result there.
         """
 
         if not from_assembly == self.genome:
@@ -208,10 +488,44 @@ class Data(object):
                 .format(newfile))
             return
 
+        kwargs = {}
+        if self.type_.lower() == 'bigwig':
+            # Split large bigWigs by chromosome over the track's threads
+            kwargs['jobs'] = self.threads
+        elif self.type_.lower() in ('bam', 'bigbed'):
+            # Sorted with the track's threads and memory
+            kwargs.update(threads=self.threads, memory=self.memory or None,
+                          scratch=scratch)
+
+        if cache is None:
+            self._run_liftover(from_assembly, to_assembly, newfile, kwargs)
+        else:
+            chainfile = liftover.download_chainfile(from_assembly, to_assembly)
+            key = cache.key(self.processed, chainfile, self.type_,
+                            liftover.tool_version(self.type_, **kwargs))
+            with cache.lock(key):
+                if cache.get(key, newfile):
+                    log("Using cached liftover of {0}".format(self.processed))
+                else:
+                    self._run_liftover(
+                        from_assembly, to_assembly, newfile, kwargs)
+                    cache.put(key, newfile)
+
+        # Write the sentinel file to indicate genome we lifted over to.
+        sentinel = self._liftover_sentinel(from_assembly, to_assembly, newfile)
+        with open(sentinel, 'w') as fout:
+            pass
+
+    def _run_liftover(self, from_assembly, to_assembly, newfile, kwargs):
+        """
+        Lift over the processed file to `newfile`, passing `kwargs` to
+        `hubward.liftover.liftover`.
+        """
         tmp = tempfile.NamedTemporaryFile(delete=False).name
         log("Lift over {0} to {1}".format(self.processed, tmp))
         liftover.liftover(
-            from_assembly, to_assembly, self.processed, tmp, self.type_)
+            from_assembly, to_assembly, self.processed, tmp, self.type_,
+            **kwargs)
         utils.makedirs(os.path.dirname(newfile))
         log("Moving {0} to {1}".format(tmp, newfile))
         shutil.move(tmp, newfile)
@@ -219,44 +533,132 @@ class Data(object):
         if self.type_.lower() == 'bam':
             shutil.move(tmp + '.bai', newfile + '.bai')
 
-
         # CrossMap.py seems to `chmod go-rw` on lifted-over file. So we copy
         # permissions from the original one.
         shutil.copymode(self.processed, newfile)
 
-        # Write the sentinel file to indicate genome we lifted over to.
-        sentinel = self._liftover_sentinel(from_assembly, to_assembly, newfile)
-        with open(sentinel, 'w') as fout:
-            pass
+
+def _io_jobs(downloader):
+    """
+    When tracks share a download manager, allow as many download jobs to wait
+    on it at once as it has connections, independently of the number of
+    processing jobs. That way processing of each track starts as soon as its
+    own download lands.
+    """
+    if downloader is not None:
+        return downloader.max_connections * 2
+    return None
+
+
+def _process_batch(tracks):
+    """
+    Process tracks that share a script which supports batch mode.
+
+    The script is called once, as `script --batch <manifest>`, for all of
+    `tracks` that need updating. The manifest is a tab-delimited file with
+    one "original<TAB>processed" line per track. Each processed file is then
+    checked just as if the script had been called on it individually.
+    """
+    stale = []
+    for d in tracks:
+        reasons = d._needs_update()
+        if reasons:
+            d.why = reasons
+            stale.append(d)
+    if not stale:
+        return
+
+    script = stale[0].script
+    stale[0]._check_script()
+    manifest_fn = tempfile.NamedTemporaryFile(
+        delete=False, suffix='.batch.tsv').name
+    with open(manifest_fn, 'w') as fout:
+        for d in stale:
+            utils.makedirs(os.path.dirname(d.processed))
+            fout.write('{0.original}\t{0.processed}\n'.format(d))
+    for d in stale:
+        d._before = d._processed_stat()
+    cmds = [script, '--batch', manifest_fn]
+    log("Running {0} in batch mode on {1} tracks".format(script, len(stale)))
+    env = dict(os.environ)
+    env['HUBWARD_THREADS'] = str(max(d.threads for d in stale))
+    try:
+        subprocess.check_call(cmds, env=env)
+        errors = []
+        for d in stale:
+            try:
+                d._verify(cmds)
+            except ValueError as e:
+                errors.append(str(e))
+        if errors:
+            raise ValueError('\n'.join(errors))
+    finally:
+        os.unlink(manifest_fn)
 
 
 class Study(object):
-    def __init__(self, dirname):
+    def __init__(self, dirname, staleness='mtime', build_metadata=True,
+                 downloader=None, cache=None):
         """
         Represents a single metadata.yaml file.
 
         Parameters
         ----------
 
-        fn : filename of YAML- or JSON-formatted config file
+        dirname : directory containing metadata.yaml or metadata-builder.py
+
+        staleness : "mtime" | "hash"
+            How to decide whether processed files are out of date. "mtime"
+            compares modification times. "hash" compares content hashes
+            recorded in a manifest (see `hubward.manifest`), which is robust
+            to `git checkout`, `rsync -a`, and clock skew.
+
+        build_metadata : bool
+            If False, do not run metadata-builder.py; use the existing
+            metadata.yaml as-is.
+
+        downloader : hubward.download.DownloadManager or None
+            If provided, tracks download their sources through it.
+
+        cache : hubward.cache.DownloadCache or None
+            If provided, sources are shared with other studies via this
+            cache.
         """
+        if staleness not in ('mtime', 'hash'):
+            raise ValueError(
+                "staleness must be 'mtime' or 'hash', not {0}"
+                .format(staleness))
         self.dirname = dirname
-        self._build_metadata()
+        self.downloader = downloader
+        self.cache = cache
+        if build_metadata:
+            self._build_metadata()
         fn = os.path.join(self.dirname, 'metadata.yaml')
 
         if not os.path.exists(fn):
             raise ValueError("Can't find {0}".format(fn))
 
-        self.metadata = yaml.load(open(fn))
-        schema = yaml.load(utils.get_resource('metadata_schema.yaml'))
-        jsonschema.validate(self.metadata, schema)
+        self.metadata = hubward_metadata.load(fn, 'metadata_schema.yaml')
         self.study = self.metadata['study']
         self.label = self.metadata['study']['label']
 
         self.study.setdefault('short_label', self.label)
         self.study.setdefault('long_label', self.study['short_label'])
         self.study['PMID'] = str(self.study.get('PMID', ''))
-        self.tracks = [Data(d, self.dirname) for d in self.metadata['tracks']]
+        if staleness == 'hash':
+            self.manifest = manifest.Manifest(self.dirname)
+        else:
+            self.manifest = None
+        self.tracks = [
+            Data(d, self.dirname, manifest=self.manifest,
+                 downloader=downloader, cache=cache)
+            for d in self.metadata['tracks']
+        ]
+        sharing = {}
+        for d in self.tracks:
+            d.sharing = sharing.setdefault(
+                os.path.abspath(d.source_fn), [])
+            d.sharing.append(d)
 
         # If description is blank or missing, fill in the contents of the
         # README.
@@ -318,11 +720,211 @@ class Study(object):
             raise ValueError("Expected {0} but was not created by {1}"
                              .format(metadata, builder))
 
-    def process(self, force=False):
+    def process(self, force=False, jobs=1, workers=None, cores=None,
+                memory=None):
+        """
+        Process each track in the study.
+
+        Parameters
+        ----------
+        jobs : int
+            Number of tracks to process at once. If any tracks fail, the
+            remaining tracks are still processed and a ValueError listing all
+            failures is raised at the end.
+
+        workers : hubward.workers.WorkerPool or None
+            If provided, Python scripts that define a `process(source,
+            target)` function are called in these worker processes rather than
+            run as subprocesses.
+
+        cores, memory : int or None
+            When jobs > 1, limit the total threads and memory (in MB) of
+            tracks processed at once, based on the `resources` configured for
+            each track. See `hubward.scheduler.Scheduler`.
+        """
+        scheduler.check_jobs(jobs)
         log('Study: {0.study[label]}, in "{0.dirname}"'.format(self),
             style=Fore.BLUE)
+        if jobs == 1:
+            for tracks in self._batches():
+                if len(tracks) == 1 and not tracks[0].batch:
+                    tracks[0].process(workers)
+                else:
+                    _process_batch(tracks)
+            return
+
+        s = scheduler.Scheduler(
+            jobs, cores=cores, memory=memory,
+            io_jobs=_io_jobs(self.downloader))
+        self.add_jobs(s, composite=False, workers=workers)
+        s.run()
+
+    def _batches(self):
+        """
+        Returns a list of lists of tracks. Tracks configured with `batch: true`
+        that share a script are grouped together so they can be processed
+        with a single call to that script; every other track is in a list by
+        itself.
+        """
+        batches = []
+        by_script = {}
+        for d in self.tracks:
+            if not d.batch:
+                batches.append([d])
+                continue
+            script = os.path.abspath(d.script)
+            if script not in by_script:
+                by_script[script] = []
+                batches.append(by_script[script])
+            by_script[script].append(d)
+        return batches
+
+    def add_jobs(self, scheduler, composite=True, workers=None):
+        """
+        Add the jobs needed to process every track in this study to
+        a `hubward.scheduler.Scheduler`.
+
+        Tracks that share a batch-mode script are processed by a single job.
+
+        If `composite` is True, also add a job that builds the composite track
+        (stored as `self.composite`) as soon as all of this study's tracks have
+        been processed.
+
+        See `process` for `workers`.
+
+        Returns the names of the added jobs that nothing else depends on.
+        """
+        finals = []
+        for i, tracks in enumerate(self._batches()):
+            name = '{0}:{1}'.format(self.dirname, i)
+            if len(tracks) == 1 and not tracks[0].batch:
+                finals.append(tracks[0].add_jobs(scheduler, name, workers))
+            else:
+                finals.append(scheduler.add(
+                    name + ':batch',
+                    lambda tracks=tracks: _process_batch(tracks),
+                    tag=os.path.basename(tracks[0].script),
+                    threads=max(d.threads for d in tracks),
+                    memory=max(d.memory for d in tracks)))
+        if not composite:
+            return finals
+
+        def build_composite():
+            log('Building composite track for {0.study[label]}'.format(self),
+                style=Fore.BLUE)
+            self.composite = self.composite_track()
+
+        return [
+            scheduler.add(
+                '{0}:composite'.format(self.dirname), build_composite,
+                depends=finals, tag=self.label, threads=0)
+        ]
+
+    def liftover(self, from_assembly, to_assembly, newdir, jobs=1, cores=None,
+                 memory=None, scratch=None, cache=None):
+        """
+        Lift over every track in the study to `newdir`, and write a new
+        metadata.yaml there reflecting the liftover.
+
+        Parameters
+        ----------
+        from_assembly, to_assembly : str
+
+        newdir : str
+            Destination directory. Each track's lifted-over file goes to the
+            same path relative to `newdir` as its processed file has relative
+            to this study's directory.
+
+        jobs : int
+            Number of tracks to lift over at once. The chain file is
+            downloaded once beforehand.
+
+        cores, memory : int or None
+            Limit the total threads and memory (in MB) of tracks lifted over
+            at once, based on the `resources` configured for each track. See
+            `hubward.scheduler.Scheduler`.
+
+        scratch : str or None
+            Directory for temporary files while sorting BAM and bigBed
+            files. Each one is sorted with the threads and memory from its
+            track's `resources`.
+
+        cache : hubward.cache.LiftoverCache or None
+            See `Data.liftover`.
+
+        Tracks already lifted over (see `Data._needs_liftover`) are skipped.
+        If any track fails, the others are still lifted over, but the new
+        metadata.yaml is not written and a ValueError listing all failures
+        is raised.
+        """
+        scheduler.check_jobs(jobs)
+        dirname = self.dirname.rstrip(os.path.sep)
+        newdir = newdir.rstrip(os.path.sep)
         for d in self.tracks:
-            d.process()
+            if d.genome != from_assembly:
+                raise ValueError(
+                    '{0} has a configured genome of {1} but liftover '
+                    'requested from {2}.'
+                    .format(d.label, d.genome, from_assembly)
+                )
+
+        if self.tracks:
+            liftover.download_chainfile(from_assembly, to_assembly)
+
+        s = scheduler.Scheduler(jobs, cores=cores, memory=memory)
+        for i, d in enumerate(self.tracks):
+            outfile = d.processed.replace(dirname, newdir)
+            s.add(
+                '{0}:{1}:liftover'.format(dirname, i),
+                lambda d=d, outfile=outfile: d.liftover(
+                    from_assembly, to_assembly, outfile, scratch=scratch,
+                    cache=cache),
+                tag=d.label, threads=d.threads, memory=d.memory)
+        s.run()
+
+        # Only edit the metadata once all tracks have been lifted over
+        note = ('lifted over from {0} to {1}; see {2} for original'
+                .format(from_assembly, to_assembly, dirname))
+        for d in self.tracks:
+            # new assembly
+            d.obj['genome'] = to_assembly
+
+            # overwrite source fn and url to avoid re-running later
+            d.obj['source']['fn'] = note
+            d.obj['source']['url'] = note
+
+        # Note the liftover in the description
+        self.metadata['study']['description'] += (
+            '\nData were lifted over from {0} to {1}\n'
+            .format(from_assembly, to_assembly)
+        )
+
+        # Keep track of the original assembly for documentation purposes. If
+        # this study was consecutively lifted over, pull the original assembly
+        # and study data from the existing `liftover` section of the config.
+        previous = self.metadata['study'].get('liftover', {})
+        self.metadata['study']['liftover'] = {
+            'from_assembly': from_assembly,
+            'to_assembly': to_assembly,
+            'original_study': previous.get('original_study', dirname),
+            'original_assembly': previous.get(
+                'original_assembly', from_assembly),
+            'previous_study': dirname,
+        }
+
+        utils.makedirs(newdir)
+        with open(os.path.join(newdir, 'metadata.yaml'), 'w') as fout:
+            fout.write(
+                '# This config file was created when lifting over {0} from '
+                '{1} to {2}.\n\n'.format(dirname, from_assembly, to_assembly)
+            )
+            log('Writing new metadata to {0}'.format(fout.name))
+            yaml.dump(self.metadata, fout)
+
+        symlink = os.path.join(newdir, 'ORIGINAL-STUDY')
+        if os.path.lexists(symlink):
+            os.unlink(symlink)
+        os.symlink(os.path.abspath(dirname), symlink)
 
     def reference_section(self):
         """
@@ -350,6 +952,15 @@ class Study(object):
             {1}
             """).format(reference, pmid)
 
+    def documentation(self):
+        """
+        ReST source of the study's documentation: its description followed by
+        the reference section.
+        """
+        return (
+            self.metadata['study'].get('description', '') + '\n' +
+            self.reference_section())
+
     def composite_track(self):
         """
         Create a composite track ready to be added to a trackhub.TrackDb
@@ -360,9 +971,7 @@ class Study(object):
         bams = [i for i in self.tracks if i.type_ == 'bam']
 
         # Build the HTML docs
-        last_section = self.reference_section()
-        html_string = utils.reST_to_html(
-            self.metadata['study'].get('description', '') + '\n' + last_section)
+        html_string = utils.reST_to_html(self.documentation())
 
         sanitized_label = utils.sanitize(self.label, strict=True)
 
@@ -437,21 +1046,29 @@ class Study(object):
 
 
 class Group(object):
-    def __init__(self, fn):
-        self.group = yaml.load(open(fn))
+    def __init__(self, fn, staleness='mtime', build_metadata=True,
+                 downloader=None, cache=None):
+        self.group = hubward_metadata.load(fn, 'group_schema.yaml')
         self.filename = fn
+        self.downloader = downloader
+        self.cache = cache
         self.dirname = os.path.dirname(fn)
         self.group.setdefault('short_label', self.group['name'])
         self.group.setdefault('long_label', self.group['name'])
-
-        schema = yaml.load(utils.get_resource('group_schema.yaml'))
-        jsonschema.validate(self.group, schema)
         self.studies = [
-            Study(os.path.join(self.dirname, s))
+            Study(os.path.join(self.dirname, s), staleness=staleness,
+                  build_metadata=build_metadata, downloader=downloader,
+                  cache=cache)
             for s in self.group['studies']
         ]
 
-    def process(self):
+    def process(self, jobs=1, workers=None, cores=None, memory=None):
+        """
+        Process all studies and build the track hub.
+
+        See `Study.process` for the arguments.
+        """
+        scheduler.check_jobs(jobs)
         hub, genomes_file, genome_, trackdb = default_hub(
             hub_name=self.group['name'],
             genome=self.group['genome'],
@@ -461,12 +1078,32 @@ class Group(object):
         )
         hub.url = self.group['hub_url']
 
+        # Render any documentation that isn't cached yet in parallel, so that
+        # building each composite track finds it cached
+        utils.reST_to_html_many(
+            [study.documentation() for study in self.studies], jobs=jobs)
+
         # Process each study, and have it generate its own composite track to
         # be added to the trackdb.
+        if jobs == 1:
+            for study in self.studies:
+                study.process(workers=workers)
+                study.composite = study.composite_track()
+        else:
+            # All tracks from all studies are scheduled together, and each
+            # study's composite track is built as soon as its own tracks are
+            # done. A slow study therefore doesn't hold up the others.
+            s = scheduler.Scheduler(
+                jobs, cores=cores, memory=memory,
+                io_jobs=_io_jobs(self.downloader))
+            for study in self.studies:
+                study.add_jobs(s, workers=workers)
+            s.run()
+
+        # Add in the configured order so trackDb.txt is the same regardless of
+        # which study finished first.
         for study in self.studies:
-            study.process()
-            composite = study.composite_track()
-            trackdb.add_tracks(composite)
+            trackdb.add_tracks(study.composite)
 
 
         self.hub = hub
@@ -475,8 +1112,8 @@ class Group(object):
         self.trackdb = trackdb
 
     def upload(self, hub_only=False, host=None, user=None, rsync_options=None,
-               hub_remote=None):
-        self.process()
+               hub_remote=None, jobs=1):
+        self.process(jobs=jobs)
 
         if 'server' in self.group:
             host = host or self.group['server'].get('host')
@@ -0,0 +1,299 @@
+"""
+Module for running a graph of interdependent jobs with bounded concurrency.
+"""
+import time
+import threading
+from colorama import Fore
+from hubward.log import log, tagged
+
+
+def check_jobs(jobs):
+    """
+    Raise a ValueError unless `jobs` is a usable number of parallel jobs.
+    """
+    if jobs is None or int(jobs) < 1:
+        raise ValueError(
+            "Number of jobs must be at least 1, not {0}".format(jobs))
+
+
+# Default for Scheduler's `max_wait`, in seconds
+MAX_WAIT = 600
+
+
+class Scheduler(object):
+    def __init__(self, jobs=1, cores=None, memory=None, io_jobs=None,
+                 max_wait=MAX_WAIT):
+        """
+        Runs jobs as soon as the jobs they depend on have completed, with at
+        most `jobs` running at once.
+
+        Jobs are run in threads. This is intended for work that mostly
+        happens in subprocesses (processing scripts, downloads, UCSC tools),
+        so the GIL is not a bottleneck.
+
+        Parameters
+        ----------
+        jobs : int
+            Maximum number of jobs to run at the same time.
+
+        cores : int or None
+            If provided, the total `threads` of running jobs (see `add`) is
+            kept within this limit.
+
+        memory : int or None
+            If provided, the total `memory` (in MB) of running jobs is kept
+            within this limit.
+
+        io_jobs : int or None
+            If provided, jobs added with threads=0 (e.g., waiting on
+            downloads) are limited to this many at once instead, and do not
+            count against `jobs`.
+
+        max_wait : float or None
+            Seconds a job may be passed over (see below) before no further
+            jobs are started ahead of it. If None, a steady stream of small
+            jobs can hold up a large one indefinitely.
+
+        Jobs are started in the order they were added, except that a job that
+        doesn't fit in the remaining cores or memory is passed over in favor
+        of later ready jobs that do. Once it has waited `max_wait` seconds,
+        only jobs with threads=0 are started until it fits, so it runs at the
+        latest when the jobs already running finish. A job needing more than
+        the limits on its own is run when nothing else is running.
+        """
+        check_jobs(jobs)
+        self.jobs = jobs
+        self.io_jobs = io_jobs
+        self.max_wait = max_wait
+        self.cores = cores
+        self.memory = memory
+        self._order = []
+        self._funcs = {}
+        self._depends = {}
+        self._tags = {}
+        self._threads = {}
+        self._memory = {}
+        self.done = set()
+        self.failed = {}
+        self._cond = threading.Condition()
+
+    def add(self, name, func, depends=None, tag=None, threads=1, memory=0):
+        """
+        Add a job.
+
+        Parameters
+        ----------
+        name : str
+            Unique name for the job.
+
+        func : callable
+            Called with no arguments to run the job.
+
+        depends : list
+            Names of jobs that must complete successfully before this one
+            starts. If any of them fail, this job is skipped.
+
+        tag : str
+            If provided, log messages from this job are tagged with it (see
+            `hubward.log.tagged`).
+
+        threads : int
+            Number of cores the job is expected to keep busy. Use 0 for jobs
+            that mostly wait on I/O.
+
+        memory : int
+            Peak memory, in MB, the job is expected to use.
+
+        Returns `name`, so that it can be used in the `depends` of later jobs.
+        """
+        if name in self._funcs:
+            raise ValueError("Job {0} already added".format(name))
+        depends = list(depends or [])
+        for dep in depends:
+            if dep not in self._funcs:
+                raise ValueError(
+                    "Job {0} depends on unknown job {1}".format(name, dep))
+        self._order.append(name)
+        self._funcs[name] = func
+        self._depends[name] = depends
+        self._tags[name] = tag
+        self._threads[name] = threads
+        self._memory[name] = memory
+        return name
+
+    def _fits(self, name, running):
+        """
+        Whether job `name` can start alongside the jobs in `running`.
+        """
+        if self.io_jobs is not None:
+            io = self._threads[name] == 0
+            limit = self.io_jobs if io else self.jobs
+            if len([r for r in running
+                    if (self._threads[r] == 0) == io]) >= limit:
+                return False
+        elif len(running) >= self.jobs:
+            return False
+        # A job larger than the limits runs once nothing else is keeping
+        # the cores busy; downloads and other I/O jobs don't count, so that
+        # they can't hold it up.
+        if not [r for r in running if self._threads[r] > 0]:
+            return True
+        if self.cores is not None and (
+            sum(self._threads[r] for r in running) + self._threads[name] >
+            self.cores
+        ):
+            return False
+        if self.memory is not None and (
+            sum(self._memory[r] for r in running) + self._memory[name] >
+            self.memory
+        ):
+            return False
+        return True
+
+    def _start_ready(self, running, start):
+        """
+        Call `start(name)` for each ready job that fits, in order.
+        """
+        now = time.time()
+        starved = False
+        for name in list(self._ready):
+            if self.io_jobs is None and len(running) >= self.jobs:
+                break
+            io = self._threads[name] == 0
+            if starved and not io:
+                continue
+            if self._fits(name, running):
+                self._ready.remove(name)
+                self._waiting.pop(name, None)
+                running.add(name)
+                start(name)
+            elif not io:
+                since = self._waiting.setdefault(name, now)
+                if self.max_wait is not None and now - since >= self.max_wait:
+                    starved = True
+
+    def _prepare(self):
+        self._dependents = dict((name, []) for name in self._order)
+        self._unmet = {}
+        for name in self._order:
+            self._unmet[name] = len(self._depends[name])
+            for dep in self._depends[name]:
+                self._dependents[dep].append(name)
+        self._ready = [
+            name for name in self._order if self._unmet[name] == 0]
+
+        # When each ready job was first passed over
+        self._waiting = {}
+
+    def _succeed(self, name):
+        self.done.add(name)
+        for dependent in self._dependents[name]:
+            self._unmet[dependent] -= 1
+            if self._unmet[dependent] == 0:
+                self._ready.append(dependent)
+
+    def _run_job(self, name):
+        with tagged(self._tags[name]):
+            try:
+                self._funcs[name]()
+                error = None
+            except Exception as e:
+                log("{0} failed: {1}".format(name, e), style=Fore.RED)
+                error = e
+        with self._cond:
+            self._running.discard(name)
+            if error is None:
+                self._succeed(name)
+            else:
+                self._fail(name, error)
+            self._cond.notify()
+
+    def _fail(self, name, error):
+        """
+        Record a failure and skip everything downstream of it.
+        """
+        self.failed[name] = error
+        for dependent in self._dependents[name]:
+            if dependent not in self.failed:
+                self._fail(
+                    dependent,
+                    ValueError("skipped because {0} failed".format(name)))
+
+    def run(self):
+        """
+        Run all jobs.
+
+        A failed job does not stop jobs that don't depend on it. Once
+        everything that can run has run, raises a ValueError describing all
+        failures.
+        """
+        self._prepare()
+        self._running = set()
+
+        def start(name):
+            t = threading.Thread(target=self._run_job, args=(name,))
+            t.daemon = True
+            t.start()
+
+        with self._cond:
+            while self._ready or self._running:
+                self._start_ready(self._running, start)
+
+                # Use a timeout so that KeyboardInterrupt is still delivered
+                # under Python 2.
+                self._cond.wait(1)
+
+        if self.failed:
+            raise ValueError(
+                Fore.RED +
+                "{0} of {1} jobs failed:\n\n{2}".format(
+                    len(self.failed), len(self._order),
+                    '\n'.join('{0}: {1}'.format(name, self.failed[name])
+                              for name in self._order
+                              if name in self.failed)) +
+                Fore.RESET)
+
+    def plan(self):
+        """
+        Simulate how jobs would be packed, without running anything.
+
+        Assumes every job takes the same amount of time, so jobs are started
+        in "waves" and everything in a wave finishes before the next one
+        starts. Real runs will differ, but this shows which jobs are able to
+        share the machine under the configured limits.
+
+        Returns a list of waves, each a list of job names.
+        """
+        self._prepare()
+        waves = []
+        while self._ready:
+            wave = set()
+            order = []
+            self._start_ready(wave, order.append)
+            for name in order:
+                self._succeed(name)
+            waves.append(order)
+        return waves
+
+    def format_plan(self):
+        """
+        Returns the output of `plan()` as text, listing each job that uses any
+        threads or memory.
+        """
+        lines = []
+        for i, wave in enumerate(self.plan()):
+            busy = [
+                name for name in wave
+                if self._threads[name] or self._memory[name]]
+            if not busy:
+                continue
+            lines.append('wave {0}: {1} threads, {2} MB'.format(
+                i + 1,
+                sum(self._threads[name] for name in wave),
+                sum(self._memory[name] for name in wave)))
+            for name in busy:
+                lines.append(
+                    '    {0} ({1}): threads={2}, memory={3} MB'.format(
+                        self._tags[name], name,
+                        self._threads[name], self._memory[name]))
+        return '\n'.join(lines)
@@ -0,0 +1,176 @@
+"""
+Module for reporting which tracks are out of date, without processing
+anything.
+"""
+import os
+import json
+try:
+    from os import scandir
+except ImportError:
+    # Python 2
+    from scandir import scandir
+
+
+class StatCache(object):
+    def __init__(self):
+        """
+        Caches the results of filesystem lookups so that each path is only
+        stat'ed once, even when many tracks share the same script or data
+        directory.
+
+        Directories are listed in one go with `scandir`, so checking whether
+        files exist does not require a stat call per file.
+        """
+        self._dirs = {}
+        self._stats = {}
+        self._lstats = {}
+
+    def _entries(self, dirname):
+        if dirname not in self._dirs:
+            try:
+                self._dirs[dirname] = dict(
+                    (entry.name, entry) for entry in scandir(dirname))
+            except OSError:
+                self._dirs[dirname] = {}
+        return self._dirs[dirname]
+
+    def _entry(self, path):
+        path = os.path.abspath(path)
+        return self._entries(os.path.dirname(path)).get(
+            os.path.basename(path))
+
+    def lstat(self, path):
+        """
+        Like `os.lstat`.
+        """
+        path = os.path.abspath(path)
+        if path not in self._lstats:
+            entry = self._entry(path)
+            if entry is None:
+                self._lstats[path] = OSError(
+                    2, 'No such file or directory', path)
+            else:
+                self._lstats[path] = entry.stat(follow_symlinks=False)
+        result = self._lstats[path]
+        if isinstance(result, OSError):
+            raise result
+        return result
+
+    def stat(self, path):
+        """
+        Like `os.stat`.
+        """
+        path = os.path.abspath(path)
+        if path not in self._stats:
+            entry = self._entry(path)
+            if entry is None:
+                self._stats[path] = OSError(
+                    2, 'No such file or directory', path)
+            elif not entry.is_symlink():
+                self._stats[path] = self.lstat(path)
+            else:
+                try:
+                    self._stats[path] = entry.stat()
+                except OSError as e:
+                    self._stats[path] = e
+        result = self._stats[path]
+        if isinstance(result, OSError):
+            raise result
+        return result
+
+    def exists(self, path):
+        """
+        Like `os.path.exists`.
+        """
+        entry = self._entry(path)
+        if entry is None:
+            return False
+        if not entry.is_symlink():
+            return True
+        try:
+            self.stat(path)
+            return True
+        except OSError:
+            return False
+
+
+def track_status(track, stats):
+    """
+    Decides whether a track is up to date in the same way as
+    `hubward.models.Data._needs_update` (using modification times), but
+    without downloading or logging anything.
+
+    Parameters
+    ----------
+    track : hubward.models.Data
+
+    stats : StatCache
+
+    Returns
+    -------
+    A tuple of (status, reasons), where status is one of "up-to-date",
+    "stale", or "missing" (the processed file does not exist yet) and reasons
+    is a list of strings.
+    """
+    if stats.exists(os.path.join(track.reldir, 'ORIGINAL-STUDY')):
+        return 'up-to-date', ['lifted over from another study']
+
+    reasons = []
+    if not stats.exists(track.original):
+        reasons.append("{0.original} does not exist; would download"
+                       .format(track))
+    try:
+        reasons.extend(track._mtime_reasons(
+            exists=stats.exists, stat=stats.stat, lstat=stats.lstat))
+    except OSError as e:
+        reasons.append("{0.strerror}: {0.filename}".format(e))
+
+    if not stats.exists(track.processed):
+        return 'missing', reasons
+    if reasons:
+        return 'stale', reasons
+    return 'up-to-date', reasons
+
+
+def status(studies):
+    """
+    Returns a list of dicts, one for each track in each of `studies`, with
+    keys "study", "label", "processed", "status", and "reasons".
+
+    See `track_status` for details.
+    """
+    stats = StatCache()
+    results = []
+    for study in studies:
+        for track in study.tracks:
+            verdict, reasons = track_status(track, stats)
+            results.append(dict(
+                study=study.label,
+                label=track.label,
+                processed=track.processed,
+                status=verdict,
+                reasons=reasons))
+    return results
+
+
+def format_table(results):
+    """
+    Format the output of `status` as a plain-text table, followed by a count
+    of tracks in each status.
+    """
+    columns = ['status', 'study', 'label', 'processed']
+    widths = dict(
+        (c, max([len(c)] + [len(r[c]) for r in results])) for c in columns)
+    lines = ['  '.join(c.ljust(widths[c]) for c in columns)]
+    lines.append('  '.join('-' * widths[c] for c in columns))
+    for r in results:
+        lines.append('  '.join(r[c].ljust(widths[c]) for c in columns))
+    lines.append('')
+    for verdict in ['up-to-date', 'stale', 'missing']:
+        lines.append('{0}: {1}'.format(
+            verdict, len([r for r in results if r['status'] == verdict])))
+    return '\n'.join(lines)
+
+
+def format_json(results):
+    return json.dumps(results, indent=2)
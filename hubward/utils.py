@@ -1,100 +1,42 @@
 import subprocess
 import pybedtools
 import os
+import errno
 import pkg_resources
 import tempfile
 from docutils.core import publish_string
 import bleach
-import pycurl
 import pybedtools
 import string
-import tarfile
-
-
-# The following license is from conda_build. Code from conda_build is used in
-# the download, tar_xf, and unzip functions.
-#
-# ----------------------------------------------------------------------------
-# Except where noted below, conda is released under the following terms:
-#
-# (c) 2012 Continuum Analytics, Inc. / http://continuum.io
-# All Rights Reserved
-#
-# Redistribution and use in source and binary forms, with or without
-# modification, are permitted provided that the following conditions are met:
-#     * Redistributions of source code must retain the above copyright
-#       notice, this list of conditions and the following disclaimer.
-#     * Redistributions in binary form must reproduce the above copyright
-#       notice, this list of conditions and the following disclaimer in the
-#       documentation and/or other materials provided with the distribution.
-#     * Neither the name of Continuum Analytics, Inc. nor the
-#       names of its contributors may be used to endorse or promote products
-#       derived from this software without specific prior written permission.
-#
-# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
-# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
-# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
-# DISCLAIMED. IN NO EVENT SHALL CONTINUUM ANALYTICS BE LIABLE FOR ANY
-# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
-# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
-# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
-# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
-# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
-# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
-#
-#
-# Exceptions
-# ==========
-#
-# versioneer.py is Public Domain
-# ----------------------------------------------------------------------------
-
-def download(url, outfile):
-    with open(outfile, 'wb') as f:
-        c = pycurl.Curl()
-        c.setopt(c.URL, url)
-        c.setopt(c.WRITEDATA, f)
-        c.perform()
-        c.close()
-
-
-def _tar_xf(tarball, dir_path, mode='r:*'):
-    # From conda_build, see license above.
-    if tarball.lower().endswith('.tar.z'):
-        uncompress = external.find_executable('uncompress')
-        if not uncompress:
-            sys.exit("""\
-uncompress is required to unarchive .z source files.
-""")
-        subprocess.check_call([uncompress, '-f', tarball])
-        tarball = tarball[:-2]
-    if tarball.endswith('.tar.xz'):
-        unxz = external.find_executable('unxz')
-        if not unxz:
-            sys.exit("""\
-unxz is required to unarchive .xz source files.
-""")
-
-        subprocess.check_call([unxz, '-f', '-k', tarball])
-        tarball = tarball[:-3]
-    t = tarfile.open(tarball, mode)
-    t.extractall(path=dir_path)
-    t.close()
-
-
-def _unzip(zip_path, dir_path):
-    # From conda_build, see license above.
-    z = zipfile.ZipFile(zip_path)
-    for name in z.namelist():
-        if name.endswith('/'):
-            continue
-        path = join(dir_path, *name.split('/'))
-        dp = dirname(path)
-        if not isdir(dp):
-            os.makedirs(dp)
-        with open(path, 'wb') as fo:
-            fo.write(z.read(name))
-    z.close()
+import io
+import hashlib
+import threading
+import collections
+import multiprocessing
+import numpy as np
+from hubward import decompress
+from hubward.log import log
+
+try:
+    # Python 2, where lines may also be unicode
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+def download(url, outfile, refresh=False):
+    """
+    Download `url` to `outfile`, resuming a previously interrupted download
+    if there is one.
+
+    If `refresh` is True and `outfile` exists, it is only downloaded again if
+    it changed upstream. Returns True if `outfile` was (re)written.
+
+    See `hubward.download.Transfer` for details.
+    """
+    # Imported here because hubward.download itself uses this module
+    from hubward.download import Transfer
+    return Transfer(url, outfile, refresh=refresh).perform()
 
 
 def make_executable(filename):
@@ -111,17 +53,66 @@ def makedirs(dirnames):
     if isinstance(dirnames, str):
         dirnames = [dirnames]
     for dirname in dirnames:
-        if not os.path.exists(dirname):
+        try:
             os.makedirs(dirname)
+        except OSError as e:
+            # Another process or thread may have created it in the meantime
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def cache_dir():
+    """
+    Directory for files shared across studies (chain files, downloads).
+
+    Uses the HUBWARD_CACHE_DIR environment variable if set, otherwise
+    ~/.hubward_cache.
+    """
+    return os.environ.get(
+        'HUBWARD_CACHE_DIR', os.path.expanduser('~/.hubward_cache'))
+
+
+def parse_memory(value):
+    """
+    Convert a memory amount to an integer number of MB.
+
+    `value` can be a number (already in MB) or a string with an optional
+    K, M, G, or T suffix, e.g., "500M", "30G", or "1.5G".
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = value.strip().upper().rstrip('B')
+    factors = {'K': 1. / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+    if value and value[-1] in factors:
+        return int(float(value[:-1]) * factors[value[-1]])
+    return int(float(value))
+
+
+def machine_memory():
+    """
+    Total physical memory of this machine in MB, or None if it can't be
+    determined.
+    """
+    try:
+        return (
+            os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') //
+            (1024 * 1024))
+    except (ValueError, OSError, AttributeError):
+        return None
+
 
+def unpack(filename, dest, members=None):
+    """
+    Extract archive `filename` into directory `dest`. Files that aren't
+    archives are left alone.
 
-def unpack(filename, dest):
-    if filename.lower().endswith(
-        ('.tar.gz', '.tar.bz2', '.tgz', '.tar.xz', '.tar', 'tar.z')
-    ):
-        _tar_xf(filename, dest)
-    elif filename.lower().endswith('.zip'):
-        _unzip(filename, dest)
+    If `members` is a list of paths within the archive, only those are
+    extracted (see `hubward.archive.extract`).
+    """
+    # Imported here because hubward.archive itself uses this module
+    from hubward import archive
+    if archive.is_archive(filename):
+        archive.extract(filename, dest, members=members)
 
 
 def link_is_newer(x, y):
@@ -157,13 +148,17 @@ def get_resource(fn, as_tempfile=False):
     return tmp
 
 
-def reST_to_html(s):
-    """
-    Convert ReST-formatted string `s` into HTML.
+# Bump when `_render_html` changes, so cached HTML is rendered again
+HTML_CACHE_VERSION = 1
 
-    Output is intended for uploading to UCSC configuration pages, so this uses
-    a whitelist approach for HTML tags.
-    """
+# Number of rendered HTML strings remembered in-process
+HTML_LRU_SIZE = 1024
+
+_html_lru = collections.OrderedDict()
+_html_lock = threading.Lock()
+
+
+def _render_html(s):
     html = publish_string(
         source=s,
         writer_name='html',
@@ -182,6 +177,108 @@ def reST_to_html(s):
     return bleach.clean(html, tags=safe, strip=True, attributes=attributes)
 
 
+def _html_key(s):
+    """
+    Hash of `s` and of everything else that affects how it is rendered.
+    """
+    import docutils
+    h = hashlib.sha1()
+    h.update('{0} {1} {2}\n'.format(
+        HTML_CACHE_VERSION, docutils.__version__,
+        bleach.__version__).encode('utf-8'))
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    h.update(s)
+    return h.hexdigest()
+
+
+def _html_cache_path(key):
+    return os.path.join(cache_dir(), 'html', key[:2], key + '.html')
+
+
+def _html_lookup(key):
+    """
+    Rendered HTML for `key` from the in-process LRU or from disk, or None.
+    """
+    with _html_lock:
+        if key in _html_lru:
+            html = _html_lru.pop(key)
+            _html_lru[key] = html
+            return html
+    try:
+        with io.open(_html_cache_path(key), encoding='utf-8') as f:
+            html = f.read()
+    except (IOError, OSError):
+        return None
+    _html_remember(key, html)
+    return html
+
+
+def _html_remember(key, html):
+    with _html_lock:
+        _html_lru.pop(key, None)
+        _html_lru[key] = html
+        while len(_html_lru) > HTML_LRU_SIZE:
+            _html_lru.popitem(last=False)
+
+
+def _html_store(key, html):
+    _html_remember(key, html)
+    fn = _html_cache_path(key)
+    tmp = fn + '.{0}.tmp'.format(os.getpid())
+    try:
+        makedirs(os.path.dirname(fn))
+        with io.open(tmp, 'w', encoding='utf-8') as f:
+            f.write(html)
+        os.rename(tmp, fn)
+    except (IOError, OSError):
+        # e.g., a read-only cache; the HTML is just rendered again next time
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def reST_to_html(s):
+    """
+    Convert ReST-formatted string `s` into HTML.
+
+    Output is intended for uploading to UCSC configuration pages, so this uses
+    a whitelist approach for HTML tags.
+
+    Results are cached in `<cache_dir()>/html`, keyed by a hash of `s` and
+    the docutils and bleach versions, with the most recently used ones also
+    kept in memory.
+    """
+    key = _html_key(s)
+    html = _html_lookup(key)
+    if html is None:
+        html = _render_html(s)
+        _html_store(key, html)
+    return html
+
+
+def reST_to_html_many(strings, jobs=1):
+    """
+    Like `reST_to_html` for each of `strings`, but renders those that aren't
+    cached using `jobs` processes. Returns a list of HTML strings.
+    """
+    keys = [_html_key(s) for s in strings]
+    results = [_html_lookup(key) for key in keys]
+    missing = {}
+    for s, key, html in zip(strings, keys, results):
+        if html is None:
+            missing.setdefault(key, s)
+    if missing:
+        log('Rendering documentation for {0} studies'.format(len(missing)))
+        rendered = dict(zip(
+            missing, _ordered_map(_render_html, missing.values(), jobs)))
+        for key, html in rendered.items():
+            _html_store(key, html)
+        results = [
+            rendered[key] if html is None else html
+            for key, html in zip(keys, results)]
+    return results
+
+
 def sanitize(s, strict=False):
     """
     If strict, only allow letters and digits -- spaces will be stripped.
@@ -252,7 +349,194 @@ def smart_colormap(vmin, vmax, color_high='#b11902', hue_low=0.6):
     return new_cmap
 
 
-def fix_macs_wig(fn, genome, output=None, add_chr=False, to_ignore=None):
+# Size of each block read by `fix_macs_wig` and `colored_bigbed`
+BLOCK_SIZE = 16 * 1024 * 1024
+
+WIG_FORMATS = ('wig', 'bedgraph', 'bigwig')
+
+
+def _line_blocks(f, chunksize):
+    """
+    Reads file-like object `f` (in binary mode) in blocks of about
+    `chunksize` bytes, and yields them cut at the end of a line. Every block
+    ends with a newline.
+    """
+    rest = b''
+    while True:
+        chunk = f.read(chunksize)
+        block = rest + chunk
+        if chunk:
+            # Only whole lines; the rest is kept for the next block
+            cut = block.rfind(b'\n') + 1
+            block, rest = block[:cut], block[cut:]
+            if not block:
+                continue
+        elif not block:
+            break
+        elif not block.endswith(b'\n'):
+            block += b'\n'
+        yield block
+        if not chunk:
+            break
+
+
+def _wig_tasks(f, sizes, add_chr, to_ignore, output_format, chunksize):
+    """
+    Reads WIG file-like object `f` (in binary mode) in blocks of about
+    `chunksize` bytes, and yields one task for `_fix_wig_chunk` per run of
+    data lines within a block.
+
+    Header lines are found with NumPy by their first character, so only
+    they, and not the data lines, are looked at in Python.
+    """
+    section = None
+    for block in _line_blocks(f, chunksize):
+        arr = np.frombuffer(block, dtype=np.uint8)
+        ends = np.flatnonzero(arr == 10) + 1
+        starts = np.concatenate([[0], ends[:-1]])
+        first = arr[starts]
+        letter = (first | 32) - 97
+        special = np.flatnonzero(
+            (letter >= 0) & (letter < 26) |
+            (first == ord('#')) | (first == 10) | (first == 13))
+
+        prev = 0
+        for i in list(special) + [len(starts)]:
+            if i > prev:
+                if section is None:
+                    raise ValueError(
+                        "Data line before any variableStep or fixedStep "
+                        "line: {0!r}".format(block[starts[prev]:ends[prev]]))
+                if section['chrom'] is not None:
+                    yield (
+                        block[starts[prev]:ends[i - 1]], section['header'],
+                        section['kind'], section['chrom'], section['size'],
+                        section['start'], section['step'], section['span'],
+                        section['count'], output_format)
+                    section['header'] = None
+                section['count'] += i - prev
+            if i == len(starts):
+                break
+            prev = i + 1
+            line = block[starts[i]:ends[i]].decode('utf-8').strip()
+            if not line or line.startswith(('track', 'browser', '#')):
+                continue
+            section = _wig_section(line, sizes, add_chr, to_ignore)
+
+
+def _wig_section(line, sizes, add_chr, to_ignore):
+    """
+    Parse a variableStep or fixedStep line into a dict. Its "chrom" is None
+    if the chromosome is to be ignored.
+    """
+    fields = line.split()
+    kind = fields[0]
+    if kind not in ('variableStep', 'fixedStep'):
+        raise ValueError("Unexpected line in WIG file: {0}".format(line))
+    params = dict(x.split('=', 1) for x in fields[1:])
+    chrom = params['chrom']
+    if add_chr:
+        chrom = 'chr' + chrom
+    header = ' '.join(
+        [kind] + ['chrom=' + chrom if x.startswith('chrom=') else x
+                  for x in fields[1:]]) + '\n'
+    section = dict(
+        kind=kind, chrom=chrom, header=header, count=0,
+        size=None, start=None, step=None, span=int(params.get('span', 1)))
+    if kind == 'fixedStep':
+        section['start'] = int(params['start'])
+        section['step'] = int(params.get('step', 1))
+    if chrom in to_ignore:
+        section['chrom'] = None
+    elif chrom not in sizes:
+        raise ValueError(
+            "Chromosome {0} is not in the genome; add it to `to_ignore` to "
+            "skip it".format(chrom))
+    else:
+        section['size'] = sizes[chrom]
+    return section
+
+
+def _fix_wig_chunk(task):
+    """
+    Parse a run of data lines from one section of a WIG file, and drop those
+    that extend past the end of the chromosome.
+
+    Returns the output (bytes), the number of lines dropped, the chromosome,
+    and the first and last start positions (0-based) and whether they were
+    sorted.
+    """
+    (data, header, kind, chrom, size, start, step, span, offset,
+     output_format) = task
+    values = np.fromstring(data, sep=' ')
+    n = data.count(b'\n')
+    if kind == 'variableStep':
+        if len(values) != 2 * n:
+            raise ValueError(
+                "Expected two values per variableStep line for {0}"
+                .format(chrom))
+        values = values.reshape(-1, 2)
+        pos = values[:, 0].astype(np.int64)
+        values = values[:, 1]
+    else:
+        if len(values) != n:
+            raise ValueError(
+                "Expected one value per fixedStep line for {0}".format(chrom))
+        pos = start + step * (offset + np.arange(n, dtype=np.int64))
+
+    keep = pos + span < size
+    dropped = n - int(keep.sum())
+    pos = pos[keep]
+    bounds = (None, None, True)
+    if len(pos):
+        bounds = (pos[0] - 1, pos[-1] - 1, bool(np.all(pos[1:] >= pos[:-1])))
+
+    if output_format == 'wig':
+        if dropped:
+            # Copy the lines that are kept as-is, a run at a time
+            arr = np.frombuffer(data, dtype=np.uint8)
+            ends = np.flatnonzero(arr == 10) + 1
+            starts = np.concatenate([[0], ends[:-1]])
+            edges = np.flatnonzero(np.diff(np.concatenate(
+                [[False], keep, [False]]).astype(np.int8)))
+            data = b''.join(
+                data[starts[i]:ends[j - 1]]
+                for i, j in zip(edges[::2], edges[1::2]))
+        if header is not None:
+            data = header.encode('utf-8') + data
+        return (data, dropped, chrom) + bounds
+
+    lines = [
+        '{0}\t{1}\t{2}\t{3!r}\n'.format(chrom, p - 1, p - 1 + span, v)
+        for p, v in zip(pos.tolist(), values[keep].tolist())]
+    return (''.join(lines).encode('utf-8'), dropped, chrom) + bounds
+
+
+def _ordered_map(func, tasks, jobs):
+    """
+    Like `Pool.imap`, but with at most 2 * `jobs` tasks in flight, so that
+    `tasks` (e.g., blocks of a file) are not all read into memory at once.
+    """
+    if jobs <= 1:
+        for task in tasks:
+            yield func(task)
+        return
+    pool = multiprocessing.Pool(jobs)
+    try:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(pool.apply_async(func, (task,)))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def fix_macs_wig(fn, genome, output=None, add_chr=False, to_ignore=None,
+                 output_format='wig', jobs=1, chunksize=BLOCK_SIZE):
     """
     wig files created by MACS often are extended outside the chromsome ranges.
     This function edits an input WIG file to fit within the chromosome
@@ -266,50 +550,95 @@ def fix_macs_wig(fn, genome, output=None, add_chr=False, to_ignore=None):
     Returns the output filename.
 
     fn : str
-        Input WIG filename. Can be gzipped, if extension ends in .gz.
+        Input WIG filename, with variableStep and/or fixedStep sections. Can
+        be compressed (see `hubward.decompress`).
 
     genome : str or dict
+        Assembly name (see `hubward.genomes`), or a dict of
+        {chromosome: size}.
 
     output : str or None
         If None, writes to temp file
 
     to_ignore : list
         List of chromosomes to ignore.
-    """
 
+    output_format : str
+        "wig" (the cleaned-up WIG file), "bedgraph", or "bigwig". bigWig
+        output needs `genome` to be an assembly name.
+
+    jobs : int
+        Number of processes parsing blocks of the file.
+
+    chunksize : int
+        Approximate size in bytes of each block.
+
+    The file is parsed a block at a time with NumPy rather than a line at
+    a time; when writing WIG, lines that fit within the chromosome are copied
+    unchanged.
+    """
+    if output_format not in WIG_FORMATS:
+        raise ValueError(
+            "output_format must be one of {0}, not {1}"
+            .format(', '.join(WIG_FORMATS), output_format))
+    if output_format == 'bigwig' and isinstance(genome, dict):
+        raise ValueError("bigWig output needs an assembly name as `genome`")
     if output is None:
         output = pybedtools.BedTool._tmp()
     if to_ignore is None:
         to_ignore = []
-    genome = pybedtools.chromsizes(genome)
-    with open(output, 'w') as fout:
-        if fn.endswith('.gz'):
-            f = gzip.open(fn)
-        else:
-            f = open(fn)
-        for line in f:
-            if line.startswith('track'):
-                continue
-            if line.startswith('variableStep'):
-                a, b, c = line.strip().split()
-                prefix, chrom = b.split('=')
-                if add_chr:
-                    chrom = 'chr' + chrom
-                if chrom in to_ignore:
-                    continue
-                fout.write(' '.join([a, prefix + '=' + chrom, c]) + '\n')
-                span = int(c.split('=')[1])
-                continue
-            pos, val = line.strip().split()
-            if chrom in to_ignore:
-                continue
-            if (int(pos) + span) >= genome[chrom][1]:
-                continue
-            fout.write(line)
+    to_ignore = set(to_ignore)
+    assembly = genome
+    if not isinstance(genome, dict):
+        from hubward import genomes
+        genome = genomes.chromsizes(genome)
+
+    target = output
+    if output_format == 'bigwig':
+        fd, target = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(output)),
+            prefix='.' + os.path.basename(output), suffix='.bedGraph')
+        os.close(fd)
+
+    total = 0
+    is_sorted = True
+    last = None
+    try:
+        with decompress.open_stream(fn) as f:
+            with open(target, 'wb') as fout:
+                tasks = _wig_tasks(
+                    f, genome, add_chr, to_ignore, output_format, chunksize)
+                for data, dropped, chrom, first_start, last_start, ordered in (
+                        _ordered_map(_fix_wig_chunk, tasks, jobs)):
+                    fout.write(data)
+                    total += dropped
+                    if first_start is None or not is_sorted:
+                        continue
+                    # bedGraphToBigWig wants lines sorted as
+                    # `sort -k1,1 -k2,2n` would
+                    if last is not None:
+                        if chrom == last[0]:
+                            ordered = ordered and first_start >= last[1]
+                        else:
+                            ordered = ordered and chrom > last[0]
+                    is_sorted = ordered
+                    last = (chrom, last_start)
+        if total:
+            log('Dropped {0} lines of {1} extending past the end of their '
+                'chromosome'.format(total, fn))
+        if output_format != 'wig' and not is_sorted:
+            sort_bed(target, threads=jobs,
+                     tmpdir=os.path.dirname(os.path.abspath(target)))
+        if output_format == 'bigwig':
+            bigwig(target, assembly, output)
+    finally:
+        if target != output and os.path.exists(target):
+            os.unlink(target)
     return output
 
 
-def colored_bigbed(x, color, genome, target, autosql=None, bedtype=None):
+def colored_bigbed(x, color, genome, target, autosql=None, bedtype=None,
+                   chunksize=BLOCK_SIZE):
     """
     if color is "smart", then use metaseq's smart colormap centered on zero.
 
@@ -317,24 +646,119 @@ def colored_bigbed(x, color, genome, target, autosql=None, bedtype=None):
 
     assumes that you have scores in BedTool x; this will zero all scores in the
     final bigbed
+
+    `x` can also be a filename (optionally compressed). It needs at least
+    9 fields, since the colors go in the itemRgb field.
+
+    The file is read twice, a block of about `chunksize` bytes at a time:
+    once for the range of scores, and once to color the features by looking
+    up their normalized scores in a table of the colormap's RGB values.
+    Features are sorted afterwards by `sort_bed`, and only if they weren't
+    already sorted.
     """
-    from pybedtools.featurefuncs import add_color
-    norm = x.colormap_normalize()
+    if isinstance(x, string_types):
+        if not os.path.exists(x):
+            raise ValueError("{0} does not exist".format(x))
+        fn = x
+    else:
+        fn = getattr(x, 'fn', None)
+        if not isinstance(fn, string_types) or not os.path.exists(fn):
+            fn = x.saveas().fn
+
+    vmin = vmax = None
+    for lines in _bed_chunks(fn, chunksize):
+        scores = _scores(lines)
+        if len(scores):
+            lo, hi = scores.min(), scores.max()
+            vmin = lo if vmin is None else min(vmin, lo)
+            vmax = hi if vmax is None else max(vmax, hi)
+    if vmin is None:
+        raise ValueError("No features in {0}".format(fn))
+
     if color == 'smart':
-        cmap = smart_colormap(norm.vmin, norm.vmax)
+        cmap = smart_colormap(vmin, vmax)
     else:
         cmap = singlecolormap(color)
+    lut = np.array([
+        ','.join(str(int(c * 255)) for c in rgba[:3])
+        for rgba in cmap(np.arange(cmap.N))], dtype=object)
 
-    def func(f):
-        f = add_color(f, cmap, norm)
-        f.score = '0'
-        return f
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(target)),
+        prefix='.' + os.path.basename(target), suffix='.bed')
+    try:
+        is_sorted = True
+        last = None
+        field_count = None
+        with os.fdopen(fd, 'wb') as fout:
+            for lines in _bed_chunks(fn, chunksize):
+                fields = [line.split(b'\t') for line in lines]
+                if any(len(f) < 9 for f in fields):
+                    raise ValueError(
+                        "colored_bigbed needs at least 9 fields in {0}"
+                        .format(fn))
+                if field_count is None:
+                    field_count = len(fields[0])
+                scores = np.array([f[4] for f in fields], dtype=float)
+                colors = lut[_colormap_index(scores, vmin, vmax, cmap.N)]
+                for f, rgb in zip(fields, colors):
+                    f[4] = b'0'
+                    f[8] = rgb.encode('ascii')
+                fout.write(b'\n'.join(b'\t'.join(f) for f in fields) + b'\n')
+
+                if is_sorted:
+                    chroms = np.array([f[0] for f in fields])
+                    starts = np.array([int(f[1]) for f in fields])
+                    if last is not None:
+                        chroms = np.concatenate([[last[0]], chroms])
+                        starts = np.concatenate([[last[1]], starts])
+                    same = chroms[1:] == chroms[:-1]
+                    is_sorted = bool(np.all(
+                        np.where(same, starts[1:] >= starts[:-1],
+                                 chroms[1:] > chroms[:-1])))
+                    last = (chroms[-1], starts[-1])
+        if not is_sorted:
+            sort_bed(tmp, tmpdir=os.path.dirname(tmp))
+        if bedtype is None:
+            bedtype = 'bed{0}'.format(field_count)
+        bigbed(tmp, genome=genome, output=target, _as=autosql,
+               bedtype=bedtype)
+    finally:
+        os.unlink(tmp)
+
+
+def _bed_chunks(fn, chunksize):
+    """
+    Yields lists of the lines (bytes, without newlines) of a BED file,
+    skipping track, browser, and comment lines.
+    """
+    with decompress.open_stream(fn) as f:
+        for block in _line_blocks(f, chunksize):
+            lines = [
+                line for line in block.splitlines()
+                if line.strip() and
+                not line.startswith((b'track', b'browser', b'#'))]
+            if lines:
+                yield lines
+
+
+def _scores(lines):
+    """
+    Scores (the fifth field) of BED lines as an array.
+    """
+    return np.array([line.split(b'\t', 5)[4] for line in lines],
+                    dtype=float)
 
-    x = x\
-        .sort()\
-        .each(func)\
-        .saveas()
-    bigbed(x, genome=genome, output=target, _as=autosql, bedtype=bedtype)
+
+def _colormap_index(values, vmin, vmax, n):
+    """
+    Index into a colormap of `n` colors for each of `values`, as
+    a matplotlib colormap would pick it after normalizing to [vmin, vmax].
+    """
+    if vmax == vmin:
+        return np.zeros(len(values), dtype=int)
+    idx = (values - vmin) / (vmax - vmin) * n
+    return np.clip(idx, 0, n - 1).astype(int)
 
 
 def singlecolormap(color, func=None, n=64):
@@ -382,11 +806,12 @@ def add_chr(f):
 
 
 def chromsizes(assembly):
-    url = ("http://hgdownload.cse.ucsc.edu/goldenPath/"
-           "{0}/bigZips/{0}.chrom.sizes")
-    dest = tempfile.NamedTemporaryFile(delete=False).name + '.chromsizes'
-    download(url.format(assembly), dest)
-    return dest
+    """
+    Path to the chrom.sizes file for `assembly`. See `hubward.genomes`.
+    """
+    # Imported here because hubward.genomes itself uses this module
+    from hubward import genomes
+    return genomes.chromsizes_file(assembly)
 
 
 def bigbed(filename, genome, output, blockSize=256, itemsPerSlot=512,
@@ -465,3 +890,186 @@ def bigwig(filename, genome, output, blockSize=256, itemsPerSlot=512,
     ]
     p = subprocess.check_output(cmds, stderr=subprocess.STDOUT)
     return output
+
+
+class SortedBedWriter(object):
+    def __init__(self, fout):
+        """
+        Writes BED lines to `fout`, one per `write` call, noting whether they
+        are sorted the way bedToBigBed needs (by chromosome as `sort -k1,1`
+        would, then by start) and how many fields the first one has.
+        """
+        self.fout = fout
+        self.sorted = True
+        self.field_count = None
+        self._chrom = None
+        self._start = None
+
+    def write(self, line):
+        chrom, start, _ = line.split('\t', 2)
+        start = int(start)
+        if self.field_count is None:
+            self.field_count = line.count('\t') + 1
+        if self.sorted and self._chrom is not None:
+            if chrom == self._chrom:
+                self.sorted = start >= self._start
+            else:
+                self.sorted = chrom > self._chrom
+        self._chrom, self._start = chrom, start
+        self.fout.write(line)
+
+
+def sort_bed(filename, threads=1, memory=None, tmpdir=None):
+    """
+    Sort a BED or bedGraph file in place the way bedToBigBed and
+    bedGraphToBigWig need it, using `sort --parallel`.
+
+    Parameters
+    ----------
+    threads : int
+
+    memory : int or None
+        Memory in MB. If None, use sort's default.
+
+    tmpdir : str or None
+        Directory for sort's temporary files.
+    """
+    cmds = ['sort', '-k1,1', '-k2,2n', '--parallel', str(threads)]
+    if tmpdir is not None:
+        cmds += ['-T', tmpdir]
+    if memory:
+        cmds += ['-S', '{0}M'.format(memory)]
+    env = dict(os.environ, LC_ALL='C')
+    subprocess.check_call(cmds + ['-o', filename, filename], env=env)
+
+
+# Column names, in order, for dicts of arrays passed to `write_bigbed` and
+# `write_bigwig`
+BED_COLUMNS = [
+    'chrom', 'start', 'end', 'name', 'score', 'strand', 'thickStart',
+    'thickEnd', 'itemRgb', 'blockCount', 'blockSizes', 'blockStarts']
+BEDGRAPH_COLUMNS = ['chrom', 'start', 'end', 'value']
+
+
+def _strings(values):
+    """
+    Format an array (or list) of values as a list of strings.
+    """
+    if hasattr(values, 'tolist'):
+        values = values.tolist()
+    return [
+        x.decode('utf-8') if isinstance(x, bytes) and not isinstance(x, str)
+        else str(x)
+        for x in values]
+
+
+def _feature_lines(features, columns, chunksize=100000):
+    """
+    Yields tab-delimited lines (with newlines) from `features`; see
+    `write_bigbed`.
+
+    Raises ValueError if `features` is a dict whose keys are not the first
+    few of `columns` (e.g., BED_COLUMNS).
+    """
+    names = getattr(getattr(features, 'dtype', None), 'names', None)
+    if names is not None or isinstance(features, dict):
+        # Columns of arrays, formatted a chunk at a time
+        if names is None:
+            names = columns[:len(features)]
+            if sorted(names) != sorted(features):
+                raise ValueError(
+                    "Columns must be the first {0} of {1}; got {2}"
+                    .format(len(features), ', '.join(columns),
+                            ', '.join(sorted(features))))
+        arrays = [features[name] for name in names]
+        n = len(arrays[0])
+        for i in range(0, n, chunksize):
+            chunk = [_strings(a[i:i + chunksize]) for a in arrays]
+            for row in zip(*chunk):
+                yield '\t'.join(row) + '\n'
+        return
+
+    for feature in features:
+        if isinstance(feature, string_types):
+            yield feature if feature.endswith('\n') else feature + '\n'
+        elif hasattr(feature, 'fields'):
+            # e.g., pybedtools.Interval
+            yield '\t'.join(feature.fields) + '\n'
+        else:
+            yield '\t'.join(str(x) for x in feature) + '\n'
+
+
+def _write_features(features, output, columns):
+    """
+    Write `features` to a temporary file next to `output`, sorting it if
+    needed. Returns the filename and the number of fields in the first
+    feature.
+    """
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(output)),
+        prefix='.' + os.path.basename(output), suffix='.bed')
+    try:
+        with os.fdopen(fd, 'w') as fout:
+            writer = SortedBedWriter(fout)
+            for line in _feature_lines(features, columns):
+                writer.write(line)
+        if not writer.sorted:
+            sort_bed(tmp, tmpdir=os.path.dirname(tmp))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return tmp, writer.field_count
+
+
+def write_bigbed(features, genome, output, bedtype=None, **kwargs):
+    """
+    Create a bigBed from features generated in Python, without writing
+    a BED file first.
+
+    Parameters
+    ----------
+    features : iterable, dict, or NumPy structured array
+        Either an iterable (e.g., a generator) of features, each of which is
+        a sequence of fields, a tab-delimited line, or a pybedtools.Interval;
+        or columns of arrays, as a dict keyed by the first few names in
+        BED_COLUMNS or a NumPy structured array (whose fields are used in
+        order).
+
+    genome : str
+        Assembly name; see `hubward.genomes`.
+
+    output : str
+        Path to bigBed file to create.
+
+    bedtype : str or None
+        If None, inferred from the number of fields in the first feature.
+
+    Other kwargs are passed to `bigbed`.
+
+    bedToBigBed reads its input twice, so features are still written to one
+    temporary file (sorted if they weren't already), but it is not read
+    again in Python.
+    """
+    tmp, field_count = _write_features(features, output, BED_COLUMNS)
+    try:
+        if bedtype is None:
+            bedtype = 'bed{0}'.format(field_count or 3)
+        return bigbed(tmp, genome, output, bedtype=bedtype, **kwargs)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def write_bigwig(features, genome, output, **kwargs):
+    """
+    Create a bigWig from (chrom, start, end, value) records generated in
+    Python, without writing a bedGraph file first.
+
+    `features` are as for `write_bigbed`, with dicts keyed by the names in
+    BEDGRAPH_COLUMNS. Other kwargs are passed to `bigwig`.
+    """
+    tmp, _ = _write_features(features, output, BEDGRAPH_COLUMNS)
+    try:
+        return bigwig(tmp, genome, output, **kwargs)
+    finally:
+        os.unlink(tmp)
@@ -0,0 +1,121 @@
+"""
+Module for running Python processing scripts inside long-lived worker
+processes.
+
+Running a Python script via subprocess costs a fresh interpreter and fresh
+imports (pybedtools, numpy, ...) for every track. If a script defines
+a top-level function `process(source, target)`, it can instead be loaded once
+into each of a pool of worker processes and called there directly. Scripts
+that don't follow this convention (including all non-Python scripts) are run
+as subprocesses as usual.
+"""
+import os
+import ast
+import sys
+import hashlib
+import multiprocessing
+
+# Modules loaded in this (worker) process, keyed by (path, mtime) so that an
+# edited script is reloaded.
+_modules = {}
+
+# Cached results of has_entry_point, keyed by (path, mtime)
+_entry_points = {}
+
+
+def has_entry_point(script):
+    """
+    Returns True if `script` is a Python file that defines a top-level
+    `process(source, target)` function.
+
+    The script is parsed but not imported or executed.
+    """
+    path = os.path.abspath(script)
+    try:
+        key = (path, os.stat(path).st_mtime)
+    except OSError:
+        return False
+    if key not in _entry_points:
+        _entry_points[key] = _parse_entry_point(path)
+    return _entry_points[key]
+
+
+def _parse_entry_point(path):
+    with open(path) as f:
+        source = f.read()
+    if not (path.endswith('.py') or
+            (source.startswith('#!') and 'python' in source.splitlines()[0])):
+        return False
+    try:
+        tree = ast.parse(source, path)
+    except SyntaxError:
+        # e.g., a Python 2 script when running under Python 3. It can still
+        # be run as a subprocess.
+        return False
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == 'process':
+            return True
+    return False
+
+
+def _load(path):
+    key = (path, os.stat(path).st_mtime)
+    if key not in _modules:
+        name = 'hubward_script_' + hashlib.sha1(
+            path.encode('utf-8')).hexdigest()
+        if sys.version_info[0] >= 3:
+            import importlib.util
+            spec = importlib.util.spec_from_file_location(name, path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        else:
+            import imp
+            module = imp.load_source(name, path)
+        _modules[key] = module
+    return _modules[key]
+
+
+def _call(script, source, target, env):
+    """
+    Runs in a worker process: load `script` (if not already loaded) and call
+    its `process` function, with `env` added to the environment.
+    """
+    os.environ.update(env)
+    _load(script).process(source, target)
+
+
+class WorkerPool(object):
+    def __init__(self, processes=None, maxtasksperchild=100):
+        """
+        A pool of long-lived processes that run the `process()` function of
+        Python processing scripts.
+
+        Parameters
+        ----------
+        processes : int or None
+            Number of worker processes. If None, use the number of CPUs.
+
+        maxtasksperchild : int or None
+            Replace each worker with a fresh process after it has run this
+            many tracks, to guard against scripts that leak memory. If None,
+            workers live as long as the pool.
+        """
+        self.pool = multiprocessing.Pool(
+            processes, maxtasksperchild=maxtasksperchild)
+
+    def run(self, script, source, target, env=None):
+        """
+        Call `process(source, target)` from `script` in a worker process,
+        blocking until it completes. Exceptions raised by the script are
+        re-raised here.
+
+        `env` is a dict of environment variables to set in the worker first.
+
+        Safe to call from multiple threads at once.
+        """
+        self.pool.apply(
+            _call, (os.path.abspath(script), source, target, env or {}))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -4,8 +4,18 @@
 This template script should accept two arguments: the source input filename
 (which is expected to exist) and the target output filename (expected to be
 created by this script).
+
+The work is done in the `process()` function. When hubward is run with
+`--workers`, it imports this script once per worker process and calls
+`process()` directly, so expensive imports only happen once.
 """
 import sys
 
-source = sys.argv[1]
-target = sys.argv[2]
+
+def process(source, target):
+    # Do something with `source` to convert to `target`...
+    pass
+
+
+if __name__ == "__main__":
+    process(sys.argv[1], sys.argv[2])
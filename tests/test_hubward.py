@@ -71,6 +71,1482 @@ class TestNewStudyEdited(unittest.TestCase):
     def test_tmp(self):
         pass
 
+class StudyTestCase(unittest.TestCase):
+    """
+    Builds studies in a temp dir whose tracks' originals already exist, so
+    nothing is downloaded.
+    """
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.mkdtemp()
+        self._cache_dir = os.environ.get('HUBWARD_CACHE_DIR')
+        os.environ['HUBWARD_CACHE_DIR'] = os.path.join(self.tmp, 'cache')
+
+    def tearDown(self):
+        import shutil
+        if self._cache_dir is None:
+            del os.environ['HUBWARD_CACHE_DIR']
+        else:
+            os.environ['HUBWARD_CACHE_DIR'] = self._cache_dir
+        shutil.rmtree(self.tmp)
+
+    def make_study(self, names, script, shebang='#!/bin/bash', study='study',
+                   **options):
+        """
+        Creates a study (in directory `study`) with one bigBed track per name
+        in `names`, each converted by src/convert.sh, a script with body
+        `script`. `options` are added to each track.
+        """
+        import yaml
+        dirname = os.path.join(self.tmp, study)
+        for d in ['raw-data', 'src']:
+            os.makedirs(os.path.join(dirname, d))
+        tracks = []
+        for name in names:
+            with open(os.path.join(dirname, 'raw-data', name), 'w') as f:
+                f.write('chr1\t1\t10\n')
+            track = dict(
+                genome='dm6', short_label=name, type='bigbed',
+                original='raw-data/' + name,
+                processed='processed-data/' + name + '.bb',
+                script='src/convert.sh',
+                source=dict(url='http://localhost/' + name, fn=name))
+            track.update(options)
+            tracks.append(track)
+        script_fn = os.path.join(dirname, 'src', 'convert.sh')
+        with open(script_fn, 'w') as f:
+            f.write(shebang + '\n' + dedent(script))
+        os.chmod(script_fn, 0o755)
+        with open(os.path.join(dirname, 'metadata.yaml'), 'w') as f:
+            yaml.dump(dict(study=dict(label=study, description='test'),
+                           tracks=tracks), f)
+        return dirname
+
+    def processed(self, dirname, name):
+        fn = os.path.join(dirname, 'processed-data', name + '.bb')
+        if os.path.exists(fn):
+            return open(fn).read()
+
+
+class ToolsTestCase(StudyTestCase):
+    """
+    Puts stand-ins for external tools (e.g., UCSC tools), written with
+    `tool`, first on the PATH.
+    """
+    def setUp(self):
+        super(ToolsTestCase, self).setUp()
+        self.bin = os.path.join(self.tmp, 'bin')
+        os.makedirs(self.bin)
+        self._path = os.environ['PATH']
+        os.environ['PATH'] = self.bin + os.pathsep + self._path
+
+    def tearDown(self):
+        os.environ['PATH'] = self._path
+        super(ToolsTestCase, self).tearDown()
+
+    def tool(self, name, script):
+        fn = os.path.join(self.bin, name)
+        with open(fn, 'w') as f:
+            f.write('#!/bin/bash\n' + dedent(script))
+        os.chmod(fn, 0o755)
+
+
+class TestScheduler(unittest.TestCase):
+    def test_dependencies_run_first(self):
+        s = hubward.scheduler.Scheduler(jobs=4)
+        order = []
+        s.add('a', lambda: order.append('a'))
+        s.add('b', lambda: order.append('b'), depends=['a'])
+        s.add('c', lambda: order.append('c'), depends=['a', 'b'])
+        s.run()
+        self.assertEqual(order, ['a', 'b', 'c'])
+
+    def test_failure_skips_dependents_only(self):
+        s = hubward.scheduler.Scheduler(jobs=2)
+        ran = []
+
+        def fail():
+            raise ValueError('fail')
+        s.add('bad', fail)
+        s.add('after-bad', lambda: ran.append('after-bad'), depends=['bad'])
+        s.add('good', lambda: ran.append('good'))
+        self.assertRaises(ValueError, s.run)
+        self.assertEqual(ran, ['good'])
+        self.assertEqual(sorted(s.failed), ['after-bad', 'bad'])
+
+    def test_plan_packs_within_limits(self):
+        s = hubward.scheduler.Scheduler(jobs=8, cores=8, memory=1000)
+        s.add('big', None, threads=6, memory=900)
+        s.add('big2', None, threads=6, memory=100)
+        s.add('small', None, threads=2, memory=100)
+        s.add('huge', None, threads=16)
+        self.assertEqual(
+            s.plan(), [['big', 'small'], ['big2'], ['huge']])
+
+    def test_passed_over_job_is_not_starved(self):
+        s = hubward.scheduler.Scheduler(jobs=8, cores=2, max_wait=0)
+        s.add('small1', None)
+        s.add('big', None, threads=2)
+        s.add('small2', None)
+        s.add('small3', None)
+        self.assertEqual(
+            s.plan(), [['small1'], ['big'], ['small2', 'small3']])
+
+    def test_io_jobs_dont_hold_up_large_job(self):
+        s = hubward.scheduler.Scheduler(jobs=2, cores=2, io_jobs=2)
+        s.add('download', None, threads=0)
+        s.add('huge', None, threads=8)
+        s.add('small', None)
+        self.assertEqual(s.plan(), [['download', 'huge'], ['small']])
+
+
+class TestFileHash(unittest.TestCase):
+    def test_parallel_blocks_match_serial(self):
+        import tempfile
+        orig = hubward.manifest.BLOCK_SIZE
+        hubward.manifest.BLOCK_SIZE = 10
+        try:
+            tmp = tempfile.NamedTemporaryFile(delete=False).name
+            with open(tmp, 'wb') as fout:
+                fout.write(b'0123456789' * 5 + b'abc')
+            self.assertEqual(
+                hubward.manifest.file_hash(tmp, jobs=1),
+                hubward.manifest.file_hash(tmp, jobs=4))
+            os.unlink(tmp)
+        finally:
+            hubward.manifest.BLOCK_SIZE = orig
+
+class TestDownload(StudyTestCase):
+    """
+    Downloads from a local server that supports Range and ETag requests.
+    """
+    def setUp(self):
+        super(TestDownload, self).setUp()
+        import tempfile
+        import threading
+        import hashlib
+        import time
+        try:
+            from http.server import HTTPServer, BaseHTTPRequestHandler
+            from socketserver import ThreadingMixIn
+        except ImportError:
+            from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+            from SocketServer import ThreadingMixIn
+
+        test = self
+        self.content = b'0123456789' * 100
+        # Content of other paths than /data.bed
+        self.paths = {}
+        self.requests = []
+        # Seconds each response is held up for, and the most requests
+        # handled at once
+        self.delay = 0
+        self.active = [0, 0]
+        lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with lock:
+                    test.active[0] += 1
+                    test.active[1] = max(test.active)
+                try:
+                    time.sleep(test.delay)
+                    self.respond()
+                finally:
+                    with lock:
+                        test.active[0] -= 1
+
+            def respond(self):
+                test.requests.append(self.headers)
+                content = test.paths.get(self.path, test.content)
+                etag = '"{0}"'.format(hashlib.sha1(content).hexdigest())
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                start = 0
+                if self.headers.get('Range'):
+                    start = int(self.headers['Range'][6:].rstrip('-'))
+                body = content[start:]
+                self.send_response(206 if start else 200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                if start:
+                    self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                        start, len(content) - 1, len(content)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/data.bed'.format(
+            self.server.server_address[1])
+        self.dest = os.path.join(tempfile.mkdtemp(), 'data.bed')
+
+    def tearDown(self):
+        import shutil
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(os.path.dirname(self.dest))
+        super(TestDownload, self).tearDown()
+
+    def test_resume(self):
+        with open(self.dest + '.part', 'wb') as fout:
+            fout.write(self.content[:250])
+        self.assertTrue(hubward.utils.download(self.url, self.dest))
+        self.assertEqual(self.requests[-1].get('Range'), 'bytes=250-')
+        self.assertEqual(open(self.dest, 'rb').read(), self.content)
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+        info = hubward.download.source_info(self.dest)
+        self.assertEqual(info['content_length'], len(self.content))
+
+    def test_refresh(self):
+        hubward.utils.download(self.url, self.dest)
+        self.assertFalse(
+            hubward.utils.download(self.url, self.dest, refresh=True))
+        self.content = b'changed'
+        self.assertTrue(
+            hubward.utils.download(self.url, self.dest, refresh=True))
+        self.assertEqual(open(self.dest, 'rb').read(), b'changed')
+
+    def test_manager_refresh(self):
+        hubward.utils.download(self.url, self.dest)
+        manager = hubward.download.DownloadManager(report_interval=1000)
+        try:
+            d = manager.submit(self.url, self.dest, refresh=True)
+            d.wait()
+        finally:
+            manager.close()
+        self.assertFalse(d.changed)
+
+    def test_streaming_unpack(self):
+        import io
+        import tarfile
+        buf = io.BytesIO()
+        tar = tarfile.open(fileobj=buf, mode='w:gz')
+        for name in ['d/a.bed', 'd/b.bed']:
+            info = tarfile.TarInfo(name)
+            info.size = 100
+            tar.addfile(info, io.BytesIO(b'x' * 100))
+        tar.close()
+        self.content = buf.getvalue()
+
+        tmp = os.path.dirname(self.dest)
+        archive = os.path.join(tmp, 'data.tar.gz')
+        stream = hubward.download.StreamingUnpack(
+            self.url, tmp, archive=archive)
+        stream.wait_for(os.path.join(tmp, 'd', 'a.bed'))
+        stream.wait()
+        self.assertEqual(
+            open(os.path.join(tmp, 'd', 'b.bed'), 'rb').read(), b'x' * 100)
+        self.assertEqual(open(archive, 'rb').read(), self.content)
+
+    def test_cache_shared_between_studies(self):
+        tmp = os.path.dirname(self.dest)
+        cache = hubward.cache.DownloadCache(os.path.join(tmp, 'cache'))
+        a = os.path.join(tmp, 'study1', 'raw-data', 'data.bed')
+        b = os.path.join(tmp, 'study2', 'raw-data', 'data.bed')
+        self.assertTrue(cache.fetch(self.url, a))
+        self.assertTrue(cache.fetch(self.url, b))
+        self.assertEqual(len(self.requests), 1)
+        self.assertTrue(os.path.samefile(a, b))
+        self.assertFalse(cache.fetch(self.url, a))
+
+    def test_cache_opt_in(self):
+        # setUp sets HUBWARD_CACHE_DIR, which doesn't turn it on by itself
+        self.assertEqual(hubward.cache.download_cache(), None)
+        self.assertTrue(hubward.cache.download_cache(True))
+        os.environ['HUBWARD_DOWNLOAD_CACHE'] = '1'
+        try:
+            self.assertTrue(hubward.cache.download_cache())
+        finally:
+            del os.environ['HUBWARD_DOWNLOAD_CACHE']
+
+    def test_connections_per_host(self):
+        self.delay = 0.2
+        tmp = os.path.dirname(self.dest)
+        manager = hubward.download.DownloadManager(
+            max_connections=8, max_per_host=2, report_interval=0)
+        try:
+            downloads = [
+                manager.submit(self.url, os.path.join(tmp, str(i)))
+                for i in range(6)]
+            for d in downloads:
+                d.wait()
+        finally:
+            manager.close()
+        self.assertEqual(self.active[1], 2)
+        for i in range(6):
+            self.assertEqual(
+                open(os.path.join(tmp, str(i)), 'rb').read(), self.content)
+
+    def test_prefetch_reports_bad_archive(self):
+        # A truncated zip, and a good source in another study
+        self.paths['/data.zip'] = b'PK\x03\x04truncated'
+        bad = self.make_study(
+            ['a.bed'], 'cp $1 $2\n', study='bad',
+            source=dict(url=self.url[:-4] + '.zip', fn='data.zip'))
+        good = self.make_study(
+            ['b.bed'], 'cp $1 $2\n', study='good',
+            source=dict(url=self.url, fn='b.bed'))
+        for dirname, name in [(bad, 'a.bed'), (good, 'b.bed')]:
+            os.unlink(os.path.join(dirname, 'raw-data', name))
+        studies = [hubward.models.Study(dirname, build_metadata=False)
+                   for dirname in [bad, good]]
+        manager = hubward.download.DownloadManager(report_interval=1000)
+        try:
+            try:
+                hubward.download.prefetch(studies, manager)
+            except ValueError as e:
+                self.assertTrue('data.zip' in str(e))
+            else:
+                self.fail('ValueError not raised')
+        finally:
+            manager.close()
+        self.assertEqual(
+            open(os.path.join(good, 'raw-data', 'b.bed'), 'rb').read(),
+            self.content)
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        import io
+        import tarfile
+        import zipfile
+        import tempfile
+        self.tmp = tempfile.mkdtemp()
+        self.files = {'d/a.bed': b'a' * 1000, 'd/b.bed': b'b' * 2000}
+        for ext, mode in [('tar', 'w'), ('tar.gz', 'w:gz')]:
+            tar = tarfile.open(os.path.join(self.tmp, 'x.' + ext), mode)
+            for name, data in sorted(self.files.items()):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+            tar.close()
+        z = zipfile.ZipFile(os.path.join(self.tmp, 'x.zip'), 'w')
+        for name, data in sorted(self.files.items()):
+            z.writestr(name, data)
+        z.close()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def test_selective_extraction(self):
+        for ext in ['tar', 'tar.gz', 'zip']:
+            archive = os.path.join(self.tmp, 'x.' + ext)
+            dest = os.path.join(self.tmp, ext)
+            hubward.archive.extract(archive, dest, members=['d/b.bed'])
+            self.assertEqual(os.listdir(os.path.join(dest, 'd')), ['b.bed'])
+            self.assertEqual(
+                open(os.path.join(dest, 'd', 'b.bed'), 'rb').read(),
+                self.files['d/b.bed'])
+            # Compressed tars have no usable offsets to index
+            self.assertEqual(
+                os.path.exists(archive + '.index.json'), ext != 'tar.gz')
+
+    def test_compressed_tar_read_once(self):
+        from hubward import archive
+        archive_fn = os.path.join(self.tmp, 'x.tar.gz')
+        open_stream = archive.decompress.open_stream
+        opened = []
+
+        def counting(*args, **kwargs):
+            opened.append(args)
+            return open_stream(*args, **kwargs)
+
+        archive.decompress.open_stream = counting
+        try:
+            for members, expected in [(None, 1), (['d/a.bed'], 1),
+                                      (['./d/a.bed', 'd/b.bed'], 1),
+                                      (['missing'], 2)]:
+                opened = []
+                dest = os.path.join(self.tmp, 'out')
+                paths = archive.extract(archive_fn, dest, members=members)
+                self.assertEqual(len(opened), expected, members)
+                self.assertTrue(paths)
+        finally:
+            archive.decompress.open_stream = open_stream
+
+    def test_unknown_member_extracts_everything(self):
+        dest = os.path.join(self.tmp, 'all')
+        hubward.archive.extract(
+            os.path.join(self.tmp, 'x.tar.gz'), dest, members=['missing'])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(dest, 'd'))), ['a.bed', 'b.bed'])
+
+
+class TestDecompress(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        import subprocess
+        self.tmp = tempfile.mkdtemp()
+        self.data = b''.join(
+            'chr1\t{0}\t{1}\n'.format(i, i + 10).encode()
+            for i in range(50000))
+        self.fns = {}
+        for format_, program, ext in [('gzip', 'gzip', '.gz'),
+                                      ('bzip2', 'bzip2', '.bz2'),
+                                      ('xz', 'xz', '.xz')]:
+            fn = os.path.join(self.tmp, 'x.bed' + ext)
+            with open(fn, 'wb') as f:
+                try:
+                    proc = subprocess.Popen(
+                        [program, '-c'], stdin=subprocess.PIPE, stdout=f)
+                except OSError:
+                    continue
+                proc.communicate(self.data)
+            self.fns[format_] = fn
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def truncated(self, fn):
+        data = open(fn, 'rb').read()
+        out = os.path.join(self.tmp, 'truncated' + os.path.splitext(fn)[1])
+        with open(out, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        return out
+
+    def test_each_backend(self):
+        self.assertTrue(self.fns)
+        for format_, fn in self.fns.items():
+            for backend in hubward.decompress.backends(fn):
+                with hubward.decompress.open_stream(fn, backend) as f:
+                    self.assertEqual(f.read(), self.data, backend)
+
+    def test_fallback(self):
+        from hubward import decompress
+        fn = self.fns['gzip']
+        orig = decompress.BACKENDS['gzip']
+        decompress.BACKENDS['gzip'] = [
+            ('missing', decompress._command('hubward-missing', '-dc')),
+            ('gzip -d', decompress._command('gzip', '-dc')),
+        ] + orig
+        try:
+            self.assertEqual(decompress.backends(fn)[0], 'gzip -d')
+            with decompress.open_stream(fn) as f:
+                self.assertTrue(isinstance(f, decompress._ProcessReader))
+                self.assertEqual(f.read(), self.data)
+            self.assertRaises(
+                ValueError, decompress.open_stream, fn, 'missing')
+        finally:
+            decompress.BACKENDS['gzip'] = orig
+
+    def test_truncated(self):
+        from hubward import decompress
+        fn = self.truncated(self.fns['gzip'])
+        with decompress._ProcessReader(['gzip', '-dc'], fn) as f:
+            self.assertRaises(IOError, f.read)
+        with decompress.open_stream(fn, 'gzip') as f:
+            self.assertRaises((IOError, EOFError), f.read)
+
+    def test_stderr_does_not_block(self):
+        # More on stderr than a pipe holds, before any output
+        from hubward import decompress
+        fn = self.fns['gzip']
+        script = 'head -c 1000000 /dev/zero >&2; gzip -dc "$0"'
+        with decompress._ProcessReader(['sh', '-c', script], fn) as f:
+            self.assertEqual(f.read(), self.data)
+
+
+class TestChain(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.mkdtemp()
+        self.chainfile = os.path.join(self.tmp, 'aToB.over.chain')
+        with open(self.chainfile, 'w') as f:
+            f.write(dedent(
+                """\
+                chain 1000 chr1 1000 + 100 400 chrA 2000 + 0 250 1
+                100\t50\t0
+                150
+
+                chain 500 chr1 1000 + 500 600 chrB 1000 - 100 200 2
+                100
+                """))
+        self.chain = hubward.chain.Chain(
+            self.chainfile, os.path.join(self.tmp, 'aToB.npz'))
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def test_map_intervals(self):
+        m = self.chain.map_intervals(
+            'chr1', [120, 510, 150, 190], [180, 520, 300, 510])
+        self.assertEqual(list(m['mapped']), [True, True, False, False])
+        self.assertEqual(list(m['start'][:2]), [20, 880])
+        self.assertEqual(list(m['end'][:2]), [80, 890])
+        self.assertEqual(list(m['reverse'][:2]), [False, True])
+        self.assertEqual(list(m['split']), [False, False, False, True])
+
+    def test_split_intervals(self):
+        m = self.chain.split_intervals('chr1', [90, 180], [120, 560])
+        self.assertEqual(list(m['index']), [0, 1, 1, 1])
+        self.assertEqual(list(m['start']), [0, 80, 100, 840])
+        self.assertEqual(list(m['end']), [20, 100, 250, 900])
+
+    def test_liftover_bed(self):
+        infile = os.path.join(self.tmp, 'in.bed')
+        outfile = os.path.join(self.tmp, 'out.bed')
+        with open(infile, 'w') as f:
+            f.write(
+                'chr1\t510\t520\ty\t0\t+\t512\t518\n'
+                'chr2\t1\t5\tz\n'
+                'chr1\t100\t400\tb\t0\t+\t100\t400\t0\t2\t50,100,\t0,150,\n')
+        self.assertEqual(
+            self.chain.liftover_bed(infile, outfile, min_match=0.5), (2, 1))
+        self.assertEqual(
+            open(outfile).read(),
+            'chrB\t880\t890\ty\t0\t-\t882\t888\n'
+            'chrA\t0\t200\tb\t0\t+\t0\t200\t0\t2\t50,100,\t0,100,\n')
+
+
+class TestScatterBigwig(ToolsTestCase):
+    def setUp(self):
+        super(TestScatterBigwig, self).setUp()
+        # "bigWigs" here are bedGraphs
+        self.tool('bigWigInfo', """\
+            echo "chromCount: 4"
+            cut -f1 "$2" | sort -u | awk '{print "\t" $1 " 0 1000"}'
+            """)
+        self.tool('bigWigToBedGraph', """\
+            awk -v c="${1#-chrom=}" '$1 == c' "$2" > "$3"
+            """)
+        self.tool('bedGraphToBigWig', 'cp "$1" "$3"\n')
+        with open(os.path.join(self.tmp, 'testB.chrom.sizes'), 'w') as f:
+            f.write('chrA\t2000\nchrB\t1000\n')
+        os.environ['HUBWARD_CHROMSIZES'] = self.tmp
+        self.chainfile = os.path.join(self.tmp, 'testAToTestB.over.chain')
+        with open(self.chainfile, 'w') as f:
+            f.write(dedent(
+                """\
+                chain 1000 chr1 1000 + 0 500 chrA 2000 + 0 500 1
+                500
+
+                chain 1000 chr2 1000 + 0 500 chrA 2000 + 1000 1500 2
+                500
+
+                chain 1000 chr3 1000 + 0 100 chrB 1000 + 0 100 3
+                100
+                """))
+
+    def tearDown(self):
+        del os.environ['HUBWARD_CHROMSIZES']
+        super(TestScatterBigwig, self).tearDown()
+
+    def test_chromosomes_lifted_over_in_parallel(self):
+        from hubward import liftover
+        infile = os.path.join(self.tmp, 'in.bw')
+        outfile = os.path.join(self.tmp, 'out.bw')
+        with open(infile, 'w') as f:
+            f.write('chr1\t10\t20\t1.5\n'
+                    'chr1\t400\t600\t1\n'
+                    'chr2\t0\t100\t2\n'
+                    'chr3\t50\t150\t3\n'
+                    'chr4\t0\t10\t4\n')
+
+        # The chain is already open in this process, e.g. from lifting over
+        # another track
+        hubward.chain.load(self.chainfile)
+        for i in range(3):
+            liftover._scatter_bigwig(
+                self.chainfile, 'testB', infile, outfile, jobs=3)
+            self.assertEqual(
+                open(outfile).read(),
+                'chrA\t10\t20\t1.5\n'
+                'chrA\t400\t500\t1\n'
+                'chrA\t1000\t1100\t2\n'
+                'chrB\t50\t100\t3\n')
+
+
+class TestLiftoverBam(ToolsTestCase):
+    def setUp(self):
+        super(TestLiftoverBam, self).setUp()
+        from hubward import liftover
+        self.orig = liftover.download_chainfile
+        liftover.download_chainfile = lambda *args: 'a.chain'
+        self.scratch = os.path.join(self.tmp, 'scratch')
+        os.makedirs(self.scratch)
+        self.infile = os.path.join(self.tmp, 'in.bam')
+        self.outfile = os.path.join(self.tmp, 'out.bam')
+        with open(self.infile, 'w') as f:
+            f.write('reads\n')
+        # Writes the output and index, leaving a temp file in the -T dir
+        self.tool('samtools', """\
+            echo "$@" > {0}
+            while [ $# -gt 1 ]; do
+                case $1 in
+                    -T) prefix=$2 ;;
+                    -o) out=$2 ;;
+                esac
+                shift
+            done
+            cat > $prefix.tmp.0000.bam
+            cp $prefix.tmp.0000.bam ${{out%%##idx##*}}
+            touch ${{out##*##idx##}}
+            """.format(os.path.join(self.tmp, 'args')))
+
+    def tearDown(self):
+        from hubward import liftover
+        liftover.download_chainfile = self.orig
+        super(TestLiftoverBam, self).tearDown()
+
+    def lift(self, **kwargs):
+        from hubward import liftover
+        return liftover._liftover_bam(
+            'a', 'b', self.infile, self.outfile, scratch=self.scratch,
+            **kwargs)
+
+    def sort_args(self):
+        return open(os.path.join(self.tmp, 'args')).read().split()
+
+    def test_sorted_within_memory(self):
+        self.tool('CrossMap.py', 'cat "$3"\n')
+        self.lift(threads=4, memory=1000)
+        self.assertEqual(open(self.outfile).read(), 'reads\n')
+        self.assertTrue(os.path.exists(self.outfile + '.bai'))
+        self.assertEqual(os.listdir(self.scratch), [])
+        args = self.sort_args()
+        self.assertEqual(args[args.index('-@') + 1], '4')
+        self.assertEqual(args[args.index('-m') + 1], '250M')
+
+        # Fewer threads rather than more than 100M per thread
+        self.lift(threads=4, memory=250)
+        args = self.sort_args()
+        self.assertEqual(args[args.index('-@') + 1], '2')
+        self.assertEqual(args[args.index('-m') + 1], '125M')
+
+    def test_cleanup_on_failure(self):
+        import subprocess
+        self.tool('CrossMap.py', 'cat "$3"\nexit 1\n')
+        self.assertRaises(subprocess.CalledProcessError, self.lift)
+        self.assertFalse(os.path.exists(self.outfile))
+        self.assertFalse(os.path.exists(self.outfile + '.bai'))
+        self.assertEqual(os.listdir(self.scratch), [])
+
+        self.tool('CrossMap.py', 'yes "$3"\n')
+        self.tool('samtools', 'exit 2\n')
+        try:
+            self.lift()
+        except subprocess.CalledProcessError as e:
+            self.assertEqual(e.cmd[0], 'samtools')
+        else:
+            self.fail('CalledProcessError not raised')
+
+
+class TestLiftoverBigbed(ToolsTestCase):
+    def setUp(self):
+        super(TestLiftoverBigbed, self).setUp()
+        from hubward import liftover
+        self.orig = liftover.download_chainfile
+        liftover.download_chainfile = lambda *args: 'a.chain'
+        # "bigBeds" here are BED files
+        self.tool('bigBedToBed', 'cat "$1"\n')
+        self.tool('bedToBigBed', 'cp "$1" "$3"\n')
+        with open(os.path.join(self.tmp, 'b.chrom.sizes'), 'w') as f:
+            f.write('chr1\t1000\nchr2\t1000\n')
+        os.environ['HUBWARD_CHROMSIZES'] = self.tmp
+        self.bed = ''.join(
+            'chr{0}\t{1}\t{2}\tf\n'.format(chrom, start, start + 5)
+            for chrom in [1, 2] for start in range(0, 500, 10))
+        self.infile = os.path.join(self.tmp, 'in.bb')
+        self.outfile = os.path.join(self.tmp, 'out.bb')
+        with open(self.infile, 'w') as f:
+            f.write(self.bed)
+
+    def tearDown(self):
+        from hubward import liftover
+        liftover.download_chainfile = self.orig
+        del os.environ['HUBWARD_CHROMSIZES']
+        super(TestLiftoverBigbed, self).tearDown()
+
+    def lift(self):
+        from hubward import liftover
+        return liftover._liftover_bigbed(
+            'a', 'b', self.infile, self.outfile, engine='liftOver')
+
+    def test_sorted_writer(self):
+        import io
+        for lines, expected in [(['chr1\t1\t2\n', 'chr1\t1\t3\n',
+                                  'chr2\t0\t1\n'], True),
+                                (['chr1\t5\t6\n', 'chr1\t1\t2\n'], False),
+                                (['chr2\t1\t2\n', 'chr10\t1\t2\n'], False)]:
+            fout = io.StringIO() if str is not bytes else io.BytesIO()
+            writer = hubward.utils.SortedBedWriter(fout)
+            for line in lines:
+                writer.write(line)
+            self.assertEqual(writer.sorted, expected, lines)
+            self.assertEqual(writer.field_count, 3)
+            self.assertEqual(fout.getvalue(), ''.join(lines))
+
+    def test_sorted_and_unsorted_output(self):
+        # Already sorted, then reversed by the "liftover"
+        for liftover in ['cat', 'tac']:
+            self.tool('liftOver', liftover + '\n')
+            self.lift()
+            self.assertEqual(open(self.outfile).read(), self.bed)
+
+    def test_failure_reported(self):
+        import subprocess
+        # liftOver exits without reading everything, so bigBedToBed gets
+        # SIGPIPE
+        with open(self.infile, 'w') as f:
+            f.write(self.bed * 1000)
+        self.tool('liftOver', 'head -n 1\nexit 3\n')
+        try:
+            self.lift()
+        except subprocess.CalledProcessError as e:
+            self.assertEqual(e.returncode, 3)
+            self.assertEqual(e.cmd[0], 'liftOver')
+        else:
+            self.fail('CalledProcessError not raised')
+
+    def test_default_engine(self):
+        from hubward import liftover
+        # liftOver is used by default when it's on the PATH...
+        self.tool('liftOver', 'echo "chr1\t0\t5\tlifted"\n')
+        liftover._liftover_bigbed('a', 'b', self.infile, self.outfile)
+        self.assertEqual(open(self.outfile).read(), 'chr1\t0\t5\tlifted\n')
+        self.assertEqual(liftover.tool_version('bigbed'), 'liftOver')
+
+        # ...and hubward.chain when it isn't
+        os.environ['PATH'] = self.bin
+        os.unlink(os.path.join(self.bin, 'liftOver'))
+        self.assertEqual(liftover._bigbed_engine(), 'hubward')
+        self.assertEqual(liftover.tool_version('bigbed'),
+                         'hubward.chain {0}'.format(liftover.chain.VERSION))
+        self.assertEqual(
+            liftover.tool_version('bigbed', engine='liftOver'), 'liftOver')
+
+
+class TestLiftoverCache(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.mkdtemp()
+        self.cache = hubward.cache.LiftoverCache(
+            os.path.join(self.tmp, 'cache'), max_size=1)
+        self.chainfile = os.path.join(self.tmp, 'aToB.over.chain')
+        with open(self.chainfile, 'w') as f:
+            f.write('chain\n')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def _lifted(self, name, size):
+        fn = os.path.join(self.tmp, name)
+        with open(fn, 'wb') as f:
+            f.write(name.encode() * size)
+        return fn
+
+    def test_hit_links_result(self):
+        infile = self._lifted('in', 10)
+        key = self.cache.key(infile, self.chainfile, 'bigBed', 'v1')
+        self.assertNotEqual(
+            key, self.cache.key(infile, self.chainfile, 'bigBed', 'v2'))
+        dest = os.path.join(self.tmp, 'new', 'out')
+        self.assertFalse(self.cache.get(key, dest))
+        self.cache.put(key, self._lifted('out', 10))
+        self.assertTrue(self.cache.get(key, dest))
+        self.assertEqual(open(dest, 'rb').read(), b'out' * 10)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_edits_dont_reach_cache(self):
+        key = self.cache.key(
+            self._lifted('in', 10), self.chainfile, 'bigBed', 'v1')
+        src = self._lifted('out', 10)
+        self.cache.put(key, src)
+        # The file that was stored is edited in place
+        with open(src, 'r+b') as f:
+            f.write(b'new')
+        dest = os.path.join(self.tmp, 'new', 'out')
+        self.assertTrue(self.cache.get(key, dest))
+        self.assertEqual(open(dest, 'rb').read(), b'out' * 10)
+
+        # So is a study's (hardlinked) file from the cache, so the entry is
+        # dropped
+        with open(dest, 'r+b') as f:
+            f.write(b'new')
+        self.assertFalse(self.cache.get(
+            key, os.path.join(self.tmp, 'new', 'out2')))
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_opt_in(self):
+        os.environ['HUBWARD_CACHE_DIR'] = self.tmp
+        try:
+            self.assertIsNone(hubward.cache.liftover_cache())
+            self.assertIsInstance(hubward.cache.liftover_cache(True),
+                                  hubward.cache.LiftoverCache)
+            os.environ['HUBWARD_LIFTOVER_CACHE'] = '1'
+            self.assertIsInstance(hubward.cache.liftover_cache(),
+                                  hubward.cache.LiftoverCache)
+        finally:
+            del os.environ['HUBWARD_CACHE_DIR']
+            os.environ.pop('HUBWARD_LIFTOVER_CACHE', None)
+
+    def test_evicts_least_recently_used(self):
+        import time
+        # Each entry is 600 KB; the cache holds 1 MB
+        keys = []
+        for name in ['a', 'b', 'c']:
+            key = self.cache.key(
+                self._lifted(name + '.in', 1), self.chainfile, 'bam', 'v1')
+            self.cache.put(key, self._lifted(name, 600 * 1024))
+            keys.append(key)
+            time.sleep(0.05)
+        self.assertEqual(
+            [e['key'] for e in self.cache.entries()], keys[2:])
+
+    def test_concurrent_puts(self):
+        import threading
+        # As Data.liftover does: each thread stores its result while holding
+        # the lock on its own key, and the cache is over its limit
+        keys = [self.cache.key(self._lifted(name + '.in', 1),
+                               self.chainfile, 'bam', 'v1')
+                for name in ['a', 'b']]
+        # Both are already stored (e.g., being replaced), so each put finds
+        # the cache over its limit with the other's entry to evict
+        max_size = self.cache.max_size
+        self.cache.max_size *= 2
+        for key in keys:
+            self.cache.put(key, self._lifted('o', 600 * 1024))
+        self.cache.max_size = max_size
+        locked = [threading.Event() for key in keys]
+
+        def put(i):
+            with self.cache.lock(keys[i]):
+                locked[i].set()
+                locked[1 - i].wait()
+                self.cache.put(keys[i], self._lifted(str(i), 600 * 1024))
+
+        threads = [threading.Thread(target=put, args=(i,)) for i in [0, 1]]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join(10)
+            self.assertFalse(t.is_alive())
+
+        # Whichever finished last may have evicted the other's entry
+        self.cache.evict()
+        self.assertEqual(len(self.cache.entries()), 1)
+
+    def test_locked_entries_not_evicted(self):
+        key = self.cache.key(
+            self._lifted('a.in', 1), self.chainfile, 'bam', 'v1')
+        self.cache.put(key, self._lifted('a', 600 * 1024))
+        with self.cache.lock(key):
+            self.assertEqual(self.cache.evict(max_size=0), 0)
+        self.assertEqual(self.cache.evict(max_size=0), 1)
+
+
+class TestGenomes(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def test_user_supplied_chromsizes(self):
+        fn = os.path.join(self.tmp, 'testAssembly.chrom.sizes')
+        with open(fn, 'w') as f:
+            f.write('chr1\t1000\nchr2\t500\n')
+        os.environ['HUBWARD_CHROMSIZES'] = self.tmp
+        try:
+            self.assertEqual(
+                hubward.genomes.chromsizes_file('testAssembly'), fn)
+            self.assertEqual(
+                hubward.genomes.chromsizes('testAssembly'),
+                {'chr1': 1000, 'chr2': 500})
+        finally:
+            del os.environ['HUBWARD_CHROMSIZES']
+
+
+class TestFixMacsWig(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.mkdtemp()
+        self.wig = os.path.join(self.tmp, 'macs.wig')
+        with open(self.wig, 'w') as f:
+            f.write(dedent("""\
+                track type=wiggle_0
+                variableStep chrom=1 span=10
+                1\t0.5
+                81\t1.5
+                91\t2.5
+                fixedStep chrom=2 start=1 step=10 span=10
+                3
+                4
+                variableStep chrom=M span=10
+                1\t9
+                """))
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def test_clipped_to_chromosomes(self):
+        sizes = {'chr1': 100, 'chr2': 15}
+        for jobs, chunksize in [(1, 1024), (2, 16)]:
+            out = hubward.utils.fix_macs_wig(
+                self.wig, sizes, os.path.join(self.tmp, 'out.wig'),
+                add_chr=True, to_ignore=['chrM'], jobs=jobs,
+                chunksize=chunksize)
+            self.assertEqual(open(out).read(), dedent("""\
+                variableStep chrom=chr1 span=10
+                1\t0.5
+                81\t1.5
+                fixedStep chrom=chr2 start=1 step=10 span=10
+                3
+                """))
+        out = hubward.utils.fix_macs_wig(
+            self.wig, sizes, os.path.join(self.tmp, 'out.bedGraph'),
+            add_chr=True, to_ignore=['chrM'], output_format='bedgraph')
+        self.assertEqual(
+            open(out).read(),
+            'chr1\t0\t10\t0.5\nchr1\t80\t90\t1.5\nchr2\t0\t10\t3.0\n')
+
+
+class TestWriteFeatures(ToolsTestCase):
+    def setUp(self):
+        super(TestWriteFeatures, self).setUp()
+        # Converted files are the sorted BED/bedGraph, and bedToBigBed's
+        # -type is noted next to them
+        self.tool('bedToBigBed', 'cp "$1" "$3"\necho "$6" > "$3.type"\n')
+        self.tool('bedGraphToBigWig', 'cp "$1" "$3"\n')
+        with open(os.path.join(self.tmp, 'testAssembly.chrom.sizes'),
+                  'w') as f:
+            f.write('chr1\t1000\nchr2\t1000\n')
+        os.environ['HUBWARD_CHROMSIZES'] = self.tmp
+        self.output = os.path.join(self.tmp, 'out')
+
+    def tearDown(self):
+        del os.environ['HUBWARD_CHROMSIZES']
+        super(TestWriteFeatures, self).tearDown()
+
+    def lines(self, features, columns=None):
+        from hubward import utils
+        return ''.join(utils._feature_lines(
+            features, columns or utils.BED_COLUMNS, chunksize=2))
+
+    def test_strings(self):
+        import numpy as np
+        from hubward import utils
+        self.assertEqual(utils._strings(np.array([1, 20])), ['1', '20'])
+        self.assertEqual(utils._strings(np.array([0.5, 2.0])), ['0.5', '2.0'])
+        self.assertEqual(utils._strings(np.array([b'a', b'bc'])), ['a', 'bc'])
+        self.assertEqual(utils._strings(['x', 1]), ['x', '1'])
+
+    def test_feature_lines(self):
+        import numpy as np
+        import pybedtools
+        expected = 'chr1\t1\t5\ta\nchr2\t3\t4\tb\nchr1\t0\t2\tc\n'
+        records = [('chr1', 1, 5, 'a'), ('chr2', 3, 4, 'b'),
+                   ('chr1', 0, 2, 'c')]
+        self.assertEqual(self.lines(iter(records)), expected)
+        self.assertEqual(self.lines(['chr1\t1\t5\ta', 'chr2\t3\t4\tb\n',
+                                     'chr1\t0\t2\tc']), expected)
+        # unicode lines on Python 2
+        self.assertEqual(self.lines([u'chr1\t1\t5\ta', u'chr2\t3\t4\tb\n',
+                                     u'chr1\t0\t2\tc']), expected)
+        self.assertEqual(self.lines(
+            pybedtools.create_interval_from_list([str(x) for x in r])
+            for r in records), expected)
+        columns = dict(zip(['chrom', 'start', 'end', 'name'],
+                           [np.array(x) for x in zip(*records)]))
+        self.assertEqual(self.lines(columns), expected)
+        array = np.array(records, dtype=[('chrom', 'S4'), ('start', int),
+                                         ('end', int), ('name', 'S1')])
+        self.assertEqual(self.lines(array), expected)
+
+        # Not the first few BED or bedGraph columns
+        from hubward import utils
+        del columns['name']
+        columns['score'] = np.array([1, 2, 3])
+        self.assertRaises(ValueError, self.lines, columns)
+        self.assertRaises(
+            ValueError, self.lines, columns, utils.BEDGRAPH_COLUMNS)
+
+    def test_write_bigbed(self):
+        import numpy as np
+        from hubward import utils
+        records = [('chr2', 3, 4, 'b'), ('chr1', 1, 5, 'a'),
+                   ('chr1', 0, 2, 'c')]
+        expected = 'chr1\t0\t2\tc\nchr1\t1\t5\ta\nchr2\t3\t4\tb\n'
+        for features in [records, records[::-1],
+                         dict(chrom=np.array(['chr2', 'chr1', 'chr1']),
+                              start=np.array([3, 1, 0]),
+                              end=np.array([4, 5, 2]),
+                              name=np.array(['b', 'a', 'c']))]:
+            utils.write_bigbed(features, 'testAssembly', self.output)
+            self.assertEqual(open(self.output).read(), expected)
+            self.assertEqual(
+                open(self.output + '.type').read(), '-type=bed4\n')
+        self.assertEqual(os.listdir(self.tmp).count('out'), 1)
+        self.assertFalse(
+            [fn for fn in os.listdir(self.tmp) if fn.endswith('.bed')])
+
+    def test_write_bigwig(self):
+        import numpy as np
+        from hubward import utils
+        array = np.array(
+            [('chr1', 10, 20, 0.5), ('chr1', 0, 10, 1.5)],
+            dtype=[('chrom', 'S4'), ('start', int), ('end', int),
+                   ('value', float)])
+        utils.write_bigwig(array, 'testAssembly', self.output)
+        self.assertEqual(open(self.output).read(),
+                         'chr1\t0\t10\t1.5\nchr1\t10\t20\t0.5\n')
+
+
+class TestColoredBigbed(ToolsTestCase):
+    def setUp(self):
+        super(TestColoredBigbed, self).setUp()
+        self.tool('bedToBigBed', 'cp "$1" "$3"\n')
+        with open(os.path.join(self.tmp, 'testAssembly.chrom.sizes'),
+                  'w') as f:
+            f.write('chr1\t1000\nchr2\t1000\n')
+        os.environ['HUBWARD_CHROMSIZES'] = self.tmp
+        self.infile = os.path.join(self.tmp, 'in.bed')
+        self.output = os.path.join(self.tmp, 'out.bb')
+        # Includes the min, the max, and ties
+        self.scores = [-2.5, 0, 3, 7.25, 3, -2.5, 10, 1e-3, 10]
+
+    def tearDown(self):
+        del os.environ['HUBWARD_CHROMSIZES']
+        super(TestColoredBigbed, self).tearDown()
+
+    def write(self, starts, fields=9):
+        with open(self.infile, 'w') as f:
+            for start, score in zip(starts, self.scores):
+                f.write('\t'.join(
+                    ['chr1', str(start), str(start + 10), 'f', str(score),
+                     '+', str(start), str(start + 10), '0'][:fields]) + '\n')
+
+    def expected(self, cmap, starts):
+        from matplotlib.colors import Normalize
+        norm = Normalize(min(self.scores), max(self.scores))
+        lines = []
+        for start, score in sorted(zip(starts, self.scores)):
+            rgb = ','.join(
+                str(int(c * 255)) for c in cmap(norm(score))[:3])
+            lines.append('\t'.join(
+                ['chr1', str(start), str(start + 10), 'f', '0', '+',
+                 str(start), str(start + 10), rgb]) + '\n')
+        return ''.join(lines)
+
+    def test_colors_match_colormap(self):
+        from hubward import utils
+        vmin, vmax = min(self.scores), max(self.scores)
+        for color, cmap in [
+                ('smart', utils.smart_colormap(vmin, vmax)),
+                ('#1f77b4', utils.singlecolormap('#1f77b4'))]:
+            for starts in [list(range(0, 90, 10)),
+                           list(range(80, -10, -10))]:
+                self.write(starts)
+                utils.colored_bigbed(self.infile, color, 'testAssembly',
+                                     self.output, chunksize=64)
+                self.assertEqual(
+                    open(self.output).read(), self.expected(cmap, starts))
+
+    def test_needs_nine_fields(self):
+        from hubward import utils
+        self.write(list(range(0, 90, 10)), fields=6)
+        self.assertRaises(ValueError, utils.colored_bigbed, self.infile,
+                          'smart', 'testAssembly', self.output)
+
+    def test_missing_file(self):
+        from hubward import utils
+        self.assertRaises(ValueError, utils.colored_bigbed,
+                          os.path.join(self.tmp, 'missing.bed'), 'smart',
+                          'testAssembly', self.output)
+
+
+class TestReSTToHtml(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.mkdtemp()
+        os.environ['HUBWARD_CACHE_DIR'] = self.tmp
+        hubward.utils._html_lru.clear()
+
+    def tearDown(self):
+        import shutil
+        del os.environ['HUBWARD_CACHE_DIR']
+        hubward.utils._html_lru.clear()
+        shutil.rmtree(self.tmp)
+
+    def test_cached_on_disk(self):
+        docs = ['Study {0}\n\n*emphasis*'.format(i) for i in range(3)]
+        html = hubward.utils.reST_to_html_many(docs, jobs=2)
+        self.assertTrue('<em>emphasis</em>' in html[0])
+        self.assertEqual(hubward.utils.reST_to_html(docs[1]), html[1])
+
+        # Later runs use the HTML cached on disk without rendering it again
+        hubward.utils._html_lru.clear()
+        render = hubward.utils._render_html
+        hubward.utils._render_html = None
+        try:
+            self.assertEqual(hubward.utils.reST_to_html_many(docs), html)
+        finally:
+            hubward.utils._render_html = render
+
+
+class TestMetadata(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.mkdtemp()
+        os.environ['HUBWARD_CACHE_DIR'] = self.tmp
+        self.fn = os.path.join(self.tmp, 'group.yaml')
+        with open(self.fn, 'w') as f:
+            f.write('name: example\ngenome: dm6\n')
+
+    def tearDown(self):
+        import shutil
+        del os.environ['HUBWARD_CACHE_DIR']
+        shutil.rmtree(self.tmp)
+
+    def test_cached_until_changed(self):
+        import jsonschema
+        expected = {'name': 'example', 'genome': 'dm6'}
+        self.assertEqual(
+            hubward.metadata.load(self.fn, 'group_schema.yaml'), expected)
+
+        # Rewritten with the same contents: neither parsed nor validated
+        os.utime(self.fn, (0, 0))
+        yaml = hubward.metadata.yaml
+        hubward.metadata.yaml = None
+        try:
+            self.assertEqual(
+                hubward.metadata.load(self.fn, 'group_schema.yaml'), expected)
+        finally:
+            hubward.metadata.yaml = yaml
+
+        with open(self.fn, 'w') as f:
+            f.write('name: 1\n')
+        self.assertRaises(
+            jsonschema.ValidationError,
+            hubward.metadata.load, self.fn, 'group_schema.yaml')
+
+    def test_cached_as_json(self):
+        import json
+        import datetime
+        cache_fn = hubward.metadata._cache_path(self.fn)
+        config = hubward.metadata.load(self.fn, 'group_schema.yaml')
+        self.assertEqual(json.load(open(cache_fn))['data'], config)
+        self.assertEqual(
+            type(hubward.metadata.load(self.fn, 'group_schema.yaml')['name']),
+            type(config['name']))
+
+        # Dates can't be stored as JSON, so these are parsed every time
+        os.unlink(cache_fn)
+        with open(self.fn, 'a') as f:
+            f.write('extra: 2016-01-01\n')
+        config = hubward.metadata.load(self.fn, 'group_schema.yaml')
+        self.assertEqual(config['extra'], datetime.date(2016, 1, 1))
+        self.assertFalse(os.path.exists(cache_fn))
+
+
+class TestStudyProcess(StudyTestCase):
+    def test_parallel_failures_reported_at_end(self):
+        dirname = self.make_study(['a', 'b', 'bad', 'c'], """\
+            [[ $1 == *bad ]] && exit 1
+            cp $1 $2
+            """)
+        study = hubward.models.Study(dirname, build_metadata=False)
+        self.assertRaises(ValueError, study.process, jobs=0)
+        self.assertRaises(ValueError, study.process, jobs=3)
+        for name in ['a', 'b', 'c']:
+            self.assertEqual(self.processed(dirname, name), 'chr1\t1\t10\n')
+        self.assertEqual(self.processed(dirname, 'bad'), None)
+
+    def test_hash_mode_detects_untouched_output(self):
+        dirname = self.make_study(['a'], 'cp $1 $2\n')
+        hubward.models.Study(
+            dirname, staleness='hash', build_metadata=False).process()
+        with open(os.path.join(dirname, 'raw-data', 'a'), 'w') as f:
+            f.write('chr1\t1\t20\n')
+        with open(os.path.join(dirname, 'src', 'convert.sh'), 'w') as f:
+            f.write('#!/bin/bash\nexit 0\n')
+
+        # Nothing is recorded, so the track is still out of date next time
+        for i in range(2):
+            study = hubward.models.Study(
+                dirname, staleness='hash', build_metadata=False)
+            self.assertRaises(ValueError, study.process)
+
+
+class TestGroupProcess(StudyTestCase):
+    def test_composite_built_after_own_tracks(self):
+        import yaml
+        script = """\
+            [[ $1 == *bad ]] && exit 1
+            cp $1 $2
+            """
+        good = self.make_study(['a', 'b'], script, study='good')
+        failing = self.make_study(['c', 'bad'], script, study='failing')
+        fn = os.path.join(self.tmp, 'group.yaml')
+        with open(fn, 'w') as f:
+            yaml.dump(dict(name='group', genome='dm6', email='a@b.c',
+                           hub_url='http://localhost/hub.txt',
+                           studies=['good', 'failing']), f)
+
+        # Note which tracks were processed when each composite was built
+        built = {}
+        composite_track = hubward.models.Study.composite_track
+
+        def record(study):
+            built[study.label] = sorted(
+                os.path.basename(d.processed) for d in study.tracks
+                if os.path.exists(d.processed))
+            return composite_track(study)
+
+        hubward.models.Study.composite_track = record
+        try:
+            group = hubward.models.Group(fn, build_metadata=False)
+            self.assertRaises(ValueError, group.process, jobs=3)
+        finally:
+            hubward.models.Study.composite_track = composite_track
+        self.assertEqual(built, {'good': ['a.bb', 'b.bb']})
+        self.assertEqual(self.processed(failing, 'c'), 'chr1\t1\t10\n')
+
+
+class TestSharedArchive(StudyTestCase):
+    def test_compressed_tar_read_once(self):
+        import io
+        import tarfile
+        from hubward import archive
+        dirname = self.make_study(
+            ['a.bed', 'b.bed'], 'cp $1 $2\n',
+            source=dict(url='http://localhost/x.tar.gz', fn='x.tar.gz'))
+        raw = os.path.join(dirname, 'raw-data')
+        tar = tarfile.open(os.path.join(raw, 'x.tar.gz'), 'w:gz')
+        for name in ['a.bed', 'b.bed']:
+            os.unlink(os.path.join(raw, name))
+            info = tarfile.TarInfo(name)
+            info.size = 4
+            tar.addfile(info, io.BytesIO(name[:1].encode() * 4))
+        tar.close()
+
+        open_stream = archive.decompress.open_stream
+        opened = []
+
+        def counting(*args, **kwargs):
+            opened.append(args)
+            return open_stream(*args, **kwargs)
+
+        archive.decompress.open_stream = counting
+        try:
+            hubward.models.Study(dirname, build_metadata=False).process(
+                jobs=2)
+        finally:
+            archive.decompress.open_stream = open_stream
+        self.assertEqual(len(opened), 1)
+        self.assertEqual(self.processed(dirname, 'a.bed'), 'aaaa')
+        self.assertEqual(self.processed(dirname, 'b.bed'), 'bbbb')
+
+
+class TestStudyLiftover(StudyTestCase):
+    def setUp(self):
+        super(TestStudyLiftover, self).setUp()
+        from hubward import liftover
+        self.orig = liftover.download_chainfile, liftover.liftover
+        self.lifted = []
+        self.fail = set()
+
+        def fake_liftover(from_, to_, infile, outfile, filetype, **kwargs):
+            name = os.path.basename(infile)
+            self.lifted.append(name)
+            if name in self.fail:
+                raise ValueError('liftover of {0} failed'.format(name))
+            with open(outfile, 'w') as f:
+                f.write(open(infile).read())
+
+        liftover.download_chainfile = lambda *args: None
+        liftover.liftover = fake_liftover
+
+    def tearDown(self):
+        from hubward import liftover
+        liftover.download_chainfile, liftover.liftover = self.orig
+        super(TestStudyLiftover, self).tearDown()
+
+    def test_metadata_written_once_all_tracks_succeed(self):
+        import yaml
+        dirname = self.make_study(['a', 'b', 'c'], 'cp $1 $2\n')
+        hubward.models.Study(dirname, build_metadata=False).process()
+        newdir = os.path.join(self.tmp, 'lifted')
+        metadata = os.path.join(newdir, 'metadata.yaml')
+
+        self.fail = set(['b.bb'])
+        study = hubward.models.Study(dirname, build_metadata=False)
+        self.assertRaises(
+            ValueError, study.liftover, 'dm6', 'dm3', newdir, jobs=2)
+        self.assertEqual(sorted(self.lifted), ['a.bb', 'b.bb', 'c.bb'])
+        self.assertFalse(os.path.exists(metadata))
+        self.assertFalse(self.processed(newdir, 'b'))
+        self.assertTrue(self.processed(newdir, 'a'))
+
+        # Only the failed track is lifted over again
+        self.fail = set()
+        self.lifted = []
+        study = hubward.models.Study(dirname, build_metadata=False)
+        study.liftover('dm6', 'dm3', newdir, jobs=2)
+        self.assertEqual(self.lifted, ['b.bb'])
+        config = yaml.safe_load(open(metadata))
+        self.assertEqual(config['study']['liftover']['from_assembly'], 'dm6')
+        self.assertEqual(
+            set(t['genome'] for t in config['tracks']), set(['dm3']))
+        for name in ['a', 'b', 'c']:
+            self.assertEqual(self.processed(newdir, name), 'chr1\t1\t10\n')
+
+
+class TestStatus(StudyTestCase):
+    def test_stat_cache_matches_os(self):
+        fn = os.path.join(self.tmp, 'file')
+        with open(fn, 'w') as f:
+            f.write('x')
+        os.symlink(fn, os.path.join(self.tmp, 'link'))
+        os.symlink('nowhere', os.path.join(self.tmp, 'broken'))
+        stats = hubward.status.StatCache()
+        for name in ['file', 'link', 'broken', 'missing']:
+            path = os.path.join(self.tmp, name)
+            self.assertEqual(stats.exists(path), os.path.exists(path), name)
+            if os.path.lexists(path):
+                self.assertEqual(
+                    stats.lstat(path).st_ino, os.lstat(path).st_ino)
+            if os.path.exists(path):
+                self.assertEqual(
+                    stats.stat(path).st_ino, os.stat(path).st_ino)
+        self.assertRaises(
+            OSError, stats.stat, os.path.join(self.tmp, 'broken'))
+
+        # Each directory is only listed once
+        os.unlink(fn)
+        self.assertTrue(stats.exists(fn))
+
+    def test_status_of_each_track(self):
+        dirname = self.make_study(['a', 'b', 'c'], 'cp $1 $2\n')
+        hubward.models.Study(dirname, build_metadata=False).process()
+        script = os.path.join(dirname, 'src', 'convert.sh')
+        later = os.stat(script).st_mtime + 10
+        os.utime(os.path.join(dirname, 'raw-data', 'b'), (later, later))
+        os.unlink(os.path.join(dirname, 'processed-data', 'c.bb'))
+
+        results = hubward.status.status(
+            [hubward.models.Study(dirname, build_metadata=False)])
+        self.assertEqual(
+            [(r['label'], r['status']) for r in results],
+            [('a', 'up-to-date'), ('b', 'stale'), ('c', 'missing')])
+        self.assertEqual(
+            results[1]['reasons'],
+            ['{0}/raw-data/b is newer than {0}/processed-data/b.bb, need to '
+             're-run'.format(dirname)])
+
+
+class TestBatch(StudyTestCase):
+    def test_manifest_and_verification(self):
+        dirname = self.make_study(['a', 'b', 'skip'], """\
+            [[ $1 == --batch ]] || exit 1
+            cp $2 $(dirname $0)/../manifest.tsv
+            while read original processed; do
+                [[ $original == *skip ]] || cp $original $processed
+            done < $2
+            """, batch=True)
+        manifest = os.path.join(dirname, 'manifest.tsv')
+        study = hubward.models.Study(dirname, build_metadata=False)
+        try:
+            study.process()
+            self.fail('expected a ValueError')
+        except ValueError as e:
+            self.assertTrue('processed-data/skip.bb' in str(e))
+            self.assertFalse('processed-data/a.bb' in str(e))
+        self.assertEqual(
+            open(manifest).read().splitlines(),
+            ['{0}/raw-data/{1}\t{0}/processed-data/{1}.bb'.format(
+                dirname, name) for name in ['a', 'b', 'skip']])
+        self.assertEqual(self.processed(dirname, 'a'), 'chr1\t1\t10\n')
+
+        # Only stale tracks are in the manifest next time
+        self.assertRaises(ValueError, study.process, jobs=2)
+        self.assertEqual(
+            open(manifest).read().splitlines(),
+            ['{0}/raw-data/skip\t{0}/processed-data/skip.bb'.format(
+                dirname)])
+
+
+class TestWorkers(StudyTestCase):
+    script = """\
+        import os
+        calls = []
+
+
+        def process(source, target):
+            calls.append(source)
+            with open(target, 'w') as f:
+                f.write('{0} {1} {2}'.format(
+                    os.getpid(), len(calls), os.environ['HUBWARD_THREADS']))
+        """
+    template = os.path.join(
+        os.path.dirname(__file__), '..', 'resources', 'process_template.py')
+
+    def test_has_entry_point(self):
+        dirname = self.make_study(
+            ['a'], self.script, shebang='#!/usr/bin/env python')
+        script = os.path.join(dirname, 'src', 'convert.sh')
+        self.assertTrue(hubward.workers.has_entry_point(script))
+        self.assertTrue(hubward.workers.has_entry_point(self.template))
+
+        for name, source in [
+            ('shell.sh', 'process() { cp $1 $2; }\n'),
+            ('other.py', 'def main(source, target):\n    pass\n'),
+        ]:
+            fn = os.path.join(self.tmp, name)
+            with open(fn, 'w') as f:
+                f.write(source)
+            self.assertFalse(hubward.workers.has_entry_point(fn), name)
+
+    def test_loaded_once_per_worker(self):
+        dirname = self.make_study(
+            ['a', 'b'], self.script, shebang='#!/usr/bin/env python',
+            resources=dict(threads=3))
+        pool = hubward.workers.WorkerPool(1)
+        try:
+            hubward.models.Study(dirname, build_metadata=False).process(
+                workers=pool)
+
+            # The template's process() is a no-op
+            pool.run(self.template, 'in', os.path.join(self.tmp, 'out'))
+        finally:
+            pool.close()
+        a = self.processed(dirname, 'a').split()
+        b = self.processed(dirname, 'b').split()
+        self.assertNotEqual(a[0], str(os.getpid()))
+        self.assertEqual(a[0], b[0])
+        self.assertEqual([a[1], b[1]], ['1', '2'])
+        self.assertEqual(a[2], '3')
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'out')))
+
+    def test_other_scripts_run_as_subprocesses(self):
+        dirname = self.make_study(['a'], 'cp $1 $2\n')
+        pool = hubward.workers.WorkerPool(1)
+        try:
+            hubward.models.Study(dirname, build_metadata=False).process(
+                workers=pool)
+        finally:
+            pool.close()
+        self.assertEqual(self.processed(dirname, 'a'), 'chr1\t1\t10\n')
+
 
 if __name__ == '__main__':
     unittest.main()